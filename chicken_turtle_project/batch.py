@@ -0,0 +1,261 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+ct-batch: run a pipeline stage in many projects at once
+'''
+
+from chicken_turtle_project.common import (
+    graceful_main, get_editable_path, debug_option, _init_logging
+)
+from chicken_turtle_project.requirements import parse_requirements_file
+from chicken_turtle_project import __version__, pipeline, trace
+from chicken_turtle_util.exceptions import UserException
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+import plumbum as pb
+import traceback
+import click
+import os
+
+import logging
+logger = logging.getLogger(__name__)
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.argument('directory', default='.', type=click.Path(exists=True, file_okay=False))
+@click.option(
+    '--stage',
+    type=click.Choice(['project', 'venv', 'docs', 'tests']),
+    default='venv',
+    show_default=True,
+    help='Stage to run in each project: project (ct-mkproject), venv (ct-mkvenv), docs (ct-mkdoc) or tests.'
+)
+@click.option(
+    '--jobs', '-j',
+    type=int,
+    default=None,
+    help='Maximum number of projects to process concurrently. Default: number of CPUs.'
+)
+@debug_option()
+@click.version_option(version=__version__)
+def main(directory, stage, jobs, debug):
+    '''
+    Run ct-mkvenv (or another stage) in each project in DIRECTORY.
+    
+    Projects are the directories containing a project.py, in DIRECTORY or any
+    of its subdirectories (except hidden directories, venvs and subdirectories
+    of projects). A project whose *requirements.in lists another project as a
+    local editable requirement (e.g. ``-e ../sibling``) is processed after the
+    other project. Projects which do not depend on each other are processed
+    concurrently, each in a separate process.
+    
+    A failing project does not stop the others, except for the projects which
+    depend on it, which are skipped. A summary of failures is logged at the
+    end.
+    '''
+    with graceful_main(logger, app_name='batch', debug=debug):
+        project_roots = _find_project_roots(Path(directory))
+        if not project_roots:
+            raise UserException('No project.py found in {}'.format(directory))
+        dependencies = _get_dependencies(project_roots)
+        failures = _run(_sort_topologically(dependencies), dependencies, stage, jobs, debug)
+        
+        # Summarise
+        logger.info('{} of {} projects succeeded'.format(len(project_roots) - len(failures), len(project_roots)))
+        if failures:
+            for project_root, message in sorted(failures.items()):
+                logger.error('{}: {}'.format(project_root, message))
+            raise UserException('{} of {} projects failed'.format(len(failures), len(project_roots)))
+    
+def _find_project_roots(directory):
+    '''
+    Find the directories containing a project.py
+    
+    Parameters
+    ----------
+    directory : pathlib.Path
+    
+    Returns
+    -------
+    [pathlib.Path]
+        Sorted absolute paths.
+    '''
+    project_roots = []
+    for path, directories, files in os.walk(os.path.abspath(str(directory))):
+        if 'project.py' in files:
+            project_roots.append(Path(path))
+            directories[:] = []  # do not look for projects inside projects
+        else:
+            directories[:] = [name for name in directories if not name.startswith('.') and name != 'venv']
+    return sorted(project_roots)
+    
+def _get_dependencies(project_roots):
+    '''
+    Get the projects which each project depends on through local editable requirements
+    
+    Parameters
+    ----------
+    project_roots : [pathlib.Path]
+        Absolute paths of projects.
+        
+    Returns
+    -------
+    {pathlib.Path : {pathlib.Path}}
+        Dependencies by project root. Only dependencies in `project_roots` are
+        included.
+    '''
+    dependencies = {}
+    project_roots = set(project_roots)
+    for project_root in project_roots:
+        dependencies[project_root] = set()
+        for path in project_root.glob('*requirements.in'):
+            for requirement in parse_requirements_file(path).requirements:
+                editable_path = get_editable_path(project_root, requirement)
+                if editable_path in project_roots and editable_path != project_root:
+                    dependencies[project_root].add(editable_path)
+    return dependencies
+    
+def _sort_topologically(dependencies):
+    '''
+    Sort projects such that each project comes after its dependencies
+    
+    Parameters
+    ----------
+    dependencies : {pathlib.Path : {pathlib.Path}}
+        As returned by `_get_dependencies`.
+        
+    Returns
+    -------
+    [pathlib.Path]
+    
+    Raises
+    ------
+    UserException
+        If dependencies are cyclic.
+    '''
+    order = []
+    remaining = dict(dependencies)
+    while remaining:
+        ready = sorted(project_root for project_root, dependencies_ in remaining.items() if not dependencies_ & remaining.keys())
+        if not ready:
+            raise UserException(
+                'Local editable requirements of these projects form a cycle: {}'
+                .format(', '.join(map(str, sorted(remaining))))
+            )
+        order.extend(ready)
+        for project_root in ready:
+            del remaining[project_root]
+    return order
+    
+def _run(project_roots, dependencies, stage, jobs, debug=False):
+    '''
+    Run stage in each project, on a process pool
+    
+    A project is submitted once all its dependencies have succeeded, or
+    skipped if any failed.
+    
+    Parameters
+    ----------
+    project_roots : [pathlib.Path]
+        Topologically sorted, as returned by `_sort_topologically`.
+    dependencies : {pathlib.Path : {pathlib.Path}}
+    stage : str
+    jobs : int or None
+        Maximum number of worker processes.
+    debug : bool
+        Whether workers log at debug level.
+        
+    Returns
+    -------
+    {pathlib.Path : str}
+        Error message by project root, for each project that failed or was
+        skipped.
+    '''
+    succeeded = set()
+    failures = {}
+    waiting = list(project_roots)
+    running = {}  # {future : project_root}
+    parent_span = trace.get_current_span_id()
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while waiting or running:
+            # Submit or skip projects whose dependencies finished. Note:
+            # waiting is in topological order, so skips cascade in one pass.
+            for project_root in list(waiting):
+                failed_dependencies = dependencies[project_root] & failures.keys()
+                if failed_dependencies:
+                    failures[project_root] = 'Skipped, failed dependencies: {}'.format(', '.join(map(str, sorted(failed_dependencies))))
+                elif dependencies[project_root] <= succeeded:
+                    logger.info('Processing {}'.format(project_root))
+                    running[executor.submit(_process, project_root, stage, parent_span, debug)] = project_root
+                else:
+                    continue
+                waiting.remove(project_root)
+                
+            # Wait for a project to finish
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    project_root = running.pop(future)
+                    try:
+                        error = future.result()
+                    except Exception as ex:  # e.g. worker process was killed
+                        error = 'Worker failed: {!r}'.format(ex)
+                    if error is None:
+                        logger.info('Finished {}'.format(project_root))
+                        succeeded.add(project_root)
+                    else:
+                        logger.error('Failed {}'.format(project_root))
+                        failures[project_root] = error
+    return failures
+    
+def _init_worker(debug):
+    '''
+    Set up logging and tracing in a worker process
+    
+    Workers started by fork inherit them from ct-batch, but those started by
+    spawn or forkserver do not. Both are no-ops when already set up.
+    
+    Note: called by each task instead of as ProcessPoolExecutor initializer,
+    which requires Python 3.7.
+    '''
+    _init_logging('batch', debug)
+    trace.start('ct-batch worker')
+    
+def _process(project_root, stage, parent_span, debug=False):
+    '''
+    Run stage in project, in a worker process
+    
+    Returns
+    -------
+    str or None
+        Error message, None if succeeded.
+    '''
+    _init_worker(debug)
+    try:
+        with trace.span(str(project_root), 'project', parent=parent_span):
+            pipeline.reset()
+            pipeline.run(stage, project_root)
+    except pb.commands.ProcessExecutionError as ex:
+        return 'Command failed\n' + str(ex)
+    except UserException as ex:
+        return ex.message
+    except SystemExit as ex:  # e.g. sys.exit in project.py; must not escape, it would kill the worker
+        if ex.code not in (None, 0):
+            return 'Exited with {}'.format(ex.code)
+    except Exception:
+        return traceback.format_exc()
+    return None
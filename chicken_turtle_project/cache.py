@@ -0,0 +1,180 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Persistent caches shared by the ct-* commands
+
+Caches live in ``$CT_CACHE_DIR``, which defaults to
+``$XDG_CACHE_HOME/chicken_turtle_project`` (``~/.cache/chicken_turtle_project``
+if XDG_CACHE_HOME is not set). Removing the directory is always safe.
+
+Entries are written atomically, so concurrent ct-* processes (e.g. the
+workers of ct-batch) never see a partial entry. Entries which are expensive
+to create are additionally created under a `lock`, so that they are created
+only once.
+'''
+
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import mkstemp
+import plumbum as pb
+import fcntl
+import hashlib
+import json
+import os
+
+def get_cache_dir():
+    '''
+    Get root directory of the CTP cache
+
+    Returns
+    -------
+    pathlib.Path
+    '''
+    path = pb.local.env.get('CT_CACHE_DIR')
+    if not path:
+        path = Path(pb.local.env.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'chicken_turtle_project'
+    return Path(str(path)).absolute()
+
+def digest(*parts):
+    '''
+    Get SHA256 hex digest of parts
+
+    Parameters
+    ----------
+    parts : iterable of (str or bytes)
+        Parts are separated by a NUL byte before hashing, so the digest of
+        ``('ab', 'c')`` differs from that of ``('a', 'bc')``.
+
+    Returns
+    -------
+    str
+    '''
+    hash_ = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        hash_.update(part)
+        hash_.update(b'\0')
+    return hash_.hexdigest()
+
+def file_digest(path):
+    '''
+    Get SHA256 hex digest of file contents
+
+    Parameters
+    ----------
+    path : pathlib.Path
+
+    Returns
+    -------
+    str or None
+        Digest, or None if the file does not exist.
+    '''
+    hash_ = hashlib.sha256()
+    try:
+        with path.open('rb') as f:
+            for buffer in iter(lambda: f.read(65536), b''):
+                hash_.update(buffer)
+    except FileNotFoundError:
+        return None
+    return hash_.hexdigest()
+
+@contextmanager
+def lock(path, blocking=True):
+    '''
+    Hold an exclusive lock on a lock file while in context
+    
+    The lock is an advisory lock (flock) which is released when the process
+    exits, so a lock file left behind is harmless.
+    
+    Parameters
+    ----------
+    path : pathlib.Path
+        Lock file, created if missing.
+    blocking : bool
+        If False, raise BlockingIOError instead of waiting when another
+        process holds the lock.
+    '''
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    
+class Cache(object):
+
+    '''
+    Persistent key-value store of text values
+
+    Each value is stored in a separate file, named after its key, in a
+    subdirectory of the CTP cache dir. Writes are atomic, so concurrent ct-*
+    processes never see a partially written value.
+    '''
+
+    def __init__(self, name):
+        '''
+        Parameters
+        ----------
+        name : str
+            Name of the cache, used as subdirectory name.
+        '''
+        self._dir = get_cache_dir() / name
+
+    def _path(self, key):
+        return self._dir / key
+
+    def get(self, key):
+        '''
+        Get value of key, None if missing
+        '''
+        try:
+            with self._path(key).open('r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        '''
+        Set value of key
+        '''
+        os.makedirs(str(self._dir), exist_ok=True)
+        fd, temp_path = mkstemp(dir=str(self._dir), prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(value)
+            os.replace(temp_path, str(self._path(key)))
+        except:
+            os.remove(temp_path)
+            raise
+
+    def get_json(self, key):
+        '''
+        Get JSON decoded value of key, None if missing
+        '''
+        value = self.get(key)
+        if value is not None:
+            value = json.loads(value)
+        return value
+
+    def set_json(self, key, value):
+        '''
+        Set value of key to JSON encoded value
+        '''
+        self.set(key, json.dumps(value, sort_keys=True))
@@ -21,14 +21,21 @@ from chicken_turtle_util.exceptions import UserException
 from urllib.parse import urlparse
 from pathlib import Path
 from glob import glob
+from configparser import ConfigParser
 from chicken_turtle_project.specification import project_py_required_attributes, project_py_optional_attributes
+from chicken_turtle_project.cache import Cache, digest, file_digest
+from chicken_turtle_project import __version__, trace
 import plumbum as pb
 import shutil
-import git
+import stat
+import uuid
+import os
 import sys
 import re
 import click
 from functools import partial
+from threading import Lock
+from types import MappingProxyType
 
 import logging
 logger = logging.getLogger(__name__)
@@ -43,22 +50,116 @@ def eval_string(string, name='in_memory_string'):
     exec(code, None, locals_)
     return locals_
     
+class Project(object):
+    
+    '''
+    Validated project info of project.py, immutable
+    
+    Each attribute of project.py's `project` is an attribute of the same name.
+    Missing optional attributes are None, except for `pre_commit_no_ignore`
+    which defaults to an empty tuple. `entry_points` is a read-only mapping of
+    tuples.
+    
+    Use `get_project` to get the Project of a project.
+    '''
+    
+    __slots__ = tuple(sorted(project_py_required_attributes | project_py_optional_attributes))
+    
+    def __init__(self, **attributes):
+        attributes = dict(attributes)
+        attributes['python_version'] = tuple(attributes['python_version'])
+        attributes['pre_commit_no_ignore'] = tuple(attributes.get('pre_commit_no_ignore', ()))
+        if attributes.get('entry_points') is not None:
+            attributes['entry_points'] = MappingProxyType({
+                group: tuple(entry_points)
+                for group, entry_points in attributes['entry_points'].items()
+            })
+        for name in self.__slots__:
+            object.__setattr__(self, name, attributes.get(name))
+            
+    def __setattr__(self, name, value):
+        raise AttributeError('Project is immutable')
+    
+    def __delattr__(self, name):
+        raise AttributeError('Project is immutable')
+    
+    def __eq__(self, other):
+        return isinstance(other, Project) and self.to_dict() == other.to_dict()
+    
+    def __hash__(self):
+        return hash(self.name)
+    
+    def __repr__(self):
+        return 'Project({})'.format(', '.join('{}={!r}'.format(name, value) for name, value in sorted(self.to_dict().items())))
+    
+    def to_dict(self):
+        '''
+        Get project info as dict, as in project.py
+        
+        Returns
+        -------
+        dict
+            New dict of all attributes which are not None. Values are copies as
+            well, e.g. `entry_points` is a dict of lists.
+        '''
+        project = {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+        project['pre_commit_no_ignore'] = list(project['pre_commit_no_ignore'])
+        if 'entry_points' in project:
+            project['entry_points'] = {group: list(entry_points) for group, entry_points in project['entry_points'].items()}
+        return project
+    
+_projects = {}  # project.py digest -> Project
+    
 def get_project(project_root):
     '''
     Get and validate project info from project.py
     
+    Validated project info is cached by content of project.py and CTP version,
+    in process and on disk, so commands only validate a changed project.py.
+    
     Returns
     -------
-    dict
-        project info.
+    Project
     '''
     # Load 
+    project_py_path = project_root / 'project.py'
     try:
-        project = eval_file(project_root / 'project.py')['project']
+        with project_py_path.open() as f:
+            content = f.read()
     except IOError:
         raise UserException('Must run from the directory which contains project.py')
+    key = digest(content, __version__)
+    project = _projects.get(key)
+    if project is None:
+        cache = Cache('project')
+        cached = cache.get_json(key)
+        if cached is None:
+            attributes, warnings = _validate_project(project_root, eval_string(content, str(project_py_path)))
+            cache.set_json(key, dict(attributes=attributes, warnings=warnings))
+        else:
+            attributes = cached['attributes']
+            warnings = cached['warnings']
+        for warning in warnings:
+            logger.warning(warning)
+        project = Project(**attributes)
+        _projects[key] = project
+    return project
+    
+def _validate_project(project_root, project_py):
+    '''
+    Validate locals of project.py
+    
+    Returns
+    -------
+    (project :: dict, warnings :: [str])
+        Validated project info with stripped values and defaults filled in,
+        and warnings to log.
+    '''
+    try:
+        project = project_py['project']
     except KeyError:
         raise UserException('project.py must export a `project` variable (with a dict)')
+    warnings = []
     
     # Attributes that must be present    
     for attr in project_py_required_attributes:
@@ -101,9 +202,9 @@ def get_project(project_root):
     if re.search('\s', project['name']):
         raise UserException('Attribute `name` may not contain whitespace, use dashes instead')
     if re.search('_', project['name']):
-        logger.warning('Attribute `name` contains underscores, dashes are preferred')
+        warnings.append('Attribute `name` contains underscores, dashes are preferred')
     if project['name'].lower() != project['name']:
-        logger.warning('Attribute `name` contains upper case characters, all lower case is preferred')
+        warnings.append('Attribute `name` contains upper case characters, all lower case is preferred')
     
     # Validate readme_file
     if not re.fullmatch('(.*/)?README.[a-z0-9]+', project['readme_file']):
@@ -120,7 +221,7 @@ def get_project(project_root):
     version = project['python_version']
     if len(version) != 2 or not isinstance(version[0], int) or not isinstance(version[1], int) or version[0] < 0 or version[1] < 0:
         raise UserException('python_version must be a tuple of (major>0, minor>0), e.g. (3,5): {!r}'.format(pattern))
-    return project
+    return project, warnings
     
 def _init_logging(app_name, debug):
     if debug:
@@ -135,8 +236,11 @@ def _init_logging(app_name, debug):
 def graceful_main(logger, app_name, debug=False):
     _init_logging(app_name, debug)
     signal(SIGPIPE, SIG_DFL)  # Ignore SIGPIPE, http://stackoverflow.com/a/30091579/1031434
+    command_name = app_name if app_name == 'ct' else 'ct-' + app_name
+    trace.start(command_name)
     try:
-        yield
+        with trace.span(command_name, 'process'):
+            yield
     except pb.commands.ProcessExecutionError as ex:
         logger.error('Command failed\n' + str(ex))
         sys.exit(3)
@@ -146,52 +250,134 @@ def graceful_main(logger, app_name, debug=False):
     except Exception as ex:
         logger.exception(ex)
         sys.exit(2)
+    finally:
+        trace.stop()
 
+@contextmanager
+def working_directory(path):
+    '''
+    Change the current working directory of the process and of plumbum's
+    local machine, restoring both on exit
+    
+    Parameters
+    ----------
+    path : pathlib.Path or str
+    '''
+    original = os.getcwd()
+    os.chdir(str(path))
+    try:
+        with pb.local.cwd(str(path)):
+            yield
+    finally:
+        os.chdir(original)
+        
 def get_repo(project_root):
+    import git  # Note: slow import, only import when needed
     return git.Repo(pb.local.env.get('GIT_DIR', str(project_root)))
 
-#TODO test whole CTP with a line like -e ../chicken_turtle_util[asyncio,configuration,inspect]
-def parse_requirements(lines):
-    for line in lines:
-        match = re.fullmatch(r'(-e\s)?\s*([^#\s][^\s]*)?\s*(#.*)?', line.strip())
-        result = [bool(match.group(1)), None, None, match.group(0)]
-        dependency = match.group(2)
-        if dependency:
-            result[1] = dependency 
-            for pattern in (r'(\[)', r'(==|<|>)'):
-                parts = re.split(pattern, dependency)
-                if len(parts) > 1:
-                    result[1] = ''.join(parts[:-2])
-                    result[2] = ''.join(parts[-2:])
-                    break
-        yield tuple(result)
-    
-# XXX requirements.txt files are very complex https://pip.pypa.io/en/stable/reference/pip_install/#requirements-file-format
-# We do not want to duplicate the effort into parsing them
-# Yet we do want to get the names of the packages that would be installed by `pip -r requirement.txt` 
-# The returned url isn't even necessarily a url.
-# The current limitation is very limited but seems to do alright on requirements.txt files generated by pip-compile
-def parse_requirements_file(path):
-    '''
-    Parse requirements.txt or requirements.in file
-    
-    Note: requirements-parser 0.1.0 does not support -e lines it seems, hence this ad-hoc parser
-    
+def get_git_dir(path):
+    '''
+    Get the git directory of the repository path is in, without running git
+
+    Honours ``GIT_DIR``. A ``.git`` file (worktree, submodule) is followed.
+
     Parameters
     ----------
     path : pathlib.Path
-        path to requirements file
+        Absolute path.
+
+    Returns
+    -------
+    pathlib.Path or None
+        Absolute path, None if path is not in a git repository.
+    '''
+    git_dir = pb.local.env.get('GIT_DIR')
+    if git_dir:
+        return Path(os.path.abspath(git_dir))
+    for directory in [path] + list(path.parents):
+        dot_git = directory / '.git'
+        if dot_git.is_dir():
+            return dot_git
+        if dot_git.is_file():
+            with dot_git.open() as f:
+                content = f.read().strip()
+            if content.startswith('gitdir:'):
+                return Path(os.path.normpath(str(directory / content[len('gitdir:'):].strip())))
+    return None
+
+class GitStaging(object):
+    
+    '''
+    Paths to stage with git, staged all at once by a single git call
+    
+    Attributes
+    ----------
+    staged : bool
+        True if `commit` staged any paths, i.e. changed the git index.
+    '''
+    
+    def __init__(self):
+        self._paths = set()
+        self._lock = Lock()
+        self.staged = False
+        
+    def add(self, path):
+        '''
+        Add path to stage
+        
+        Parameters
+        ----------
+        path : pathlib.Path or str
+        '''
+        with self._lock:
+            self._paths.add(str(path))
+        
+    def commit(self):
+        '''
+        Stage all added paths
+        '''
+        if self._paths:
+            paths = sorted(self._paths)
+            logger.debug('Staging ' + ' '.join(paths))
+            pb.local['git']('add', '--', *paths)
+            self._paths.clear()
+            self.staged = True
+    
+@contextmanager
+def git_staging():
+    '''
+    Context manager that yields a GitStaging, staged on exit
+    
+    Paths are staged even when an exception is raised, files which were
+    changed should be staged regardless.
+    '''
+    staging = GitStaging()
+    try:
+        yield staging
+    finally:
+        staging.commit()
+
+def get_editable_path(project_root, requirement):
+    '''
+    Get absolute path of local editable requirement, None if not editable or not local
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+        Root of the project whose requirements file lists the requirement.
+    requirement : chicken_turtle_project.requirements.Requirement
         
     Returns
     -------
-    Generator that yields (editable : bool, dependency_url : str, version_spec : str, whole line : str)
-    '''
-    # XXX return namedtuple instead
-    with path.open('r') as f:
-        # Ad-hoc parse each line into a dependency (requirements-parser 0.1.0 does not support -e lines it seems)
-        for parsed in parse_requirements(f.readlines()):
-            yield parsed
-                
+    pathlib.Path or None
+    '''
+    if not requirement.editable:
+        return None
+    url = urlparse(requirement.dependency)
+    if url.scheme not in ('', 'file') or not url.path:
+        return None
+    return Path(os.path.normpath(str(project_root / url.path)))
+    
 def path_stem_deep(path):#XXX unused, but maybe useful
     '''path name without any suffixes'''
     i = path.name.find('.')
@@ -206,6 +392,21 @@ def get_url_name(url):#XXX unused
     return path_stem_deep(Path(result.netloc + '/' + result.path))
 
 def get_dependency_name(editable, url):
+    '''
+    Get normalised project name of a requirement
+    
+    Parameters
+    ----------
+    editable : bool
+    url : str
+        Project name, or url/path of an editable requirement. The name of a
+        local editable requirement without ``egg=`` fragment is read from its
+        metadata, see `_get_project_name`.
+        
+    Returns
+    -------
+    str
+    '''
     if not editable:
         name = url
     else:
@@ -213,11 +414,153 @@ def get_dependency_name(editable, url):
         if match:
             name = match.group(1)
         else:
-            url = urlparse(url)
-            name = pb.local['python'](str(Path(url.path) / 'setup.py'), '--name').strip()
+            name = _get_project_name(Path(urlparse(url).path))
+    return normalise_name(name)
+
+def normalise_name(name):
+    '''
+    Normalise project name as in PEP 503, e.g. ``Foo.Bar_baz`` -> ``foo-bar-baz``
+    '''
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def parse_version(version):
+    '''
+    Parse version, so that equivalent versions compare equal (e.g. 1.0 and 1.0.0)
+    
+    Returns
+    -------
+    packaging.version.Version or str
+        The version as is if it is invalid, or if packaging is not installed.
+    '''
+    try:
+        from packaging.version import Version, InvalidVersion
+    except ImportError:
+        return version
+    try:
+        return Version(version)
+    except InvalidVersion:
+        return version
+
+_project_names = {}  # key -> name, see _get_project_name
+
+def _get_project_name(path):
+    '''
+    Get name of the Python project in a directory
+    
+    Reads static metadata first: project.py, setup.cfg, pyproject.toml, and
+    PKG-INFO of an sdist or egg-info directory. Only if none of these provides
+    the name, ``setup.py --name`` is run. Names are cached (in process and on
+    disk) by path and the content of these files, except PKG-INFO, which is
+    generated from them.
+    
+    Parameters
+    ----------
+    path : pathlib.Path
+        Project root.
+    
+    Returns
+    -------
+    str
+    '''
+    path = path.absolute()
+    key = digest(str(path), *(file_digest(path / name) or '' for name in ('project.py', 'setup.cfg', 'pyproject.toml', 'setup.py')))
+    name = _project_names.get(key)
+    if name is None:
+        cache = Cache('project_name')
+        name = cache.get(key)
+        if name is None:
+            name = _read_project_name(path)
+            if name is None:
+                logger.debug('Running setup.py --name of {}'.format(path))
+                name = pb.local['python'](str(path / 'setup.py'), '--name').strip()
+            cache.set(key, name)
+        _project_names[key] = name
+    return name
+
+def _read_project_name(path):
+    '''
+    Read project name from static metadata, None if not found
+    '''
+    # project.py
+    try:
+        with (path / 'project.py').open() as f:
+            name = eval_string(f.read(), str(path / 'project.py'))['project'].get('name')
+        if name:
+            return name
+    except Exception:  # missing or invalid project.py
+        pass
         
-    return name.lower().replace('_', '-')
+    # setup.cfg
+    config = ConfigParser(interpolation=None)
+    config.read(str(path / 'setup.cfg'))
+    name = config.get('metadata', 'name', fallback=None)
+    if name and not name.startswith(('attr:', 'file:')):
+        return name
+    
+    # pyproject.toml. Note: only supports a basic string on a single line, e.g. name = "pkg"
+    try:
+        with (path / 'pyproject.toml').open() as f:
+            content = f.read()
+        match = re.search(r'^\[project\]\s*$(.*?)(?=^\[|\Z)', content, re.MULTILINE | re.DOTALL)
+        if match:
+            match = re.search(r'^name\s*=\s*["\']([^"\']+)["\']\s*(#.*)?$', match.group(1), re.MULTILINE)
+            if match:
+                return match.group(1)
+    except FileNotFoundError:
+        pass
+    
+    # PKG-INFO
+    for pkg_info_path in [path / 'PKG-INFO'] + sorted(path.glob('*.egg-info/PKG-INFO')):
+        try:
+            with pkg_info_path.open() as f:
+                match = re.search(r'^Name:\s*(\S+)', f.read(), re.MULTILINE)
+            if match:
+                return match.group(1)
+        except FileNotFoundError:
+            pass
+    
+    return None
 
+def write_file_if_changed(path, content):
+    '''
+    Write file atomically, unless it already has the given content
+    
+    When the content is unchanged, the file is not touched at all, leaving its
+    mtime intact for caches depending on it. Otherwise, the content is written
+    to a temporary file which then replaces the file, so that readers never
+    see a partially written file. The mode of an existing file is kept.
+    
+    Parameters
+    ----------
+    path : pathlib.Path
+    content : str
+    
+    Returns
+    -------
+    bool
+        True if the file was written.
+    '''
+    try:
+        with path.open('r') as f:
+            if f.read() == content:
+                return False
+        mode = stat.S_IMODE(path.stat().st_mode)
+    except FileNotFoundError:
+        mode = None
+    
+    temp_path = path.with_name('.{}.{}.tmp'.format(path.name, uuid.uuid4().hex))
+    fd = os.open(str(temp_path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)  # umask applies
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        if mode is not None:
+            temp_path.chmod(mode)
+        os.replace(str(temp_path), str(path))
+    except:
+        temp_path.unlink()
+        raise
+    return True
+    
 def get_pkg_root(project_root, package_name):
     return project_root / package_name.replace('.', '/')
     
@@ -0,0 +1,65 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+from chicken_turtle_project.common import graceful_main, debug_option
+from chicken_turtle_project import __version__, pipeline
+from chicken_turtle_util import cli
+import click
+
+import logging
+logger = logging.getLogger(__name__)
+
+@click.group(chain=True, context_settings=dict(help_option_names=['-h', '--help']))
+@debug_option()
+@click.version_option(version=__version__)
+@click.pass_context
+def main(context, debug):
+    '''
+    Run Chicken Turtle Project commands in a single process.
+    
+    Commands run the commands they depend on first: project (ct-mkproject) <-
+    venv (ct-mkvenv) <- docs (ct-mkdoc), and venv <- tests (py.test in the
+    venv). Multiple commands can be given; each runs at most once, e.g. ``ct
+    docs tests`` updates the venv once.
+    
+    Must be run in the project root.
+    '''
+    context.obj = dict(debug=debug)
+    pipeline.reset()
+    
+def _add_stage_command(name, help_):
+    @main.command(name, help=help_)
+    @click.pass_context
+    def command(context):
+        with graceful_main(logger, app_name='ct', debug=context.obj['debug']):
+            pipeline.run(name)
+    
+_add_stage_command('project', 'Create, update and validate project, like ct-mkproject.')
+_add_stage_command('venv', 'Create or update venv, like ct-mkvenv.')
+_add_stage_command('docs', 'Generate documentation, like ct-mkdoc.')
+_add_stage_command('tests', 'Run the tests in the venv.')
+
+@main.command('release')
+@cli.argument('project-version')
+@click.pass_context
+def _release(context, project_version):
+    '''
+    Release the project, like ct-release.
+    '''
+    with graceful_main(logger, app_name='ct', debug=context.obj['debug']):
+        from chicken_turtle_project.release import release, Version
+        release(Version(project_version))
@@ -19,9 +19,8 @@ from chicken_turtle_project.common import (
     graceful_main, remove_file, get_project, get_pkg_root,
     debug_option
 )
-from chicken_turtle_project import __version__
+from chicken_turtle_project import __version__, pipeline
 import click
-from pathlib import Path
 import logging
 import plumbum as pb
 
@@ -34,22 +33,30 @@ def main(debug):
     '''
     Generate project documentation
     
-    Note: calls `ct-mkvenv` to ensure the venv is up to date
+    Note: runs ct-mkvenv's stage first to ensure the venv is up to date
     '''
     with graceful_main(logger, app_name='mkdoc', debug=debug):
-        pb.local['ct-mkvenv'] & pb.FG  # ensure venv is up to date
+        pipeline.reset()
+        pipeline.run('docs')
         
-        venv_dir = Path(pb.local.env.get('CT_VENV_DIR', 'venv')).absolute()
-        project_root = Path.cwd()
-        project = get_project(project_root)
-        pkg_root = get_pkg_root(project_root, project['package_name'])
-        
-        doc_root = project_root / 'docs'
-        remove_file(doc_root / 'build')
-        kwargs = dict(
-            venv_activate=venv_dir / 'bin/activate',
-            doc_root=doc_root,
-            pkg_root=pkg_root,
-            pkg_root_root= project_root / project['package_name'].split('.')[0]
-        )
-        pb.local['sh']['-c', '. {venv_activate} && cd {doc_root} && make html'.format(**kwargs)] & pb.FG
+def mkdoc(project_root):
+    '''
+    Generate documentation of project, assuming its venv is up to date
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    '''
+    venv_dir = pipeline.get_venv_dir(project_root)
+    project = get_project(project_root)
+    pkg_root = get_pkg_root(project_root, project.package_name)
+    
+    doc_root = project_root / 'docs'
+    remove_file(doc_root / 'build')
+    kwargs = dict(
+        venv_activate=venv_dir / 'bin/activate',
+        doc_root=doc_root,
+        pkg_root=pkg_root,
+        pkg_root_root= project_root / project.package_name.split('.')[0]
+    )
+    pb.local['sh']['-c', '. {venv_activate} && cd {doc_root} && make html'.format(**kwargs)] & pb.FG
@@ -17,34 +17,39 @@
 
 from chicken_turtle_util.exceptions import UserException
 from chicken_turtle_project.common import (
-    get_project, graceful_main, get_repo, 
-    parse_requirements_file, get_dependency_name, get_pkg_root, 
-    is_sip_dependency, get_dependency_file_paths, debug_option
+    get_project, graceful_main, get_git_dir, git_staging,
+    get_dependency_name, get_pkg_root, is_sip_dependency, 
+    write_file_if_changed, debug_option, get_editable_path
 )
+from chicken_turtle_project.requirements import get_dependency_manifest, parse_requirement_line
+from chicken_turtle_project.cache import Cache, digest, file_digest
+from chicken_turtle_project.stages import Stage, Stamps, run_stages
+from chicken_turtle_project.package_data import get_package_data
 from chicken_turtle_project import specification as spec
-from setuptools import find_packages  # Always prefer setuptools over distutils
 from collections import defaultdict
+from functools import partial
 from pathlib import Path
 from configparser import ConfigParser
+from io import StringIO
 from chicken_turtle_project import __version__
 from chicken_turtle_util import cli
 from datetime import date
 import plumbum as pb
-import pypandoc
 import click
+import itertools
+import json
+import platform
 import pprint
+import stat
 import os
 import re
 from glob import glob
-from tempfile import mkstemp
-from collections_extended import setlist
+from tempfile import TemporaryDirectory
 import sys
 
 import logging
 logger = logging.getLogger(__name__)
 
-git_ = pb.local['git']
-
 _dummy_version = '0.0.0'
 
 def main(args=None):
@@ -57,9 +62,29 @@ def main(args=None):
     envvar='CT_PROJECT_VERSION',
     help='Internal option, do not use.'
 )
+@click.option(
+    '--full-resolve',
+    is_flag=True,
+    default=False,
+    envvar='CT_FULL_RESOLVE',
+    help='Resolve all requirements, instead of only the added and changed requirements.'
+)
+@click.option(
+    '--jobs', '-j',
+    type=int,
+    default=None,
+    envvar='CT_JOBS',
+    help='Maximum number of stages (e.g. pip-compile, pandoc) to run concurrently. Default: no limit, 1: run sequentially.'
+)
+@click.option(
+    '--explain',
+    is_flag=True,
+    default=False,
+    help='Explain why each generated file is or is not regenerated.'
+)
 @debug_option()
 @click.version_option(version=__version__)
-def _main(project_version, debug):
+def _main(project_version, full_resolve, jobs, explain, debug):
     '''
     Create, update and validate project, enforcing Chicken Turtle Project
     development methodology.
@@ -87,6 +112,12 @@ def _main(project_version, debug):
     - test_requirements.in
     - MANIFEST.in
     
+    Generated files are only regenerated when their inputs (e.g. project.py,
+    requirements.in or the package tree) changed, or when the file itself was
+    modified, since the last run. Use --explain to see which files are
+    regenerated and why. Records of the last run are kept in
+    .cache/chicken_turtle_project.
+    
     The following files will be created or overwritten if they exist:
     
     - requirements.txt
@@ -114,94 +145,256 @@ def _main(project_version, debug):
     Environment variables:
     
     - CT_NO_MKPROJECT: when set, ct-mkproject will exit immediately
+    - CT_FULL_RESOLVE: when set, imply --full-resolve
+    - CT_CACHE_DIR: directory in which to cache e.g. compiled requirements.
+      Defaults to ``$XDG_CACHE_HOME/chicken_turtle_project``.
+    - CT_TRACE: when set, append trace spans of each ct-* command, stage and
+      command run to this file (Chrome trace event format).
     '''
     with graceful_main(logger, app_name='mkproject', debug=debug):
         if 'CT_NO_MKPROJECT' in pb.local.env:
             sys.exit(0)
         
-        project_root = Path.cwd()
-        repo = get_repo(project_root)
-        
-        _ensure_project_exists(project_root)
+        mkproject(Path.cwd(), project_version, full_resolve, jobs, explain)
         
-        project = get_project(project_root)
-        pkg_root = get_pkg_root(project_root, project['package_name'])
-        project['version'] = project_version
-        
-        format_kwargs = {
-            'name': project['name'],
-            'human_friendly_name': project['human_friendly_name'],
-            'author': project['author'],
-            'readme_file': project['readme_file'],
-            'pkg_root': str(pkg_root.relative_to(project_root)),
-            'pkg_root_root': str(project['package_name'].split('.')[0]),
-            'pkg_name': project['package_name'],
-            'version': project_version,
-            'year': date.today().year,
-        }
+def mkproject(project_root, project_version=_dummy_version, full_resolve=False, jobs=None, explain=False):
+    '''
+    Create, update and validate project, staging the files it changed
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    project_version : str
+    full_resolve : bool
+        See ``--full-resolve``.
+    jobs : int or None
+        See ``--jobs``.
+    explain : bool
+        See ``--explain``.
+    '''
+    with git_staging() as staging:
+        _mkproject(project_root, project_version, full_resolve, staging, jobs, explain)
+    if staging.staged:
+        # Staging changed the git index, which is part of the key of the cached
+        # packages; recache them, so the next run needn't run git
+        _find_packages(project_root, _get_cache_dir(project_root) / 'packages.json')
         
+def _mkproject(project_root, project_version, full_resolve, staging, jobs=None, explain=False):
+    '''
+    Create, update and validate project
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    project_version : str
+    full_resolve : bool
+        See ``--full-resolve``.
+    staging : chicken_turtle_project.common.GitStaging
+        Modified files are added to this.
+    jobs : int or None
+        See ``--jobs``.
+    explain : bool
+        See ``--explain``.
+    '''
+    # Note: GitPython is slow to import, a no-op run must not need it
+    git_dir = get_git_dir(project_root)
+    if git_dir is None:
+        raise UserException('Project must be in a git repository: {}'.format(project_root))
+    
+    _ensure_project_exists(project_root, staging)
+    
+    project = get_project(project_root)
+    pkg_root = get_pkg_root(project_root, project.package_name)
+    
+    format_kwargs = {
+        'name': project.name,
+        'human_friendly_name': project.human_friendly_name,
+        'author': project.author,
+        'readme_file': project.readme_file,
+        'pkg_root': str(pkg_root.relative_to(project_root)),
+        'pkg_root_root': str(project.package_name.split('.')[0]),
+        'pkg_name': project.package_name,
+        'version': project_version,
+        'year': date.today().year,
+    }
+    
+    def update_packages():
         path = pkg_root
         while path != project_root:
-            _ensure_exists(path / '__init__.py')
+            _ensure_exists(path / '__init__.py', staging=staging)
             path = path.parent
-        _update_root_package(pkg_root, format_kwargs)
+        _update_root_package(pkg_root, format_kwargs, staging)
         
         test_root = pkg_root / 'tests'
-        _ensure_exists(test_root / '__init__.py')
+        _ensure_exists(test_root / '__init__.py', staging=staging)
         
         conftest_py_path = test_root / 'conftest.py'
-        _ensure_exists(conftest_py_path)
-        _ensure_contains_snippets(conftest_py_path, {spec.conftest_py}, format_kwargs)
-        
+        _ensure_exists(conftest_py_path, staging=staging)
+        _ensure_contains_snippets(conftest_py_path, {spec.conftest_py}, format_kwargs, staging=staging)
+    
+    def update_manifest_in():
         manifest_in = project_root / 'MANIFEST.in'
-        _ensure_exists(manifest_in)
-        _ensure_contains_snippets(manifest_in, spec.manifest_in, format_kwargs)
-        
+        _ensure_exists(manifest_in, staging=staging)
+        _ensure_contains_snippets(manifest_in, spec.manifest_in, format_kwargs, staging=staging)
+    
+    def update_requirements_in():
         requirements_in_path = project_root / 'requirements.in'
-        _ensure_exists(requirements_in_path)
-        _ensure_contains_snippets(requirements_in_path, {spec.requirements_in_header}, format_kwargs)
+        _ensure_exists(requirements_in_path, staging=staging)
+        _ensure_contains_snippets(requirements_in_path, {spec.requirements_in_header}, format_kwargs, staging=staging)
 
         dev_requirements_in_path = project_root / 'dev_requirements.in'
-        _ensure_exists(dev_requirements_in_path)
-        _ensure_contains_snippets(dev_requirements_in_path, spec.dev_requirements_in, format_kwargs)
+        _ensure_exists(dev_requirements_in_path, staging=staging)
+        _ensure_contains_snippets(dev_requirements_in_path, spec.dev_requirements_in, format_kwargs, staging=staging)
         
         test_requirements_in_path = project_root / 'test_requirements.in'
-        _ensure_exists(test_requirements_in_path)
-        _ensure_contains_snippets(test_requirements_in_path, spec.test_requirements_in, format_kwargs)
-        
+        _ensure_exists(test_requirements_in_path, staging=staging)
+        _ensure_contains_snippets(test_requirements_in_path, spec.test_requirements_in, format_kwargs, staging=staging)
+    
+    def update_setup_cfg():
         setup_cfg_path = project_root / 'setup.cfg'
-        _ensure_exists(setup_cfg_path)
-        _update_ini_file(setup_cfg_path, spec.setup_cfg_defaults, spec.setup_cfg_overwrite, format_kwargs)
-        
+        _ensure_exists(setup_cfg_path, staging=staging)
+        _update_ini_file(setup_cfg_path, spec.setup_cfg_defaults, spec.setup_cfg_overwrite, format_kwargs, staging=staging)
+    
+    def update_coveragerc():
         coveragerc_path = project_root / '.coveragerc'
-        _ensure_exists(coveragerc_path)
-        _update_ini_file(coveragerc_path, spec.coveragerc_defaults, spec.coveragerc_overwrite, format_kwargs)
-        
+        _ensure_exists(coveragerc_path, staging=staging)
+        _update_ini_file(coveragerc_path, spec.coveragerc_defaults, spec.coveragerc_overwrite, format_kwargs, staging=staging)
+    
+    def update_gitignore():
         gitignore_path = project_root / '.gitignore'
-        _ensure_exists(gitignore_path)
-        _ensure_contains_snippets(gitignore_path, spec.gitignore_patterns, format_kwargs)
-        
-        pre_commit_hook = Path(repo.git_dir) / 'hooks/pre-commit'
-        _ensure_exists(pre_commit_hook, git_add=False)
-        _ensure_contains_snippets(pre_commit_hook, {spec.pre_commit_hook}, format_kwargs, git_add=False)
-        pre_commit_hook.chmod(0o775)
-        
+        _ensure_exists(gitignore_path, staging=staging)
+        _ensure_contains_snippets(gitignore_path, spec.gitignore_patterns, format_kwargs, staging=staging)
+    
+    def update_pre_commit_hook():
+        pre_commit_hook = git_dir / 'hooks/pre-commit'
+        _ensure_exists(pre_commit_hook)
+        _ensure_contains_snippets(pre_commit_hook, {spec.pre_commit_hook}, format_kwargs)
+        if stat.S_IMODE(pre_commit_hook.stat().st_mode) != 0o775:
+            pre_commit_hook.chmod(0o775)
+    
+    def validate():
         _raise_if_missing_file(project)
-        
         # TODO check that source files have correct copyright header
         # TODO ensure the readme_file is mentioned in MANIFEST.in
-        
-        _update_requirements_txt(project_root)
-        
-        _update_setup_py(project, project_root, pkg_root, format_kwargs)
-        
-        doc_root = project_root / 'docs' 
-        _ensure_exists(doc_root / 'conf.py', spec.docs_conf_py, format_kwargs)
-        _ensure_exists(doc_root / 'Makefile', spec.docs_makefile, raw=True)
-        _ensure_exists(doc_root / 'index.rst', spec.docs_index_rst, format_kwargs)
-        _ensure_exists(doc_root / '_templates/autosummary/module.rst', spec.docs_templates_autosummary_module_rst, raw=True)
-            
-def _ensure_project_exists(project_root):
+    
+    doc_root = project_root / 'docs'
+    
+    def update_docs():
+        _ensure_exists(doc_root / 'conf.py', spec.docs_conf_py, format_kwargs, staging=staging)
+        _ensure_exists(doc_root / 'Makefile', spec.docs_makefile, raw=True, staging=staging)
+        _ensure_exists(doc_root / 'index.rst', spec.docs_index_rst, format_kwargs, staging=staging)
+        _ensure_exists(doc_root / '_templates/autosummary/module.rst', spec.docs_templates_autosummary_module_rst, raw=True, staging=staging)
+    
+    # Inputs of the generated files, a stage reruns when any of its inputs or
+    # outputs changed since it last ran
+    def get_config_inputs():
+        return {
+            'project.py': file_digest(project_root / 'project.py'),
+            'format_kwargs': digest(repr(sorted(format_kwargs.items()))),
+            'chicken_turtle_project': _get_generator_digest(),
+        }
+    
+    def get_requirements_txt_inputs():
+        inputs = _get_requirements_inputs(project_root)
+        inputs['python'] = platform.python_version()
+        inputs['chicken_turtle_project'] = _get_generator_digest()
+        return inputs
+    
+    def get_setup_py_inputs():
+        inputs = get_config_inputs()
+        inputs.update(_get_requirements_inputs(project_root))
+        inputs[project.readme_file] = file_digest(project_root / project.readme_file)
+        packages = _find_packages(project_root, packages_cache)
+        inputs['packages'] = digest(*packages)
+        inputs['package_data'] = digest(repr(sorted(get_package_data(project_root, packages, package_data_cache).items())))
+        return inputs
+    
+    # Note: stages mostly wait on I/O or subprocesses (pip-compile, pandoc),
+    # so independent stages run concurrently. pip-compile and pandoc wait on
+    # `validate` as to fail fast on an invalid project.
+    cache_dir = _get_cache_dir(project_root)
+    stamps = Stamps(cache_dir / 'mkproject.json')
+    packages_cache = cache_dir / 'packages.json'
+    package_data_cache = cache_dir / 'package_data.json'
+    try:
+        run_stages([
+            Stage(
+                'package_files', update_packages, inputs=get_config_inputs,
+                outputs=[path / '__init__.py' for path in pkg_root.parents if project_root in path.parents] + [
+                    pkg_root / '__init__.py', pkg_root / 'tests/__init__.py', pkg_root / 'tests/conftest.py'
+                ]
+            ),
+            Stage('manifest_in', update_manifest_in, inputs=get_config_inputs, outputs=[project_root / 'MANIFEST.in']),
+            Stage(
+                'requirements_in', update_requirements_in, inputs=get_config_inputs,
+                outputs=[project_root / name for name in ('requirements.in', 'dev_requirements.in', 'test_requirements.in')]
+            ),
+            Stage('setup_cfg', update_setup_cfg, inputs=get_config_inputs, outputs=[project_root / 'setup.cfg']),
+            Stage('coveragerc', update_coveragerc, inputs=get_config_inputs, outputs=[project_root / '.coveragerc']),
+            Stage('gitignore', update_gitignore, inputs=get_config_inputs, outputs=[project_root / '.gitignore']),
+            Stage('pre_commit_hook', update_pre_commit_hook),
+            Stage('validate', validate),
+            Stage(
+                'requirements_txt', lambda: _update_requirements_txt(project_root, staging, incremental=not full_resolve),
+                after=('requirements_in', 'validate'), outputs=[project_root / 'requirements.txt'],
+                inputs=None if full_resolve else get_requirements_txt_inputs,  # a full resolve always runs
+            ),
+            Stage('dependencies', lambda: _get_dependencies(project_root), on_demand=True),
+            Stage('long_description', lambda: _get_long_description(project_root, project.readme_file), on_demand=True),
+            Stage('packages', lambda: _find_packages(project_root, packages_cache), on_demand=True),
+            Stage('package_data', lambda packages: get_package_data(project_root, packages, package_data_cache), ('packages',), on_demand=True),
+            Stage(
+                'setup_py', partial(_update_setup_py, project, project_version, project_root, staging),
+                ('dependencies', 'long_description', 'packages', 'package_data'),
+                after=('package_files', 'requirements_in', 'gitignore', 'validate'),
+                inputs=get_setup_py_inputs, outputs=[project_root / 'setup.py']
+            ),
+            Stage(
+                'docs', update_docs, inputs=get_config_inputs,
+                outputs=[doc_root / name for name in ('conf.py', 'Makefile', 'index.rst', '_templates/autosummary/module.rst')]
+            ),
+        ], jobs=jobs, stamps=stamps, explain=explain)
+    finally:
+        # Stamps of the stages that succeeded are valid even if others failed
+        stamps.save()
+    
+def _get_cache_dir(project_root):
+    return project_root / '.cache/chicken_turtle_project'
+
+def _get_generator_digest():
+    '''
+    Get digest of the version of CTP that generates the project files
+    
+    Files generated by a different CTP version may differ, even if the project
+    didn't change.
+    '''
+    return digest(__version__, file_digest(Path(spec.__file__)) or '', file_digest(Path(__file__)) or '')
+
+def _get_requirements_inputs(project_root):
+    '''
+    Get digests of the *requirements.in files, the files they include and the
+    setup.py of their local editable requirements
+    
+    Returns
+    -------
+    {str : str}
+        Digest by file path relative to the project root (or absolute if
+        outside the project root)
+    '''
+    inputs = {}
+    manifest = get_dependency_manifest(project_root)
+    for path, digest_ in manifest.digests.items():
+        path = Path(path)
+        if project_root in path.parents:
+            path = path.relative_to(project_root)
+        inputs[str(path)] = digest_
+    for requirement in manifest.requirements:
+        editable_path = get_editable_path(project_root, requirement)
+        if editable_path:
+            inputs[str(editable_path / 'setup.py')] = file_digest(editable_path / 'setup.py')
+    return inputs
+
+def _ensure_project_exists(project_root, staging):
     project_path = project_root / 'project.py'
     if not project_path.exists():
         logger.info('project.py not found, will create from template')
@@ -211,12 +404,11 @@ def _ensure_project_exists(project_root):
         human_friendly_name = click.prompt('Please pick a human friendly name for your project')
         assert name and name.strip()
         assert human_friendly_name and human_friendly_name.strip()
-        with project_path.open('w') as f:
-            logger.info('Creating project.py')
-            f.write(spec.project_py.format(name=name, human_friendly_name=human_friendly_name, pkg_name=pkg_name))
-            git_('add', str(project_path))
+        logger.info('Creating project.py')
+        write_file_if_changed(project_path, spec.project_py.format(name=name, human_friendly_name=human_friendly_name, pkg_name=pkg_name))
+        staging.add(project_path)
         
-def _update_root_package(pkg_root, format_kwargs):
+def _update_root_package(pkg_root, format_kwargs, staging):
     '''
     Set __version__ in package root __init__.py
     '''
@@ -230,30 +422,28 @@ def _update_root_package(pkg_root, format_kwargs):
             break
     else:
         lines.append(version_line)
-    logger.info('Setting __version__ in {}'.format(pkg_root_init))
-    with pkg_root_init.open('w') as f:
-        f.write('\n'.join(lines))
-    git_('add', pkg_root_init)
+    if write_file_if_changed(pkg_root_init, '\n'.join(lines)):
+        logger.info('Setting __version__ in {}'.format(pkg_root_init))
+        staging.add(pkg_root_init)
     
 def _ensure_dir_exists(path):
     if not path.exists():
         path.mkdir()
         
-def _ensure_exists(path, content='', format_kwargs={}, raw=False, git_add=True):
+def _ensure_exists(path, content='', format_kwargs={}, raw=False, staging=None):
     '''
     Ensure file exists
     '''
     os.makedirs(str(path.parent), exist_ok=True)
     if not path.exists():
         logger.info('Creating {}'.format(path))
-        with path.open('w') as f:
-            if not raw:
-                content = content.format(**format_kwargs)
-            f.write(content)
-        if git_add:
-            git_('add', str(path))
+        if not raw:
+            content = content.format(**format_kwargs)
+        write_file_if_changed(path, content)
+        if staging:
+            staging.add(path)
         
-def _ensure_contains_snippets(path, snippets, format_kwargs, git_add=True):
+def _ensure_contains_snippets(path, snippets, format_kwargs, staging=None):
     '''
     Ensure snippets are present in file
     '''
@@ -263,12 +453,11 @@ def _ensure_contains_snippets(path, snippets, format_kwargs, git_add=True):
     missing_snippets = [snippet for snippet in snippets if snippet not in content]
     if missing_snippets:
         logger.info('Inserting missing snippets into {}'.format(path))
-        with path.open('w') as f:
-            f.write('\n'.join(missing_snippets + [content]))
-        if git_add:
-            git_('add', path)
+        write_file_if_changed(path, '\n'.join(missing_snippets + [content]))
+        if staging:
+            staging.add(path)
         
-def _update_ini_file(path, defaults, overwrite, format_kwargs, git_add=True):
+def _update_ini_file(path, defaults, overwrite, format_kwargs, staging=None):
     '''
     Ensure defaults are applied to missing options and some options are 
     overwritten to a fixed value
@@ -301,79 +490,493 @@ def _update_ini_file(path, defaults, overwrite, format_kwargs, git_add=True):
     # Write updated
     if changed:
         logger.info('Writing {}'.format(path))
-        with path.open('w') as f:
-            config.write(f)
-        if git_add:
-            git_('add', path)
+        content = StringIO()
+        config.write(content)
+        write_file_if_changed(path, content.getvalue())
+        if staging:
+            staging.add(path)
         
 def _raise_if_missing_file(project):
-    for file in ('LICENSE.txt', project['readme_file']):
+    for file in ('LICENSE.txt', project.readme_file):
         if not glob(file):
             raise UserException("Missing file: {}".format(file))
 
-def _update_requirements_txt(project_root):
-    logger.info('Writing requirements.txt')
+def _update_requirements_txt(project_root, staging, incremental=True):
+    '''
+    Compile *requirements.in files into requirements.txt
     
-    input_file_paths = get_dependency_file_paths(project_root)
-    regular_dependencies_fd, regular_dependencies_path = mkstemp()
-    try:
-        regular_dependencies_path = Path(regular_dependencies_path)
+    Resolved requirements are cached by `_get_requirements_txt_key`, when the
+    key matches, the cached requirements.txt is reused without running
+    pip-compile. A full resolve ignores the cache.
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    staging : chicken_turtle_project.common.GitStaging
+    incremental : bool
+        If True, keep the pins of unchanged requirements and only resolve the
+        added or changed requirements, see `_compile_requirements_incrementally`.
+        Else, resolve all requirements.
+    '''
+    # Filter out sip dependencies
+    options = []
+    lines = []
+    for file in get_dependency_manifest(project_root).files:
+        options.extend(option for option in file.options if option not in options)
+        for requirement in file.requirements:
+            if not is_sip_dependency(requirement.dependency):
+                lines.append(requirement.line)
+            elif not requirement.version_spec or not requirement.version_spec.startswith('=='):
+                raise UserException("{!r} must be pinned (i.e. must have a '==version' suffix) as it's a sip dependency".format(requirement.dependency))
+    lines = options + lines
+    
+    # Get requirements.txt from cache or compile it
+    requirements_txt_path = project_root / 'requirements.txt'
+    cache = Cache('requirements_txt')
+    key = _get_requirements_txt_key(project_root, lines)
+    requirements_txt = cache.get(key) if incremental else None
+    if requirements_txt is None:
+        logger.info('Compiling requirements.txt')
+        state_cache = Cache('requirements_txt_state')
+        inputs = _RequirementsInputs(project_root, lines)
+        requirements_txt = None
+        if incremental and requirements_txt_path.exists():
+            with requirements_txt_path.open('r') as f:
+                old_requirements_txt = f.read()
+            state = state_cache.get_json(digest(old_requirements_txt))
+            if state:
+                requirements_txt, parents = _compile_requirements_incrementally(inputs, old_requirements_txt, state, requirements_txt_path)
+        if requirements_txt is None:
+            logger.debug('Resolving all requirements')
+            requirements_txt, parents = _compile_requirements(lines, requirements_txt_path)
+        state_cache.set_json(digest(requirements_txt), dict(
+            inputs=inputs.lines,
+            options=inputs.options,
+            editables=inputs.editables,
+            parents=parents,
+        ))
+        cache.set(key, requirements_txt)
+    else:
+        logger.debug('Reusing cached requirements.txt')
+    if write_file_if_changed(requirements_txt_path, requirements_txt):
+        logger.info('Writing requirements.txt')
+        staging.add(requirements_txt_path)
+    
+class _RequirementsInputs(object):
+    
+    '''
+    Filtered requirement lines to compile into requirements.txt
+    
+    Attributes
+    ----------
+    lines : {str : str}
+        Requirement lines by normalised dependency name. Editable requirements
+        are keyed by their path instead.
+    options : [str]
+        Option lines, e.g. ``--index-url url``.
+    editables : {str : [str]}
+        (name, setup.py digest) of each local editable requirement by its
+        absolute path.
+    '''
+    
+    def __init__(self, project_root, lines):
+        self.lines = {}
+        self.options = []
+        self.editables = {}
+        for line in lines:
+            requirement = parse_requirement_line(line)
+            if not requirement:
+                self.options.append(line)
+                continue
+            path = get_editable_path(project_root, requirement)
+            if path:
+                self.lines['-e ' + str(path)] = line
+                self.editables[str(path)] = [requirement.name, file_digest(path / 'setup.py')]
+            else:
+                self.lines[requirement.name] = line
+    
+def _compile_requirements_incrementally(inputs, old_requirements_txt, state, requirements_txt_path):
+    '''
+    Update requirements.txt, only resolving added or changed requirements
+    
+    Pins only needed by removed or changed requirements are dropped, all other
+    pins are kept without consulting pip-compile. pip-compile is only run on the
+    added and changed requirements, seeded with the current pins.
+    
+    Parameters
+    ----------
+    inputs : _RequirementsInputs
+    old_requirements_txt : str
+        Current requirements.txt content
+    state : dict
+        State recorded when compiling old_requirements_txt
+    requirements_txt_path : pathlib.Path
+    
+    Returns
+    -------
+    (requirements_txt :: str, parents :: {str : [str]}) or (None, None)
+        New requirements.txt content and the parents of each of its pins.
+        (None, None) if an incremental update is not possible, e.g. when a
+        local editable requirement changed or pip-compile's annotations could
+        not be parsed.
+    '''
+    if inputs.editables != state['editables'] or inputs.options != state.get('options', []):
+        return None, None
+    if state['parents'] is None:
+        return None, None  # annotations of old_requirements_txt could not be parsed
+    old_inputs = state['inputs']
+    changed = {key for key, line in inputs.lines.items() if old_inputs.get(key) != line}
+    removed = old_inputs.keys() - inputs.lines.keys()
+    if not changed and not removed:
+        return None, None  # Python or pip-compile version changed, resolve all
+    if any(key.startswith('-e ') for key in changed | removed):
+        # Note: editable lines (e.g. their extras) are copied from the old
+        # requirements.txt, they are only updated by a full resolve
+        return None, None
+    logger.debug('Incremental requirements.txt update: added or changed: {}; removed: {}'.format(', '.join(sorted(changed)), ', '.join(sorted(removed))))
+    
+    # Keep pins still needed by unchanged requirements
+    head_lines, pins, unsafe = _parse_requirements_txt(old_requirements_txt)
+    children = defaultdict(set)
+    for child, parents in state['parents'].items():
+        for parent in parents:
+            children[parent].add(child)
+    roots = [key for key in inputs.lines.keys() - changed if not key.startswith('-e ')]
+    roots.extend(name for name, _ in inputs.editables.values())
+    kept = set()
+    while roots:
+        name = roots.pop()
+        if name not in kept:
+            kept.add(name)
+            roots.extend(children[name])
+    pins = {name: line for name, line in pins.items() if name in kept}
+    parents = {name: parents for name, parents in state['parents'].items() if name in kept}
+    unsafe = {name: line for name, line in unsafe.items() if name in kept}
+    
+    # Resolve added and changed requirements
+    if changed:
+        new_requirements_txt, new_parents = _compile_requirements(
+            [inputs.lines[key] for key in sorted(changed)],
+            requirements_txt_path, output_content=old_requirements_txt
+        )
+        if new_parents is None:
+            return None, None
+        _, new_pins, new_unsafe = _parse_requirements_txt(new_requirements_txt)
+        for name, line in itertools.chain(new_pins.items(), new_unsafe.items()):
+            if pins.get(name, line) != line or unsafe.get(name, line) != line:
+                logger.debug('Incremental requirements.txt update conflicts on {}, resolving all'.format(name))
+                return None, None
+        pins.update(new_pins)
+        unsafe.update(new_unsafe)
+        for name, new_parents_ in new_parents.items():
+            parents[name] = sorted(set(parents.get(name, [])) | set(new_parents_))
+            
+    return _format_requirements_txt(head_lines, pins, unsafe), parents
+    
+def _compile_requirements(lines, output_path, output_content=None):
+    '''
+    Compile requirement lines with pip-compile
+    
+    Existing pins in output_path are kept, as pip-compile prefers them.
+    
+    Parameters
+    ----------
+    lines : iterable of str
+        Requirement lines
+    output_path : pathlib.Path
+        Path to current requirements.txt, if any. It is not modified.
+    output_content : str or None
+        If not None, use this as content of the current requirements.txt
+        instead.
+    
+    Returns
+    -------
+    (requirements_txt :: str, parents :: {str : [str]} or None)
+        requirements.txt content and the parents of each pin, i.e. the
+        requirements which required the pin. Parents are None if the
+        annotations could not be parsed.
+    '''
+    with TemporaryDirectory() as temp_dir:
+        temp_dir = Path(temp_dir)
+        input_path = temp_dir / 'requirements.in'
+        with input_path.open('w') as f:
+            for line in lines:
+                f.write(line + '\n')
+        
+        # Start from current pins
+        temp_output_path = temp_dir / 'requirements.txt'
+        if output_content is None and output_path.exists():
+            with output_path.open('r') as f:
+                output_content = f.read()
+        if output_content is not None:
+            with temp_output_path.open('w') as f:
+                f.write(output_content)
         
-        # Filter out sip dependencies
-        with os.fdopen(regular_dependencies_fd, 'w') as f:
-            for input_path in input_file_paths:
-                for _, dependency, version_spec, line in parse_requirements_file(input_path):
-                    if not dependency:
-                        continue
-                    if not is_sip_dependency(dependency):
-                        f.write(line + '\n')
-                    elif not version_spec or not version_spec.startswith('=='):
-                        raise UserException("{!r} must be pinned (i.e. must have a '==version' suffix) as it's a sip dependency".format(dependency))
-
-        # Compile requirements
         # Note: pip-compile outputs a sorted list (though by a special key, e.g. currently -e first)
-        pb.local['pip-compile'](str(regular_dependencies_path), '--no-header', '--no-annotate', '-o', 'requirements.txt')  # Note: this eats up most of the time
-    finally:
-        regular_dependencies_path.unlink()
+        pb.local['pip-compile'](str(input_path), '--no-header', '-o', str(temp_output_path))  # Note: this eats up most of the time
+        with temp_output_path.open('r') as f:
+            annotated = f.read()
+    
+    # Strip annotations (pip-compile --no-annotate), but remember them
+    head_lines, pins, unsafe = _parse_requirements_txt(annotated)
+    annotations = _parse_requirements_txt_annotations(annotated)
+    if annotations is None:
+        logger.debug('Could not parse pip-compile annotations, next update resolves all requirements')
+        parents = None
+    else:
+        parents = {name: sorted(parents_) for name, parents_ in annotations.items() if name in pins or name in unsafe}
+    return _format_requirements_txt(head_lines, pins, unsafe), parents
+
+_requirements_txt_unsafe_header = [
+    '# The following packages are commented out because they are',
+    '# considered to be unsafe in a requirements file:',
+]
+
+def _parse_requirements_txt(content):
+    '''
+    Parse requirements.txt generated by pip-compile
+    
+    Returns
+    -------
+    (head_lines :: [str], pins :: {str : str}, unsafe :: {str : str})
+        Option lines (e.g. ``--index-url``) followed by editable requirement
+        lines; other pinned requirement lines by normalised name; and the
+        commented out unsafe requirement lines by normalised name. Lines are
+        stripped of annotations.
+    '''
+    options = []
+    editable_lines = []
+    pins = {}
+    unsafe = {}
+    in_unsafe = False
+    for line in content.splitlines():
+        if not line.strip() or line[0].isspace():
+            continue
+        line = re.split(r'\s+#', line, maxsplit=1)[0].rstrip()
+        if line.startswith('#'):
+            if 'considered to be unsafe' in line:
+                in_unsafe = True
+            elif in_unsafe and re.fullmatch(r'#\s*[\w.-]+(==.*)?', line):
+                unsafe[get_dependency_name(False, re.split('[#=\\s]+', line)[1])] = line
+            continue
+        if line.startswith('--'):
+            options.append(line)
+            continue
+        requirement = parse_requirement_line(line)
+        if requirement.editable:
+            editable_lines.append(line)
+        else:
+            pins[requirement.name] = line
+    if options:
+        options.append('')
+    return options + editable_lines, pins, unsafe
+
+def _parse_requirements_txt_annotations(content):
+    '''
+    Parse "via" annotations of requirements.txt generated by pip-compile
+    
+    Supports both the inline (``six==1.10.0  # via pytest``) and the multiline
+    annotation format of pip-compile. The annotation format is not a stable
+    interface of pip-tools, so any line not of a known form fails the parse.
     
-    # Stage it
-    git_('add', 'requirements.txt')
+    Returns
+    -------
+    {str : {str}} or None
+        Normalised names of the parents of each pin by normalised name.
+        Editable pins are omitted. None if a line could not be parsed.
+    '''
+    parents = defaultdict(set)
+    name = None
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        if line[0].isspace():
+            annotation = line.strip()
+            if not annotation.startswith('#'):
+                return None  # e.g. --hash continuation lines
+        else:
+            line, annotation = re.fullmatch(r'(.*?)(?:\s+#(.*))?', line).groups()
+            annotation = annotation or ''
+            if line.startswith('#'):
+                match = re.fullmatch(r'#\s*([\w.-]+)(==\S*)?', line)  # unsafe pin or comment
+                if match is None and line not in _requirements_txt_unsafe_header:
+                    return None
+            elif line.startswith('-'):  # editable pin or option
+                match = None
+            else:
+                match = re.fullmatch(r'([\w.-]+)(\[[\w.,-]*\])?==[^\s;]+(\s*;.*)?', line)
+                if match is None:
+                    return None
+            name = get_dependency_name(False, match.group(1)) if match else None
+        if name:
+            for token in re.split(r'[\s,#]+', annotation):
+                if token != 'via' and re.fullmatch(r'[A-Za-z0-9][\w.-]*', token) and not token.endswith(('.in', '.txt')):
+                    parents[name].add(get_dependency_name(False, token))
+    return parents
 
-def _update_setup_py(project, project_root, pkg_root, format_kwargs):
+def _format_requirements_txt(head_lines, pins, unsafe):
+    '''
+    Format requirements.txt like pip-compile --no-header --no-annotate
+    '''
+    lines = head_lines + sorted(pins.values(), key=str.lower)
+    if unsafe:
+        lines.append('')
+        lines.extend(_requirements_txt_unsafe_header)
+        lines.extend(sorted(unsafe.values(), key=str.lower))
+    return ''.join(line + '\n' for line in lines)
+    
+def _get_requirements_txt_key(project_root, lines):
+    '''
+    Get key of the requirements.txt compiled from given requirement lines
+    
+    The key is a digest of everything that affects the output of pip-compile:
+    the requirement lines (with the setup.py of each local editable
+    requirement), the Python version and the pip-compile version.
+    '''
+    parts = [
+        platform.python_version(), sys.platform,
+        _get_pip_compile_version(),
+    ]
+    for line in lines:
+        parts.append(line)
+        
+        # Local editable requirements are compiled to absolute file:// urls
+        # and their dependencies are listed in their setup.py
+        requirement = parse_requirement_line(line)
+        path = requirement and get_editable_path(project_root, requirement)
+        if path:
+            parts.append(str(path))
+            parts.append(file_digest(path / 'setup.py') or '')
+    return digest(*parts)
+    
+def _get_pip_compile_version():
+    '''
+    Get version of the pip-compile on PATH and of the interpreter it runs on
+    
+    The output of ``pip-compile --version`` is cached by the path and stat of
+    the pip-compile script and of its interpreter, so that it is only run
+    after pip-tools or Python is installed or upgraded.
+    
+    Returns
+    -------
+    str
+        Empty if pip-compile is not on PATH.
+    '''
+    try:
+        path = os.path.realpath(str(pb.local.which('pip-compile')))
+    except pb.CommandNotFound:
+        return ''
+    paths = [path]
+    with open(path, 'rb') as f:
+        shebang = f.readline()
+    if shebang.startswith(b'#!'):
+        interpreter = shebang[2:].decode(errors='replace').split()
+        if interpreter and os.path.isabs(interpreter[0]) and os.path.exists(interpreter[0]):
+            paths.append(os.path.realpath(interpreter[0]))
+    parts = []
+    for path_ in paths:
+        stat_ = os.stat(path_)
+        parts.extend((path_, str(stat_.st_mtime_ns), str(stat_.st_size)))
+    key = digest(*parts)
+    cache = Cache('pip_compile_version')
+    version = cache.get(key)
+    if version is None:
+        version = pb.local[path]('--version').strip()
+        cache.set(key, version)
+    return version
+    
+def _get_long_description(project_root, readme_file):
+    '''
+    Get content of readme file as reStructuredText
+    
+    reStructuredText is passed through unchanged. Markdown is converted in
+    process with m2r, other formats are converted with pandoc (as is Markdown
+    if m2r fails to import). Conversions are cached by readme content.
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    readme_file : str
+        Path to readme file relative to project_root
+        
+    Returns
+    -------
+    str
+    '''
+    path = project_root / readme_file
+    with path.open('r') as f:
+        content = f.read()
+    if path.suffix == '.rst':
+        return content
+    
+    cache = Cache('long_description')
+    key = digest(path.suffix, content)
+    long_description = cache.get(key)
+    if long_description is None:
+        long_description = _convert_to_rst(path, content)
+        cache.set(key, long_description)
+    return long_description
+    
+def _convert_to_rst(path, content):
+    if path.suffix in ('.md', '.markdown'):
+        try:
+            import m2r
+        except ImportError as ex:
+            logger.debug('Failed to import m2r, falling back to pandoc: {}'.format(ex))
+        else:
+            logger.debug('Converting {} to reStructuredText with m2r'.format(path))
+            return m2r.convert(content)
+    logger.debug('Converting {} to reStructuredText with pandoc'.format(path))
+    import pypandoc
+    return pypandoc.convert(str(path), 'rst')
+
+def _update_setup_py(project, version, project_root, staging, dependencies, long_description, packages, package_data):
+    '''
+    Write setup.py
+    
+    Parameters
+    ----------
+    project : chicken_turtle_project.common.Project
+    version : str
+    project_root : pathlib.Path
+    staging : chicken_turtle_project.common.GitStaging
+    dependencies : dict
+        Return of `_get_dependencies`.
+    long_description : str
+    packages : [str]
+    package_data : {str : [str]}
+        Return of `get_package_data`.
+    '''
     logger.debug('Preparing to write setup.py')
-    project.update(_get_dependencies(project_root))
-    project['long_description'] = pypandoc.convert(project['readme_file'], 'rst')
-    project['classifiers'] = [line.strip() for line in project['classifiers'].splitlines() if line.strip()] 
-    project['packages'] = find_packages()
-    project['package_data'] = _get_package_data(project_root, project['packages'])
+    setup_args = project.to_dict()
+    setup_args.update(dependencies)
+    setup_args['version'] = version
+    setup_args['long_description'] = long_description
+    setup_args['classifiers'] = [line.strip() for line in project.classifiers.splitlines() if line.strip()] 
+    setup_args['packages'] = list(packages)
+    setup_args['package_data'] = package_data
     
     # Write setup.py
-    del project['readme_file']
-    if 'index_test' in project:
-        del project['index_test']
-    del project['index_production']
-    del project['human_friendly_name']
-    del project['pre_commit_no_ignore']
-    del project['package_name']
-    del project['python_version']
-    logger.info('Writing setup.py')
+    for attr in ('readme_file', 'index_test', 'index_production', 'human_friendly_name', 'pre_commit_no_ignore', 'package_name', 'python_version'):
+        setup_args.pop(attr, None)
     setup_py_path = project_root / 'setup.py'
-    with setup_py_path.open('w') as f:
-        # Note: deep sort setup() args such that the same setup.py is generated
-        # for equivalent setup() calls. This avoids unnecessary merge conflicts.
-        # pformat already prints dicts items ordered by their key, need only
-        # sort lists
-        for attr in ('classifiers', 'packages', 'install_requires'):
-            if attr in project:
-                project[attr].sort()
-        for attr in ('entry_points', 'extras_require', 'package_data'):
-            if attr in project:
-                dict_ = project[attr]
-                for key in dict_:
-                    dict_[key].sort()
-        
-        f.write(setup_py_template.format(pprint.pformat(project, indent=4, width=120)))
-    git_('add', setup_py_path)
+    
+    # Note: deep sort setup() args such that the same setup.py is generated
+    # for equivalent setup() calls. This avoids unnecessary merge conflicts.
+    # pformat already prints dicts items ordered by their key, need only
+    # sort lists
+    for attr in ('classifiers', 'packages', 'install_requires'):
+        if attr in setup_args:
+            setup_args[attr].sort()
+    for attr in ('entry_points', 'extras_require', 'package_data'):
+        if attr in setup_args:
+            dict_ = setup_args[attr]
+            for key in dict_:
+                dict_[key].sort()
+    
+    if write_file_if_changed(setup_py_path, setup_py_template.format(pprint.pformat(setup_args, indent=4, width=120))):
+        logger.info('Writing setup.py')
+        staging.add(setup_py_path)
   
 def _get_dependencies(project_root):
     '''
@@ -381,17 +984,10 @@ def _get_dependencies(project_root):
     -------
     {'install_requires': ..., 'extras_require': ...}
     '''
-    paths = get_dependency_file_paths(project_root)
     extra_requires = {}
-    for path in paths: 
-        dependencies = []
-        for editable, dependency_url, version_spec, _ in parse_requirements_file(path):
-            if not dependency_url:
-                continue
-            name = get_dependency_name(editable, dependency_url)
-            if is_sip_dependency(name):
-                continue
-            dependencies.append(name + (version_spec or ''))
+    for file in get_dependency_manifest(project_root).files:
+        path = file.path
+        dependencies = [requirement.specifier for requirement in file.requirements if not is_sip_dependency(requirement.name)]
         if path.name == 'requirements.in':
             install_requires = dependencies
         else:
@@ -399,17 +995,127 @@ def _get_dependencies(project_root):
             extra_requires[name] = dependencies
     return dict(install_requires=install_requires, extras_require=extra_requires)
     
-def _get_package_data(project_root, packages):
-    package_data = defaultdict(list) 
-    for package in packages:
-        package_dir = project_root / package.replace('.', '/')
-        data_dir = package_dir / 'data'
-        if data_dir.exists() and not (data_dir / '__init__.py').exists():
-            # Found a data dir
-            for parent, _, files in os.walk(str(data_dir)):
-                package_data[package].extend(str((data_dir / parent / file).relative_to(package_dir)) for file in files)
-    return {k: sorted(v) for k,v in package_data.items()}  # sort to avoid unnecessary git diffs
-        
+def _find_packages(project_root, cache_path=None):
+    '''
+    Find the packages of the project
+    
+    A package is a directory with an __init__.py which git lists as tracked
+    (``git ls-files --cached``) or as untracked and not ignored (``git
+    ls-files --others --exclude-standard``). A tracked package is included
+    even when its directory is ignored. Like `setuptools.find_packages`, a
+    package's ancestors must be packages as well. Outside a git repository,
+    falls back to `setuptools.find_packages`.
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    cache_path : pathlib.Path or None
+        JSON file in which to cache the packages. The cached packages are
+        reused, without running git, while the git index, the ignore and git
+        config files, the package directories and their subdirectories are
+        unchanged (by stat).
+    
+    Returns
+    -------
+    [str]
+        Sorted package names
+    '''
+    git_dir = get_git_dir(project_root)
+    if git_dir is None:
+        logger.debug('Not in a git repository, falling back to setuptools.find_packages')
+        from setuptools import find_packages  # Note: slow import, only import when needed
+        return sorted(find_packages(str(project_root)))
+    
+    if cache_path:
+        try:
+            with cache_path.open('r') as f:
+                cache = json.load(f)
+            if cache['key'] == _get_packages_key(project_root, git_dir, cache['packages'], cache['excludes_file']):
+                return cache['packages']
+        except (FileNotFoundError, ValueError, KeyError, TypeError):
+            pass
+    
+    # Note: paths are relative to the project root, as git runs in it
+    git = pb.local['git']
+    with pb.local.cwd(str(project_root)):
+        output = git('ls-files', '-z', '--cached', '--others', '--exclude-standard', '--', '*__init__.py')
+        excludes_file = git('config', '--path', 'core.excludesFile', retcode=(0, 1)).strip() or None
+    candidates = set()
+    for path in output.split('\0'):
+        path = Path(path)
+        parts = path.parent.parts
+        if path.name != '__init__.py' or not parts or any('.' in part for part in parts):
+            continue
+        if (project_root / path).exists():  # Note: a tracked __init__.py may have been deleted
+            candidates.add(parts)
+    packages = sorted(
+        '.'.join(parts) for parts in candidates
+        if all(parts[:i] in candidates for i in range(1, len(parts)))
+    )
+    
+    if cache_path:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        key = _get_packages_key(project_root, git_dir, packages, excludes_file)
+        write_file_if_changed(cache_path, json.dumps(dict(key=key, packages=packages, excludes_file=excludes_file), sort_keys=True))
+    return packages
+
+def _get_packages_key(project_root, git_dir, packages, excludes_file):
+    '''
+    Get digest of the stats `_find_packages` depends on
+    
+    A package can only appear or disappear as a subdirectory of the project
+    root or of a package, by adding or removing it or the __init__.py in it.
+    The first changes the listing of the parent directory, the latter the
+    mtime of the subdirectory.
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    git_dir : pathlib.Path
+    packages : [str]
+    excludes_file : str or None
+        Configured ``core.excludesFile``.
+    '''
+    def get_stat(path):
+        try:
+            stat_ = os.stat(str(path))
+            return [stat_.st_mtime_ns, stat_.st_size]
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+    common_dir = git_dir
+    if (git_dir / 'commondir').exists():  # worktree
+        with (git_dir / 'commondir').open() as f:
+            common_dir = git_dir / f.read().strip()
+    home = Path(os.path.expanduser('~'))
+    config_home = Path(pb.local.env.get('XDG_CONFIG_HOME') or home / '.config')
+    files = [
+        Path(pb.local.env.get('GIT_INDEX_FILE') or git_dir / 'index'),
+        common_dir / 'info/exclude',
+        common_dir / 'config',
+        home / '.gitconfig',
+        config_home / 'git/config',
+        config_home / 'git/ignore',
+    ]
+    if excludes_file:
+        files.append(Path(excludes_file))
+    key = [[str(path), get_stat(path)] for path in files]
+    
+    # The .gitignore files of the project root, its ancestors in the repo and
+    # the packages; and the directories in which a package can appear
+    work_tree = git_dir.parent if git_dir.name == '.git' else project_root
+    for directory in project_root.parents:
+        if directory != work_tree and work_tree not in directory.parents:
+            break
+        key.append([str(directory), get_stat(directory / '.gitignore')])
+    for directory in [project_root] + [project_root.joinpath(*package.split('.')) for package in packages]:
+        key.append([str(directory), get_stat(directory / '.gitignore')])
+        try:
+            entries = sorted(os.scandir(str(directory)), key=lambda entry: entry.name)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        key.extend([entry.name, get_stat(entry.path)] for entry in entries if '.' not in entry.name and entry.is_dir())
+    return digest(json.dumps(key))
+    
 setup_py_template = spec.setup_py_header + '''\
 
 from setuptools import setup
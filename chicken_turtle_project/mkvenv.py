@@ -16,17 +16,20 @@
 # along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
 
 from chicken_turtle_project.common import (
-    graceful_main, get_dependency_file_paths, 
-    parse_requirements_file, is_sip_dependency, get_dependency_name,
-    sip_packages, remove_file, get_project, debug_option
+    graceful_main, is_sip_dependency, sip_packages, remove_file, get_project, debug_option,
+    normalise_name, write_file_if_changed, get_editable_path
 )
-from chicken_turtle_project import __version__
+from chicken_turtle_project.cache import file_digest
+from chicken_turtle_project.requirements import get_dependency_manifest, parse_requirements_file, parse_requirement_line
+from chicken_turtle_project import __version__, pipeline, wheelhouse, venv_store, sip_cache
 import click
 from pathlib import Path
 from collections import namedtuple
+from functools import partial
 import logging
 import plumbum as pb
-import pkg_resources
+import json
+import ast
 
 logger = logging.getLogger(__name__)
 
@@ -39,135 +42,410 @@ class SIPDependency(_SIPDependency):
         else:
             return self.name == str(other).lower()
     
-def get_venv(venv_dir):
-    return pkg_resources.WorkingSet([str(next(venv_dir.glob('lib/python*/site-packages')))])
+#: Changes to make to a venv, see `get_plan`
+Plan = namedtuple('Plan', 'install upgrade downgrade remove')
+
+#: Result of `probe`
+Probe = namedtuple('Probe', 'python_version installed importable site_packages environment')
+
+# Note: runs in the venv's Python, which may be as old as 3.4. Runs isolated
+# (-I), so neither the current directory nor PYTHONPATH end up on sys.path.
+_probe_script = '''\
+import json, os, platform, sys, sysconfig
+from importlib.util import find_spec
+try:
+    from importlib.metadata import distributions
+except ImportError:
+    import pkg_resources
+    installed = [(dist.project_name, dist.version) for dist in pkg_resources.working_set]
+else:
+    installed = [(dist.metadata['Name'], dist.version) for dist in distributions()]
+    installed = [(name, version) for name, version in reversed(installed) if name]  # Note: broken installs can lack metadata
+implementation_version = '{0.major}.{0.minor}.{0.micro}'.format(sys.implementation.version)
+if sys.implementation.version.releaselevel != 'final':
+    implementation_version += sys.implementation.version.releaselevel[0] + str(sys.implementation.version.serial)
+print(json.dumps({
+    'python_version': sys.version_info[:2],
+    'installed': installed,
+    'importable': {package: find_spec(package) is not None for package in sys.argv[1:]},
+    'site_packages': sysconfig.get_paths()['purelib'],
+    'environment': {  # Note: as packaging.markers.default_environment
+        'implementation_name': sys.implementation.name,
+        'implementation_version': implementation_version,
+        'os_name': os.name,
+        'platform_machine': platform.machine(),
+        'platform_release': platform.release(),
+        'platform_system': platform.system(),
+        'platform_version': platform.version(),
+        'python_full_version': platform.python_version(),
+        'platform_python_implementation': platform.python_implementation(),
+        'python_version': '.'.join(platform.python_version_tuple()[:2]),
+        'sys_platform': sys.platform,
+    },
+}))
+'''
+
+def probe(python):
+    '''
+    Get installed distributions and more from a venv, by running its Python once
+    
+    Parameters
+    ----------
+    python : plumbum command
+        Python of the venv.
+    
+    Returns
+    -------
+    Probe
+        ``python_version``, ``(int, int)``, is the major and minor version of
+        the Python. ``installed``, ``{str : str}``, maps the normalised name of
+        each installed distribution to its version. ``importable``,
+        ``{str : bool}``, tells whether each package of
+        `chicken_turtle_project.common.sip_packages` can be imported.
+        ``site_packages``, `pathlib.Path`, is the site-packages directory.
+        ``environment``, ``{str : str}``, is the environment to evaluate
+        environment markers in.
+    '''
+    packages = sorted(sip_packages.values())
+    result = json.loads(python('-I', '-c', _probe_script, *packages))
+    return Probe(
+        python_version=tuple(result['python_version']),
+        # Note: first on sys.path wins, the list is reversed in the probe
+        installed={normalise_name(name): version for name, version in result['installed']},
+        importable=result['importable'],
+        site_packages=Path(result['site_packages']),
+        environment=result['environment'],
+    )
+    
+def get_plan(installed, desired, keep=()):
+    '''
+    Get the changes needed to get from installed to desired distributions
+    
+    Parameters
+    ----------
+    installed : {str : str}
+        Installed version by normalised name.
+    desired : {str : str or None}
+        Desired version by normalised name. None if any version will do, e.g.
+        for an unpinned or editable requirement.
+    keep : iterable of str
+        Names of installed distributions not to remove, even if not desired.
+        
+    Returns
+    -------
+    Plan
+        Sorted names to install (not installed), upgrade, downgrade or remove.
+    '''
+    try:
+        from packaging.version import parse as parse_version
+    except ImportError:
+        from pkg_resources import parse_version  # Note: slow import, only import when needed
+    install = []
+    upgrade = []
+    downgrade = []
+    for name, version in sorted(desired.items()):
+        if name not in installed:
+            install.append(name)
+        elif version is not None and parse_version(version) != parse_version(installed[name]):
+            if parse_version(version) > parse_version(installed[name]):
+                upgrade.append(name)
+            else:
+                downgrade.append(name)
+    remove = sorted(installed.keys() - desired.keys() - set(keep))
+    return Plan(install, upgrade, downgrade, remove)
     
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.option(
+    '--verify',
+    is_flag=True,
+    default=False,
+    envvar='CT_VERIFY_VENV',
+    help='Check the installed packages even when the project files are unchanged since the last run.'
+)
 @debug_option()
 @click.version_option(version=__version__)
-def main(debug):
+def main(verify, debug):
     '''
     Create Python virtual environment in `./venv` and install project in it.
     
-    First calls `ct-mkproject` to ensure project files are up to date, unless
-    CT_NO_MKPROJECT is set. In the latter case requirements.txt,
+    First runs ct-mkproject's stage to ensure project files are up to date,
+    unless CT_NO_MKPROJECT is set. In the latter case requirements.txt,
     *requirements.in files and setup.py should already be present.
+    
+    When requirements.txt, the SIP dependencies, setup.py, project.py, the
+    venv's Python and CTP are unchanged since the last successful run, the
+    venv is assumed to be up to date and is not checked. Use --verify when
+    the venv may have been changed by other means, e.g. by running pip in
+    it.
+    
+    Note that ct-mkproject's stage still runs first, as whether the venv is
+    up to date depends on the files it generates. When those are up to date,
+    it only compares digests of its inputs and outputs to its stamps.
     '''
     with graceful_main(logger, app_name='mkvenv', debug=debug):
-        _main()
+        with pb.local.env(**({'CT_VERIFY_VENV': '1'} if verify else {})):
+            pipeline.reset()
+            pipeline.run('venv')
     
-def _main():
-    pb.local['ct-mkproject']()  # Ensure requirements.in files, ... are up to date
+def mkvenv(project_root, verify=False):
+    '''
+    Create or update venv of project, assuming its project files are up to date
     
-    project_root = Path.cwd()
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    verify : bool
+        See ``--verify``.
+    '''
     project = get_project(project_root)
-    venv_dir = Path(pb.local.env.get('CT_VENV_DIR', 'venv')).absolute()
+    venv_dir = pipeline.get_venv_dir(project_root)
+    requirements_txt = parse_requirements_file(Path('requirements.txt'))
     
     # Create venv if missing
     if not venv_dir.exists():
         # Find the desired Python
-        desired_python = 'python{}.{}'.format(*project['python_version'])
-        python = pb.local.get(desired_python, 'python{}'.format(project['python_version'][0]), 'python')
+        desired_python = 'python{}.{}'.format(*project.python_version)
+        python = pb.local.get(desired_python, 'python{}'.format(project.python_version[0]), 'python')
         if python.executable.name != desired_python:
             logger.warning('{} not found, falling back to {}'.format(desired_python, python.executable))
         
-        # Create venv    
-        logger.info('Creating venv')
-        python('-m', 'venv', str(venv_dir))
+        # Create venv, cloned from the venv store
+        venv_store.create_venv(python, requirements_txt, venv_dir, partial(_populate, requirements_txt))
         
+    # Get desired SIP dependencies
+    desired_sip_dependencies = {}  # {(name :: str) : (version :: str)}
+    for requirement in get_dependency_manifest(project_root).requirements:
+        if is_sip_dependency(requirement.name):
+            assert requirement.version_spec.startswith('==')
+            desired_sip_dependencies[requirement.name] = requirement.version_spec[2:]
+            
+    # Skip if nothing changed since the last successful run
+    stamp_path = venv_dir / 'ct_mkvenv_stamp.json'
+    stamp = _get_stamp(project_root, venv_dir, desired_sip_dependencies)
+    if not verify and _read_json(stamp_path) == stamp:
+        logger.info('Venv is up to date')
+        return
+    remove_file(stamp_path)  # the venv is about to change, invalidate the stamp until it's done
+    
     python = pb.local[str(venv_dir / 'bin/python')]
     pip = python[str(venv_dir / 'bin/pip')]  # Note: setuptools sometimes creates shebangs that are longer than the max allowed, so we call pip with python directly, avoiding the shebang
+    venv = probe(python)
         
-    # These are always (implicitly) desired
-    base_dependencies = {'pip' : '', 'setuptools' : '', 'wheel' : ''}
-    for editable, dependency, version_spec, _ in parse_requirements_file(Path('requirements.txt')):
-        if dependency in base_dependencies:
-            base_dependencies[dependency] = version_spec
-    
-    logger.info('Upgrading {}'.format(', '.join(sorted(base_dependencies))))
-    pip('install', '--upgrade', *(dependency + version_spec for dependency, version_spec in base_dependencies.items()))
-    
-    # Get desired dependencies from requirements.txt (note: requirements.txt contains no SIP deps)
-    desired_dependencies = set(base_dependencies.keys())
-    for editable, dependency, version_spec, _ in parse_requirements_file(Path('requirements.txt')):
-        if dependency:
-            desired_dependencies.add(get_dependency_name(editable, dependency))
-    
-    # Get installed dependencies
-    venv = get_venv(venv_dir)
-    installed_dependencies = {distribution.project_name.lower() for distribution in venv}
-            
-    # Remove installed packages not listed in requirements.txt
-    extra_dependencies = installed_dependencies - desired_dependencies
-    extra_dependencies.discard('chicken-turtle-project')  # never uninstall chicken-turtle-project
-    logger.debug('Installed packages: ' + ' '.join(installed_dependencies))
-    logger.debug('Desired packages: ' + ' '.join(desired_dependencies))
-    if extra_dependencies:
-        if extra_dependencies != {project['name']}:
-            logger.info('Removing packages not listed as dependencies: ' + ', '.join(extra_dependencies))
-        pip('uninstall', '-y', *extra_dependencies)
-    
-    # Install desired dependencies
-    logger.info('Installing requirements.txt')
-    pip('install', '-r', 'requirements.txt')
-    
-    # Get desired SIP dependencies
-    desired_sip_dependencies = {}  # {(name :: str) : (version :: str)}
-    input_file_paths = get_dependency_file_paths(project_root)
-    for input_path in input_file_paths:
-        for editable, dependency, version_spec, _ in parse_requirements_file(input_path):
-            if not dependency:
-                continue
-            name = get_dependency_name(editable, dependency)
-            if is_sip_dependency(name):
-                assert version_spec.startswith('==')
-                desired_sip_dependencies[name.lower()] = version_spec[2:]
+    # Install, upgrade, downgrade or remove what differs from requirements.txt
+    # (note: requirements.txt contains no SIP deps)
+    _sync(pip, project_root, requirements_txt.requirements, requirements_txt.options, venv, keep={
+        normalise_name(project.name),
+        'chicken-turtle-project',  # never uninstall chicken-turtle-project
+    } | desired_sip_dependencies.keys())
                 
     # Get installed SIP dependencies
-    installed_sip_dependencies = set()
-    for name, package in sip_packages.items():
-        if python['-c', 'import {}'.format(package)] & pb.TF:
-            installed_sip_dependencies.add(name)
+    installed_sip_dependencies = {name for name, package in sip_packages.items() if venv.importable[package]}
     
     # Install SIP dependencies
     missing_sip_dependencies = desired_sip_dependencies.keys() - installed_sip_dependencies
     if missing_sip_dependencies:
-        # Note: http://stackoverflow.com/a/1962076/1031434
         logger.info('Installing SIP dependencies')
-        wget = pb.local['wget']
-        tar = pb.local['tar']
-        sh = pb.local['sh']
-        for name in ['sip'] + list(missing_sip_dependencies - {'sip'}):
-            logger.info('- installing ' + name)
-            if name == 'sip':
-                url = 'https://sourceforge.net/projects/pyqt/files/sip/sip-{version}/sip-{version}.tar.gz'
-                unpack_path = 'sip-{version}'
-            elif name == 'pyqt5':
-                url = 'https://sourceforge.net/projects/pyqt/files/PyQt5/PyQt-{version}/PyQt-gpl-{version}.tar.gz'
-                unpack_path = 'PyQt-gpl-{version}'
-            else:
-                assert False
-            
-            version = desired_sip_dependencies[name]
-            unpack_path = Path(unpack_path.format(version=version))
-            tar_path = unpack_path.with_name(unpack_path.name + '.tar.gz')
+        for name in sorted(missing_sip_dependencies, key=lambda name: (name != 'sip', name)):  # sip first, PyQt5 builds against it
+            sip_cache.install(name, desired_sip_dependencies, venv_dir)
+        
+    # Install project package, unless an editable install of it with the
+    # same setup.py is present
+    _install_project(pip, venv_dir, project_root, project.name, venv.python_version)
+    
+    write_file_if_changed(stamp_path, json.dumps(stamp, sort_keys=True))
+    
+def _get_stamp(project_root, venv_dir, desired_sip_dependencies):
+    '''
+    Get stamp of the inputs of mkvenv
+    
+    Returns
+    -------
+    dict
+        JSON serialisable.
+    '''
+    return dict(
+        requirements_txt=file_digest(project_root / 'requirements.txt'),
+        sip_dependencies=desired_sip_dependencies,
+        setup_py=file_digest(project_root / 'setup.py'),
+        project_py=file_digest(project_root / 'project.py'),
+        pyvenv_cfg=file_digest(venv_dir / 'pyvenv.cfg'),  # interpreter path and version
+        venv_dir=str(venv_dir.absolute()),
+        ctp_version=__version__,
+    )
+    
+def _read_json(path):
+    '''
+    Read JSON file written by a previous run, None if missing or invalid
+    '''
+    try:
+        with path.open() as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    
+def _install_project(pip, venv_dir, project_root, name, python_version):
+    '''
+    Install project in venv in development mode, if not already
+    
+    The setup.py digest and setup() args of each install are recorded in the
+    venv. The install is skipped if there is an editable install of
+    project_root with the same setup.py. If only the entry points changed, the
+    project is reinstalled without its dependencies, which pip already
+    installed.
+    '''
+    record_path = venv_dir / 'ct_project_install.json'
+    record = _read_json(record_path)
+    setup_py_digest = file_digest(project_root / 'setup.py')
+    setup_args = _read_setup_args(project_root / 'setup.py')
+    site_packages = venv_dir / 'lib/python{}.{}/site-packages'.format(*python_version)
+    only_entry_points_changed = False
+    if record and record.get('project_root') == str(project_root) and _get_editable_layout(site_packages, name, project_root):
+        old_setup_args = record.get('setup_args')
+        if record.get('setup_py') == setup_py_digest and old_setup_args == setup_args:
+            logger.info('Project package is up to date')
+            return
+        only_entry_points_changed = (
+            setup_args is not None and old_setup_args is not None and
+            _without_entry_points(old_setup_args) == _without_entry_points(setup_args)
+        )
+    
+    remove_file(record_path)
+    if only_entry_points_changed:
+        logger.info('Reinstalling project package, its entry points changed')
+        pip('install', '-e', '.', '--no-deps')
+    else:
+        logger.info('Installing project package')
+        pip('install', '-e', '.')
+    record = {'project_root': str(project_root), 'setup_py': setup_py_digest, 'setup_args': setup_args}
+    write_file_if_changed(record_path, json.dumps(record, sort_keys=True))
+    
+def _read_setup_args(path):
+    '''
+    Get the args of the setup() call in a setup.py generated by ct-mkproject
+    
+    Returns
+    -------
+    dict or None
+        Args as they would be read back from JSON. None if setup.py is missing
+        or not of the generated form.
+    '''
+    try:
+        with path.open() as f:
+            tree = ast.parse(f.read())
+    except (FileNotFoundError, SyntaxError):
+        return None
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Call) and getattr(node.func, 'id', None) == 'setup':
+            kwargs = getattr(node, 'kwargs', None)  # Python < 3.5
+            if kwargs is None:
+                kwargs = next((keyword.value for keyword in node.keywords if keyword.arg is None), None)
+            if kwargs is None:
+                return None
             try:
-                wget(url.format(version=version)) #XXX use CTU http.download_file instead
-                tar('zxvf', str(tar_path))
-                with pb.local.cwd(str(unpack_path)):
-                    cmd = sh['-c', '. {} && python configure.py && make && make install'.format(str(venv_dir / 'bin/activate'))]
-                    if name == 'pyqt5':
-                        # say yes to license and ignore exit code as this script always fails (but still install correctly)
-                        (cmd << 'yes\n')(retcode=None)
-                    else:
-                        cmd & pb.FG
-            finally:
-                if unpack_path.exists():
-                    remove_file(unpack_path)
-                if tar_path.exists():
-                    remove_file(tar_path)
+                return json.loads(json.dumps(ast.literal_eval(kwargs)))
+            except ValueError:
+                return None
+    return None
+
+def _without_entry_points(setup_args):
+    setup_args = dict(setup_args)
+    setup_args.pop('entry_points', None)
+    return setup_args
+    
+def _get_editable_layout(site_packages, name, project_root):
+    '''
+    Get how project_root is installed in development mode, if at all
+    
+    Returns
+    -------
+    str or None
+        'egg-link' (setup.py develop), 'direct-url' (PEP 660) or None if there
+        is no editable install of project_root.
+    '''
+    name = normalise_name(name)
+    for path in site_packages.glob('*.egg-link'):
+        if normalise_name(path.stem) == name:
+            with path.open() as f:
+                if f.readline().strip() == str(project_root):
+                    return 'egg-link'
+    for path in site_packages.glob('*.dist-info/direct_url.json'):
+        if normalise_name(path.parent.name.split('-')[0]) == name:
+            direct_url = _read_json(path) or {}
+            if direct_url.get('url') == project_root.as_uri() and direct_url.get('dir_info', {}).get('editable'):
+                return 'direct-url'
+    return None
+
+def _populate(requirements_txt, venv_dir, requirements):
+    '''
+    Install requirements, a subset of requirements_txt, in a new venv
+    '''
+    python = pb.local[str(venv_dir / 'bin/python')]
+    venv = probe(python)
+    _sync(python[str(venv_dir / 'bin/pip')], requirements_txt.path.parent.absolute(), requirements, requirements_txt.options, venv, keep=())
+    
+def _sync(pip, project_root, requirements, options, venv, keep):
+    '''
+    Make installed distributions match requirements, running pip only for
+    the differences
+    
+    Parameters
+    ----------
+    pip : plumbum command
+        pip of the venv.
+    project_root : pathlib.Path
+        Absolute path of the project whose requirements.txt it is, relative
+        paths of editable requirements are relative to it.
+    requirements : [chicken_turtle_project.requirements.Requirement]
+        Requirements of requirements.txt.
+    options : [str]
+        Option lines of requirements.txt.
+    venv : Probe
+        `probe` of the venv.
+    keep : {str}
+        Names of distributions not to remove.
+    '''
+    # pip, setuptools and wheel are always (implicitly) desired. Requirements
+    # whose markers do not match the venv are not. Unpinned requirements are
+    # satisfied by any version, local editable requirements by an editable
+    # install of their directory.
+    requirements_by_name = {name: parse_requirement_line(name) for name in ('pip', 'setuptools', 'wheel')}
+    requirements_by_name.update((requirement.name, requirement) for requirement in requirements if _markers_match(requirement, venv.environment))
+    desired = {name: requirement.pinned_version for name, requirement in requirements_by_name.items()}
+    installed = dict(venv.installed)
+    for name, requirement in requirements_by_name.items():
+        editable_path = get_editable_path(project_root, requirement)
+        if editable_path and name in installed and not _get_editable_layout(venv.site_packages, name, editable_path):
+            del installed[name]  # (re)install the editable one
+        
+    plan = get_plan(installed, desired, keep)
+    logger.debug('Venv plan: {}'.format(plan))
+    
+    if plan.remove:
+        logger.info('Removing packages not listed as dependencies: ' + ', '.join(plan.remove))
+        pip('uninstall', '-y', *plan.remove)
+    
+    changed = plan.install + plan.upgrade + plan.downgrade
+    if changed:
+        for action, names in zip(('Installing', 'Upgrading', 'Downgrading'), plan[:3]):
+            if names:
+                logger.info('{} {}'.format(action, ', '.join(names)))
+        requirements = [requirements_by_name[name] for name in changed]
+        wheelhouse.install(pip, requirements, options, venv.python_version)
+    else:
+        logger.info('Venv matches requirements.txt')
+    
         
-    # Install project package
-    logger.info('Installing project package')
-    pip('install', '-e', '.')
+def _markers_match(requirement, environment):
+    '''
+    Get whether the environment markers of requirement, if any, match environment
     
+    Parameters
+    ----------
+    requirement : chicken_turtle_project.requirements.Requirement
+    environment : {str : str}
+        See `Probe`.
+    '''
+    if not requirement.markers:
+        return True
+    from packaging.markers import Marker
+    return Marker(requirement.markers).evaluate(environment)
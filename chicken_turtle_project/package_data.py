@@ -0,0 +1,215 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Find the package data of a project
+
+Package data is listed as one glob per directory (e.g. ``data/subdir/*``)
+where possible, keeping the generated setup.py small for large data
+directories.
+'''
+
+from chicken_turtle_project.common import write_file_if_changed
+from chicken_turtle_project.cache import digest
+from collections import defaultdict
+import json
+import os
+import re
+
+def get_package_data(project_root, packages, cache_path=None):
+    '''
+    Get package_data of project
+    
+    Each package's ``data`` directory, unless it is a package itself, is
+    package data. Files and directories ignored by a .gitignore are not
+    included (a subset of the gitignore syntax is supported: ``**``, ``!``,
+    trailing and leading ``/``).
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    packages : iterable of str
+        Package names.
+    cache_path : pathlib.Path or None
+        JSON file in which to cache the listing of each data directory. Listings
+        of directories whose mtime and applicable ignore patterns are
+        unchanged are reused.
+    
+    Returns
+    -------
+    {str : [str]}
+        Sorted file paths and globs relative to the package directory, by
+        package name. A directory of which all files are included, is listed
+        as ``directory/*`` (and its dot files, which ``*`` does not match).
+    '''
+    cache = _load_cache(cache_path)
+    new_cache = {}
+    package_data = defaultdict(list)
+    for package in sorted(packages):
+        package_dir = package.replace('.', '/')
+        data_dir = package_dir + '/data'
+        if not os.path.isdir(str(project_root / data_dir)) or os.path.exists(str(project_root / data_dir / '__init__.py')):
+            continue
+        patterns = []
+        parts = data_dir.split('/')
+        for i in range(len(parts)):
+            patterns.extend(_read_gitignore(project_root, '/'.join(parts[:i])))
+        for directory, files, complete in _walk(project_root, data_dir, patterns, cache, new_cache):
+            directory = os.path.relpath(directory, package_dir)
+            if complete:
+                package_data[package].append(directory + '/*')
+                files = [name for name in files if name.startswith('.')]
+            package_data[package].extend(directory + '/' + name for name in files)
+    if cache_path and new_cache != cache:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        write_file_if_changed(cache_path, json.dumps(new_cache, sort_keys=True))
+    return {package: sorted(data) for package, data in package_data.items()}  # sort to avoid unnecessary git diffs
+
+def _load_cache(cache_path):
+    if cache_path:
+        try:
+            with cache_path.open('r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+    return {}
+
+def _walk(project_root, directory, patterns, cache, new_cache):
+    '''
+    Walk directory tree, skipping ignored files and directories
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    directory : str
+        Directory to walk, relative to project_root.
+    patterns : [_Pattern]
+        Ignore patterns that apply to directory.
+    cache : dict
+        Listings of last run by directory.
+    new_cache : dict
+        Listings of this run are added to this.
+        
+    Yields
+    ------
+    (directory :: str, files :: [str], complete :: bool)
+        Included files of each directory, and whether all of its files are
+        included. Directories without included files are omitted.
+    '''
+    path = str(project_root / directory)
+    patterns = patterns + _read_gitignore(project_root, directory)
+    key = [os.stat(path).st_mtime_ns, digest(*(pattern.source for pattern in patterns))]
+    listing = cache.get(directory)
+    if not listing or listing[0] != key:
+        files = []
+        directories = []
+        complete = True
+        for entry in os.scandir(path):
+            is_dir = entry.is_dir()
+            if _is_ignored(directory + '/' + entry.name, is_dir, patterns):
+                if not is_dir:
+                    complete = False
+            elif is_dir:
+                directories.append(entry.name)
+            else:
+                files.append(entry.name)
+        listing = [key, sorted(files), sorted(directories), complete]
+    new_cache[directory] = listing
+    _, files, directories, complete = listing
+    if files:
+        yield directory, files, complete
+    for name in directories:
+        yield from _walk(project_root, directory + '/' + name, patterns, cache, new_cache)
+
+class _Pattern(object):
+    
+    '''
+    Pattern of a .gitignore file
+    '''
+    
+    def __init__(self, base, line):
+        self.source = base + '\0' + line
+        self.negated = line.startswith('!')
+        if self.negated:
+            line = line[1:]
+        self.directory_only = line.endswith('/')
+        line = line.rstrip('/')
+        
+        # Patterns without slash match the name at any depth, others are
+        # relative to the directory of the .gitignore
+        if '/' not in line:
+            line = '**/' + line
+        line = line.lstrip('/')
+        if base:
+            line = base + '/' + line
+        self._regex = re.compile(_translate(line))
+    
+    def matches(self, path, is_dir):
+        return (is_dir or not self.directory_only) and bool(self._regex.match(path))
+        
+def _translate(pattern):
+    '''
+    Translate gitignore glob to regex
+    '''
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape('[')
+                i += 1
+            else:
+                regex += '[' + pattern[i+1:end].replace('\\', '\\\\') + ']'
+                i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex + r'\Z'
+
+def _read_gitignore(project_root, directory):
+    '''
+    Get patterns of the .gitignore in directory, if any
+    '''
+    try:
+        with (project_root / directory / '.gitignore').open('r') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return []
+    lines = (line.rstrip() for line in lines)
+    return [_Pattern(directory, line) for line in lines if line and not line.startswith('#')]
+
+def _is_ignored(path, is_dir, patterns):
+    '''
+    Get whether path is ignored; the last matching pattern decides
+    '''
+    for pattern in reversed(patterns):
+        if pattern.matches(path, is_dir):
+            return not pattern.negated
+    return False
@@ -0,0 +1,127 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+In-process pipeline of the ct-* commands
+
+The commands form a stage graph: project -> venv -> docs, venv -> tests. The
+ct-* commands and ``ct`` run a stage by running its prerequisites first, all
+as function calls in the same process. A stage which already ran in the
+current process, for the same project directory and environment, is not run
+again.
+'''
+
+from chicken_turtle_project.common import working_directory
+from chicken_turtle_project import trace
+from pathlib import Path
+import plumbum as pb
+import logging
+
+logger = logging.getLogger(__name__)
+
+#: Environment variables that affect the outcome of a stage
+_environment_variables = ('CT_NO_MKPROJECT', 'CT_PROJECT_VERSION', 'CT_FULL_RESOLVE', 'CT_JOBS', 'CT_VERIFY_VENV', 'CT_VENV_DIR', 'GIT_DIR', 'GIT_INDEX_FILE')
+
+_satisfied = set()  # keys of stages that ran since the last reset
+
+def reset():
+    '''
+    Forget which stages ran, call at the start of each command
+    '''
+    _satisfied.clear()
+    
+def run(stage, project_root=None):
+    '''
+    Run stage and its prerequisites in process
+    
+    Stages which already ran since the last `reset`, in the same project root
+    and with the same relevant environment variables, are skipped.
+    
+    Parameters
+    ----------
+    stage : str
+        Name of the stage: project, venv, docs or tests.
+    project_root : pathlib.Path or None
+        Project root to run the stage in, defaults to the current working
+        directory. The stage runs with it as current working directory.
+    '''
+    project_root = Path(str(project_root or Path.cwd())).absolute()
+    function, prerequisites = _stages[stage]
+    for prerequisite in prerequisites:
+        run(prerequisite, project_root)
+    key = (stage, str(project_root)) + tuple(pb.local.env.get(name) for name in _environment_variables)
+    if key in _satisfied:
+        logger.debug('Stage {} already ran'.format(stage))
+        return
+    logger.debug('Running stage {}'.format(stage))
+    with working_directory(project_root), trace.span(stage, 'pipeline', project_root=str(project_root)):
+        function(project_root)
+    _satisfied.add(key)
+    
+def _project(project_root):
+    if 'CT_NO_MKPROJECT' in pb.local.env:
+        return
+    from chicken_turtle_project.mkproject import mkproject, _dummy_version
+    env = pb.local.env
+    jobs = env.get('CT_JOBS')
+    mkproject(
+        project_root,
+        project_version=env.get('CT_PROJECT_VERSION', _dummy_version),
+        full_resolve=env.get('CT_FULL_RESOLVE', '').lower() in ('1', 'true', 'yes', 'y', 'on'),
+        jobs=int(jobs) if jobs else None
+    )
+    
+def _venv(project_root):
+    from chicken_turtle_project.mkvenv import mkvenv
+    mkvenv(project_root, verify=pb.local.env.get('CT_VERIFY_VENV', '').lower() in ('1', 'true', 'yes', 'y', 'on'))
+    
+def _docs(project_root):
+    from chicken_turtle_project.mkdoc import mkdoc
+    mkdoc(project_root)
+    
+def _tests(project_root):
+    venv_dir = get_venv_dir(project_root)
+    
+    # Forget about Git and Chicken Turtle environment before running tests
+    with pb.local.env():
+        for name in [name for name in pb.local.env.keys() if name.startswith('GIT_') or name.startswith('CT_')]:
+            del pb.local.env[name]
+        pb.local['sh']['-c', '. {} && py.test'.format(venv_dir / 'bin/activate')] & pb.FG(retcode=(0,5))
+        
+def get_venv_dir(project_root):
+    '''
+    Get the venv directory of project: ``$CT_VENV_DIR`` or ``venv``
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+        Project root, relative venv dirs are relative to it.
+    
+    Returns
+    -------
+    pathlib.Path
+        Absolute path
+    '''
+    return project_root / pb.local.env.get('CT_VENV_DIR', 'venv')
+
+#: stage name -> (function, prerequisites)
+_stages = {
+    'project': (_project, ()),
+    'venv': (_venv, ('project',)),
+    'docs': (_docs, ('venv',)),
+    'tests': (_tests, ('venv',)),
+}
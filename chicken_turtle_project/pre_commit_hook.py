@@ -16,13 +16,12 @@
 # along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
 
 from chicken_turtle_project.common import remove_file, graceful_main, get_project, debug_option
-from chicken_turtle_project import __version__
+from chicken_turtle_project import __version__, pipeline
 from pathlib import Path
 import plumbum as pb
 import click
 from tempfile import TemporaryDirectory
 from glob import glob
-from contextlib import suppress
 
 import logging
 logger = logging.getLogger(__name__)
@@ -38,6 +37,7 @@ def main(debug):
     Internal, do not use
     '''
     with graceful_main(logger, app_name='pre-commit-hook', debug=debug):
+        pipeline.reset()
         with TemporaryDirectory() as temp_dir:
             temp_dir = Path(temp_dir)
             
@@ -51,32 +51,29 @@ def main(debug):
             
             project_root = _get_abs_path_from_env('GIT_WORKING_TREE')
             project = get_project(project_root)
-            for pattern in project['pre_commit_no_ignore']:
+            for pattern in project.pre_commit_no_ignore:
                 for file in glob(pattern):
                     pb.local['cp']('-a', file, str(temp_dir / file))
-            venv_dir = Path(pb.local.env.get('CT_VENV_DIR', str(project_root / 'venv'))).absolute()
+            venv_dir = pipeline.get_venv_dir(project_root).absolute()
+            git_dir = Path(git_('rev-parse', '--git-dir').strip()).absolute()  # Note: git only sets GIT_DIR in hooks in some cases
             env_context = pb.local.env(
-                GIT_DIR=str(_get_abs_path_from_env('GIT_DIR')),
-                GIT_INDEX_FILE=str(_get_abs_path_from_env('GIT_INDEX_FILE')),
+                GIT_DIR=str(git_dir),
+                GIT_INDEX_FILE=str(_get_abs_path_from_env('GIT_INDEX_FILE', git_dir / 'index')),
                 CT_VENV_DIR=str(venv_dir),
             ) 
             try:
-                with env_context, pb.local.cwd(str(temp_dir)):
+                with env_context:
                     # Check documentation for errors (which also updates the venv, which we rely on)
-                    pb.local['ct-mkdoc'] & pb.FG
+                    pipeline.run('docs', temp_dir)
                     
-                    # Forget about Git and Chicken Turtle environment before running tests
-                    bad_env_vars = [k for k in pb.local.env.keys() if k.startswith('GIT_') or k.startswith('CT_')]
-                    for name in bad_env_vars:
-                        del pb.local.env[name]
-    
                     # Run tests
-                    pb.local['sh']['-c', '. {} && py.test'.format(venv_dir / 'bin/activate')] & pb.FG(retcode=(0,5))
+                    pipeline.run('tests', temp_dir)
             finally:
                 # Restore venv dir
-                with pb.local.cwd(str(project_root)):
-                    with suppress(pb.commands.ProcessExecutionError): # if restoring fails, commit should still continue
-                        pb.local['ct-mkvenv']()
+                try:
+                    pipeline.run('venv', project_root)
+                except Exception: # if restoring fails, commit should still continue
+                    logger.warning('Failed to restore venv, run ct-mkvenv to retry', exc_info=True)
             
-def _get_abs_path_from_env(name):
-    return Path(pb.local.env.get(name, '.')).absolute()
\ No newline at end of file
+def _get_abs_path_from_env(name, default='.'):
+    return Path(pb.local.env.get(name, str(default))).absolute()
\ No newline at end of file
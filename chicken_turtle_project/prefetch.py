@@ -0,0 +1,185 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Concurrent download of pinned dependencies
+
+Each pinned requirement is downloaded by its own ``pip download --no-deps``
+process, concurrently, using the pip of the venv and the option lines (e.g.
+``--index-url``) of the requirements file. As pip runs under the venv's
+Python, it picks a wheel compatible with the venv if there is one, else an
+sdist.
+
+Downloads are stored in a directory per Python version and platform in the
+CTP cache dir, see `get_downloads_dir`. It is content addressed: each
+download is stored as ``{sha256}/{file_name}``, by the SHA256 of its content.
+A download is reused by later runs without running pip, found by the name
+and version in its file name, after checking its content still matches its
+digest. Downloads that don't match (e.g. truncated) are removed and
+downloaded again.
+
+Only pinned requirements (``name==version``) are downloaded. Others, e.g.
+editable requirements, have no version to look up a download by and are
+left to pip.
+'''
+
+from chicken_turtle_project.common import remove_file
+from chicken_turtle_project.cache import get_cache_dir, file_digest
+from chicken_turtle_project.requirements import parse_distribution_file_name
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory, mkdtemp
+from pathlib import Path
+import plumbum as pb
+import sysconfig
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+_default_jobs = 16  # downloads are I/O bound
+
+def get_downloads_dir(python_version):
+    '''
+    Get directory of downloaded distributions for a Python version on the current platform
+    
+    Parameters
+    ----------
+    python_version : (int, int)
+        Major and minor version of the Python the distributions are for.
+    
+    Returns
+    -------
+    pathlib.Path
+    '''
+    return get_cache_dir() / 'downloads' / 'py{}{}-{}'.format(python_version[0], python_version[1], sysconfig.get_platform())
+
+def prefetch(pip, requirements, options, python_version, jobs=None):
+    '''
+    Download distributions of pinned requirements concurrently, unless already downloaded
+    
+    Requirements not pinned to an exact version, or which pip fails to
+    download, are skipped. The environment markers of requirements are not
+    evaluated, pass only those which apply to the venv.
+    
+    Parameters
+    ----------
+    pip : plumbum command
+        pip of the venv to download for.
+    requirements : [chicken_turtle_project.requirements.Requirement]
+    options : [str]
+        Option lines of the requirements file, e.g. ``--index-url url``.
+    python_version : (int, int)
+        Major and minor version of the venv's Python.
+    jobs : int or None
+        Maximum number of concurrent downloads.
+    
+    Returns
+    -------
+    {(str, packaging.version.Version or str) : pathlib.Path}
+        Downloaded file by pin, see
+        `chicken_turtle_project.requirements.Requirement.pin`.
+    '''
+    requirements = [requirement for requirement in requirements if requirement.pin]
+    if not requirements:
+        return {}
+    downloads_dir = get_downloads_dir(python_version)
+    downloads_dir.mkdir(parents=True, exist_ok=True)
+    downloads = get_downloads(requirements, python_version)
+    missing = [requirement for requirement in requirements if requirement.pin not in downloads]
+    if missing:
+        logger.info('Downloading {}'.format(', '.join(requirement.name for requirement in missing)))
+        def download(requirement):
+            try:
+                _download(pip, requirement, options, downloads_dir)
+            except pb.commands.ProcessExecutionError as ex:  # Note: the install falls back to pip downloading it
+                logger.warning('Failed to download {}:\n{}'.format(requirement.line, ex.stderr))
+        with ThreadPoolExecutor(max_workers=jobs or _default_jobs) as executor:
+            list(executor.map(download, missing))
+        downloads = get_downloads(requirements, python_version)
+    return downloads
+
+def get_downloads(requirements, python_version):
+    '''
+    Get verified downloads of pinned requirements, without downloading
+    
+    Downloads whose content does not match their digest are removed.
+    
+    Parameters
+    ----------
+    requirements : [chicken_turtle_project.requirements.Requirement]
+    python_version : (int, int)
+    
+    Returns
+    -------
+    {(str, packaging.version.Version or str) : pathlib.Path}
+        Downloaded file by pin, see `prefetch`. Wheels are preferred over
+        sdists of the same pin.
+    '''
+    pins = {requirement.pin for requirement in requirements} - {None}
+    downloads_dir = get_downloads_dir(python_version)
+    if not pins or not downloads_dir.exists():
+        return {}
+    downloads = {}
+    for path in sorted(_list_downloads(downloads_dir), key=lambda path: path.name.endswith('.whl')):  # wheels last, so they win
+        pin = parse_distribution_file_name(path.name)
+        if pin not in pins:
+            continue
+        if file_digest(path) != path.parent.name:
+            logger.warning('Removing corrupt download {}'.format(path))
+            remove_file(path.parent)
+            continue
+        downloads[pin] = path
+    return downloads
+
+def _download(pip, requirement, options, downloads_dir):
+    '''
+    Download distribution of requirement into downloads_dir
+    
+    pip downloads into a temporary directory, from which the distribution is
+    moved into place, so concurrent ct-* processes never see a partial file.
+    '''
+    with TemporaryDirectory(dir=str(downloads_dir), prefix='.tmp') as temp_dir:
+        temp_dir = Path(temp_dir)
+        requirements_path = temp_dir / 'requirements.txt'
+        with requirements_path.open('w') as f:
+            for line in list(options) + [requirement.line]:
+                f.write(line + '\n')
+        download_dir = temp_dir / 'download'
+        pip('download', '--no-deps', '-d', str(download_dir), '-r', str(requirements_path))
+        for path in download_dir.iterdir():
+            content_dir = Path(mkdtemp(dir=str(temp_dir)))
+            os.replace(str(path), str(content_dir / path.name))
+            try:
+                os.rename(str(content_dir), str(downloads_dir / file_digest(content_dir / path.name)))
+            except OSError:
+                if not (downloads_dir / file_digest(content_dir / path.name) / path.name).exists():
+                    raise
+                # else: a concurrent ct-* process stored the same download first
+                
+def _list_downloads(downloads_dir):
+    '''
+    Get paths of all downloads, unverified
+    '''
+    paths = []
+    for digest in os.listdir(str(downloads_dir)):
+        if not digest.startswith('.'):  # skip temporary directories
+            content_dir = downloads_dir / digest
+            try:
+                paths.extend(content_dir / name for name in os.listdir(str(content_dir)))
+            except FileNotFoundError:
+                pass  # removed by a concurrent ct-* process
+    return paths
@@ -16,23 +16,27 @@
 # along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
 
 from chicken_turtle_util.exceptions import UserException
-from chicken_turtle_project.common import graceful_main, get_repo, get_project, parse_requirements_file, debug_option
-from chicken_turtle_project import __version__
+from chicken_turtle_project.common import graceful_main, get_repo, get_project, debug_option, working_directory
+from chicken_turtle_project.requirements import get_dependency_manifest
+from chicken_turtle_project import __version__, pipeline
 from chicken_turtle_util import cli
-from functools import partial
 from pathlib import Path
 import plumbum as pb
 from plumbum.commands import ProcessExecutionError
 from tempfile import TemporaryDirectory
 import logging
-import versio.version
-import versio.version_scheme
 import click
 
 logger = logging.getLogger(__name__)
 git_ = pb.local['git']
-Version = partial(versio.version.Version, scheme=versio.version_scheme.Pep440VersionScheme)
-Version.__name__ = 'Version'
+def Version(version):
+    '''
+    Get PEP 440 version
+    '''
+    # Note: slow import, only import when needed
+    import versio.version
+    import versio.version_scheme
+    return versio.version.Version(version, scheme=versio.version_scheme.Pep440VersionScheme)
     
 @click.command(context_settings=dict(help_option_names=['-h', '--help']))
 @cli.argument(
@@ -50,35 +54,46 @@ def main(project_version, debug):
     Any staged/unstaged changes and untracked files will be ignored. If you do 
     want these, commit them first.
     
-    Note: Calls `ct-mkdoc` before uploading documentation.
+    Note: Runs ct-mkdoc's stage before uploading documentation.
     
     Arguments: project-version: Version of the project release, e.g.
     "1.0.0-dev2". Versions must adhere to PEP-0440 and preferably make use of
     semantic versioning.
     '''
     with graceful_main(logger, app_name='release', debug=debug):       
-        # Note: The pre-commit hook already does most of the project validation
-        repo = get_repo(Path.cwd())
+        pipeline.reset()
+        release(project_version)
         
-        logger.info('Entering clean copy of working tree')
-        with TemporaryDirectory() as temp_dir:
-            temp_dir_path = Path(temp_dir)
-            
-            # Export clean working tree
-            (git_['archive', 'HEAD'] | pb.local['tar']['-x', '-C', temp_dir])()
-            
-            # Also copy pre_commit_no_ignore files
-            project_root = _get_abs_path_from_env('GIT_WORKING_TREE')
-            project = get_project(project_root)
-            for pattern in project['pre_commit_no_ignore']:
-                for file in glob(pattern):
-                    pb.local['cp']('-a', file, str(temp_dir / file))
+def release(project_version):
+    '''
+    Release the project in the current working directory
+    
+    Parameters
+    ----------
+    project_version : Version
+    '''
+    # Note: The pre-commit hook already does most of the project validation
+    repo = get_repo(Path.cwd())
+    
+    logger.info('Entering clean copy of working tree')
+    with TemporaryDirectory() as temp_dir:
+        temp_dir_path = Path(temp_dir)
         
-            # Enter tree and get to work
-            with pb.local.cwd(temp_dir):
-                with pb.local.env(GIT_DIR=repo.git_dir):
-                    validate(repo, temp_dir_path, project_version)
-                    _release_all(temp_dir_path, project_version)
+        # Export clean working tree
+        (git_['archive', 'HEAD'] | pb.local['tar']['-x', '-C', temp_dir])()
+        
+        # Also copy pre_commit_no_ignore files
+        project_root = _get_abs_path_from_env('GIT_WORKING_TREE')
+        project = get_project(project_root)
+        for pattern in project.pre_commit_no_ignore:
+            for file in glob(pattern):
+                pb.local['cp']('-a', file, str(temp_dir / file))
+    
+        # Enter tree and get to work
+        with working_directory(temp_dir):
+            with pb.local.env(GIT_DIR=repo.git_dir):
+                validate(repo, temp_dir_path, project_version)
+                _release_all(temp_dir_path, project_version)
 
 def validate(repo, project_root, project_version):
     # Disallow reuse of previous versions
@@ -104,10 +119,12 @@ def validate(repo, project_root, project_version):
     if project_version < newest_ancestor_version and not click.confirm('Given version is less than that of an ancestor commit ({}). Do you want to release anyway?'.format(newest_ancestor_version)):
         raise UserException('Cancelled')
     
-    # If requirements.txt contains -e, abort
-    for line in parse_requirements_file(project_root / 'requirements.in'):
-        if line[0]:
-            raise UserException('No editable requirements (-e) allowed for release: requirements.in: {}'.format(line[-1]))
+    # If requirements.in contains -e, abort
+    for file in get_dependency_manifest(project_root).files:
+        if file.path.name == 'requirements.in':
+            for requirement in file.requirements:
+                if requirement.editable:
+                    raise UserException('No editable requirements (-e) allowed for release: requirements.in: {}'.format(requirement.line))
     
     # Check origin is configured correctly
     logger.info('Validating git remote')
@@ -128,7 +145,7 @@ def _release_all(project_root, project_version):
         try:
             # Prepare release
             logger.info('Preparing to commit versioned project')
-            pb.local['ct-mkdoc'] & pb.FG  # Create project files (mkproject), and build documentation
+            pipeline.run('docs', project_root)  # Create project files (mkproject), and build documentation
             
             logger.info('Committing')
             git_['commit', '-m', 'Release {}'.format(version_tag)] & pb.FG
@@ -143,12 +160,12 @@ def _release_all(project_root, project_version):
             # Release
             try:
                 # to test index (if any)
-                if 'index_test' in project:
-                    _release(project['index_test'])
+                if project.index_test:
+                    _release(project.index_test)
                     released=True
             
                 # to production index
-                _release(project['index_production'])
+                _release(project.index_production)
                 released=True
             except ReleaseError as ex:
                 if ex.partial:
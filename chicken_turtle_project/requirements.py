@@ -0,0 +1,466 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Parse requirements files (requirements.txt, *requirements.in)
+
+Supports the parts of the requirements file format
+(https://pip.pypa.io/en/stable/reference/pip_install/#requirements-file-format)
+which affect what is installed: ``-r``/``-c`` includes, ``-e``, line
+continuations, comments, extras, environment markers, per-requirement options
+such as ``--hash`` and global option lines such as ``--index-url``.
+
+Parsed files are memoized in process by the content of the file and the files
+it includes, so commands can parse the same file repeatedly without cost.
+'''
+
+from chicken_turtle_project.common import get_dependency_name, get_dependency_file_paths, normalise_name, parse_version
+from chicken_turtle_project.cache import digest
+from chicken_turtle_util.exceptions import UserException
+from pathlib import Path
+import re
+
+class Requirement(object):
+    
+    '''
+    Requirement of a requirements file
+    
+    Attributes
+    ----------
+    editable : bool
+        Whether it is an editable requirement (``-e``).
+    dependency : str
+        Project name, or url/path for url/path requirements, as written;
+        without extras, version specifier or markers.
+    extras : str
+        Extras including brackets, e.g. ``[asyncio,inspect]``, or ``''``.
+    version_spec : str or None
+        Version specifier, e.g. ``==1.0`` or ``>=1,<2``.
+    markers : str or None
+        Environment markers, e.g. ``python_version < "3.5"``.
+    hashes : (str,)
+        Hashes of ``--hash`` options, e.g. ``sha256:abc...``.
+    options : (str,)
+        Other per-requirement options, e.g. ``--global-option="--no-user-cfg"``.
+    line : str
+        The requirement line, without comments and line continuations.
+    '''
+    
+    __slots__ = ('editable', 'dependency', 'extras', 'version_spec', 'markers', 'hashes', 'options', 'line', '_name')
+    
+    def __init__(self, editable, dependency, extras, version_spec, markers, hashes, options, line):
+        self.editable = editable
+        self.dependency = dependency
+        self.extras = extras
+        self.version_spec = version_spec
+        self.markers = markers
+        self.hashes = hashes
+        self.options = options
+        self.line = line
+        self._name = None
+        
+    @property
+    def name(self):
+        '''
+        Normalised project name, see `get_dependency_name`
+        '''
+        if self._name is not None:
+            return self._name
+        name = get_dependency_name(self.editable, self.dependency)
+        
+        # Note: requirements are shared by all files with the same content, so
+        # don't memoize the name of a local editable requirement; it's read
+        # from the metadata of the project it refers to, which may change
+        if not self.editable or re.search(r'egg=([^&]+)', self.dependency):
+            self._name = name
+        return name
+    
+    @property
+    def pinned_version(self):
+        '''
+        Version of a requirement pinned to a single version (``==version``), None otherwise
+        
+        Editable requirements are never pinned.
+        '''
+        version_spec = self.version_spec or ''
+        if self.editable or not version_spec.startswith('==') or any(c in version_spec for c in '*,'):
+            return None
+        return version_spec[2:].strip()
+    
+    @property
+    def pin(self):
+        '''
+        Normalised name and parsed version of a pinned requirement, None otherwise
+        
+        Returns
+        -------
+        (str, packaging.version.Version or str) or None
+            See `pinned_version` and `chicken_turtle_project.common.parse_version`.
+            Compare to `parse_distribution_file_name`.
+        '''
+        version = self.pinned_version
+        if version is None:
+            return None
+        return normalise_name(self.name), parse_version(version)
+    
+    @property
+    def specifier(self):
+        '''
+        Requirement specifier as accepted by setuptools, e.g. ``name[extra]==1.0; python_version < "3.5"``
+        '''
+        specifier = self.name + self.extras + (self.version_spec or '')
+        if self.markers:
+            specifier += '; ' + self.markers
+        return specifier
+    
+    def __repr__(self):
+        return 'Requirement({!r})'.format(self.line)
+    
+class RequirementsFile(object):
+    
+    '''
+    Parsed requirements file, with its includes (``-r``) expanded
+    
+    Attributes
+    ----------
+    path : pathlib.Path
+    requirements : (Requirement,)
+        Requirements of the file and the files it includes, in order.
+    constraints : (Requirement,)
+        Requirements of constraints files (``-c``).
+    options : (str,)
+        Global option lines, e.g. ``--index-url url`` or ``-c /abs/path``.
+        Relative paths of ``-c`` options are made absolute.
+    digests : {str : str}
+        Content digest of the file and each file it includes, by path.
+    '''
+    
+    __slots__ = ('path', 'requirements', 'constraints', 'options', 'digests')
+    
+    def __init__(self, path, requirements, constraints, options, digests):
+        self.path = path
+        self.requirements = requirements
+        self.constraints = constraints
+        self.options = options
+        self.digests = digests
+        
+    @property
+    def lines(self):
+        '''
+        Option and requirement lines, e.g. to pass on to pip
+        
+        Returns
+        -------
+        [str]
+        '''
+        return list(self.options) + [requirement.line for requirement in self.requirements]
+        
+class DependencyManifest(object):
+    
+    '''
+    Parsed *requirements.in files of a project
+    
+    Attributes
+    ----------
+    project_root : pathlib.Path
+    files : (RequirementsFile,)
+        Sorted by path.
+    '''
+    
+    __slots__ = ('project_root', 'files')
+    
+    def __init__(self, project_root, files):
+        self.project_root = project_root
+        self.files = files
+        
+    @property
+    def requirements(self):
+        '''
+        Requirements of all files
+        
+        Returns
+        -------
+        iterable of Requirement
+        '''
+        for file in self.files:
+            yield from file.requirements
+            
+    @property
+    def digests(self):
+        '''
+        Content digest of each file, including included files, by path
+        
+        Returns
+        -------
+        {str : str}
+        '''
+        digests = {}
+        for file in self.files:
+            digests.update(file.digests)
+        return digests
+    
+_manifests = {}  # str(project_root) -> DependencyManifest
+_files = {}  # str(path) -> RequirementsFile, see parse_requirements_file
+_lines = {}  # content digest -> entries, see _parse_content
+
+def get_dependency_manifest(project_root):
+    '''
+    Get the parsed *requirements.in files of a project
+    
+    Memoized, callers get the same manifest until a file changes.
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+    
+    Returns
+    -------
+    DependencyManifest
+    '''
+    files = tuple(parse_requirements_file(path) for path in sorted(get_dependency_file_paths(project_root)))
+    key = str(project_root)
+    manifest = _manifests.get(key)
+    if manifest is None or manifest.files != files:
+        manifest = DependencyManifest(project_root, files)
+        _manifests[key] = manifest
+    return manifest
+
+def parse_requirements_file(path):
+    '''
+    Parse requirements file, expanding includes
+    
+    Memoized by the content of the file and its includes.
+    
+    Parameters
+    ----------
+    path : pathlib.Path
+    
+    Returns
+    -------
+    RequirementsFile
+    
+    Raises
+    ------
+    FileNotFoundError
+        If the file or an included file does not exist.
+    ValueError
+        If a file includes itself.
+    UserException
+        If a file contains an invalid requirement.
+    '''
+    return _parse_file(Path(path), ())
+    
+def _parse_file(path, including):
+    key = str(path)
+    if key in including:
+        raise ValueError('Requirements file includes itself: {}'.format(' -> '.join(including + (key,))))
+    with path.open('rb') as f:
+        content = f.read()
+    
+    # Reuse if neither the file nor its includes changed
+    cached = _files.get(key)
+    if cached and cached.digests[key] == digest(content):
+        if all(_read_digest(Path(path_)) == digest_ for path_, digest_ in cached.digests.items() if path_ != key):
+            return cached
+    
+    try:
+        entries = _parse_content(content)
+    except UserException as ex:
+        raise UserException('{}: {}'.format(path, ex.message)) from ex
+    
+    requirements = []
+    constraints = []
+    options = []
+    digests = {key: digest(content)}
+    for kind, value in entries:
+        if kind == 'requirement':
+            requirements.append(value)
+        elif kind == 'option':
+            options.append(value)
+        else:
+            included = _parse_file(path.parent / value, including + (key,))
+            digests.update(included.digests)
+            constraints.extend(included.constraints)
+            options.extend(option for option in included.options if option not in options)
+            if kind == 'requirements':
+                requirements.extend(included.requirements)
+            else:
+                constraints.extend(included.requirements)
+                options.append('-c ' + str(included.path))
+    file = RequirementsFile(path, tuple(requirements), tuple(constraints), tuple(options), digests)
+    _files[key] = file
+    return file
+
+def _read_digest(path):
+    try:
+        with path.open('rb') as f:
+            return digest(f.read())
+    except FileNotFoundError:
+        return None
+    
+def _parse_content(content):
+    '''
+    Parse content of a requirements file, without expanding includes
+    
+    Memoized by content.
+    
+    Returns
+    -------
+    ((kind :: str, value),)
+        Entries in order of the file. ``('requirement', Requirement)``,
+        ``('option', str)`` for a global option line, ``('requirements', str)``
+        for an include (-r) of the given path, or ``('constraints', str)`` for
+        a constraints file (-c).
+    '''
+    key = digest(content)
+    entries = _lines.get(key)
+    if entries is None:
+        entries = []
+        for number, line in _get_logical_lines(content.decode('utf-8')):
+            match = re.fullmatch(r'(-r|--requirement|-c|--constraint)(?:\s*=\s*|\s+)(\S+)', line)
+            if match:
+                kind = 'requirements' if match.group(1) in ('-r', '--requirement') else 'constraints'
+                entries.append((kind, match.group(2)))
+                continue
+            try:
+                requirement = parse_requirement_line(line)
+            except UserException as ex:
+                raise UserException('line {}: {}'.format(number, ex.message)) from ex
+            if requirement:
+                entries.append(('requirement', requirement))
+            else:
+                entries.append(('option', line))
+        entries = tuple(entries)
+        _lines[key] = entries
+    return entries
+    
+def _get_logical_lines(content):
+    '''
+    Get non-empty lines without comments, joining continued lines
+    
+    Returns
+    -------
+    [(int, str)]
+        Line number (of the first physical line) and logical line.
+    '''
+    lines = []
+    continued = ''
+    start = None
+    for number, line in enumerate(content.splitlines(), 1):
+        if start is None:
+            start = number
+        if line.endswith('\\'):
+            continued += line[:-1]
+            continue
+        line = continued + line
+        continued = ''
+        line = re.sub(r'(^|\s)#.*', '', line).strip()  # Note: a # not preceded by whitespace is part of a url
+        if line:
+            lines.append((start, line))
+        start = None
+    if continued.strip():
+        lines.append((start, continued.strip()))
+    return lines
+
+def parse_distribution_file_name(name):
+    '''
+    Get the pin of a wheel or sdist by its file name
+    
+    Parameters
+    ----------
+    name : str
+        File name, e.g. ``Foo_Bar-1.0-py3-none-any.whl`` or ``foo-1.0.tar.gz``.
+        
+    Returns
+    -------
+    (str, packaging.version.Version or str) or None
+        Normalised name and parsed version, like `Requirement.pin`. None if
+        not the name of a distribution.
+    '''
+    if name.endswith('.whl'):
+        parts = name.split('-')
+        if len(parts) < 5:
+            return None
+        name, version = parts[:2]
+    else:
+        match = re.fullmatch(r'(.+)-([^-]+)\.(?:tar\.gz|tar\.bz2|zip)', name)
+        if not match:
+            return None
+        name, version = match.groups()
+    return normalise_name(name), parse_version(version)
+    
+def parse_requirement_line(line):
+    '''
+    Parse a requirement line
+    
+    Parameters
+    ----------
+    line : str
+        Line without comments and line continuations.
+    
+    Returns
+    -------
+    Requirement or None
+        None if the line is an option line, e.g. ``--index-url url``.
+    
+    Raises
+    ------
+    UserException
+        If the line is not a valid requirement.
+    '''
+    line = line.strip()
+    match = re.match(r'(-e|--editable)(?:\s*=\s*|\s+)', line)
+    editable = bool(match)
+    rest = line[match.end():] if match else line
+    if not editable and rest.startswith('-'):
+        return None
+    
+    # Split off per-requirement options (e.g. --hash)
+    match = re.search(r'\s--?[a-zA-Z]', rest)
+    if match:
+        rest, options = rest[:match.start()], rest[match.start():]
+        options = re.findall(r'''--?[\w-]+(?:(?:\s*=\s*|\s+)(?:"[^"]*"|'[^']*'|[^\s-]\S*))?''', options)
+    else:
+        options = []
+    hashes = []
+    for option in list(options):
+        match = re.fullmatch(r'--hash(?:\s*=\s*|\s+)(\S+)', option)
+        if match:
+            hashes.append(match.group(1))
+            options.remove(option)
+    rest = rest.strip()
+    
+    # Split off markers. Note: urls and paths may contain ;, their markers must be preceded by whitespace
+    is_url = editable or '/' in rest or rest.startswith('.')
+    parts = re.split(r'\s;' if is_url else r';', rest, maxsplit=1)
+    spec = parts[0].strip()
+    markers = parts[1].strip() if len(parts) > 1 else None
+    
+    # Split name/url, extras and version specifier
+    if is_url:
+        match = re.fullmatch(r'(.*?)(\[[^\]]*\])?', spec)
+        dependency, extras, version_spec = match.group(1), match.group(2) or '', None
+    else:
+        match = re.fullmatch(r'([A-Za-z0-9][\w.-]*)\s*(\[[^\]]*\])?\s*(.*)', spec)
+        if not match:
+            raise UserException('Invalid requirement: {!r}'.format(line))
+        dependency, extras, version_spec = match.group(1), match.group(2) or '', match.group(3).strip() or None
+    
+    return Requirement(
+        editable=editable, dependency=dependency, extras=extras.replace(' ', ''), version_spec=version_spec,
+        markers=markers, hashes=tuple(hashes), options=tuple(options), line=line
+    )
@@ -0,0 +1,298 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Cached builds of SIP dependencies (sip, PyQt5)
+
+SIP dependencies are not on PyPI and take long to build. Their source
+tarballs are kept in the CTP cache dir and each build's installed files are
+saved as an artifact, keyed by package, version, interpreter and the versions
+of the SIP dependencies it is built against (e.g. sip for PyQt5). Installing,
+also right after a build, merely copies the artifact's files into the venv.
+
+A build is installed into a staging directory (``make install`` with
+``DESTDIR`` and ``INSTALL_ROOT`` set), the files it installs in the venv
+prefix make up the artifact. An artifact is a directory with those files, by
+path relative to the venv, and a manifest. The path of the venv the artifact
+was built for is replaced by a placeholder in text files, and back by the
+path of the venv it is installed in.
+'''
+
+from chicken_turtle_project.cache import get_cache_dir, digest, lock
+from chicken_turtle_project.common import remove_file
+from chicken_turtle_project.venv_store import get_interpreter_digest
+from chicken_turtle_util.exceptions import UserException
+from urllib.request import urlopen
+from tempfile import mkdtemp, mkstemp, TemporaryDirectory
+from pathlib import Path
+from shlex import quote
+import plumbum as pb
+import logging
+import tarfile
+import shutil
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+#: name -> (tarball URL, name of the directory it unpacks to); formatted with version
+_sources = {
+    'sip': ('https://sourceforge.net/projects/pyqt/files/sip/sip-{version}/sip-{version}.tar.gz', 'sip-{version}'),
+    'pyqt5': ('https://sourceforge.net/projects/pyqt/files/PyQt5/PyQt-{version}/PyQt-gpl-{version}.tar.gz', 'PyQt-gpl-{version}'),
+}
+
+#: name -> names of the SIP dependencies it is built against
+_build_dependencies = {
+    'sip': (),
+    'pyqt5': ('sip',),
+}
+
+#: name -> glob, relative to the venv, matching a file which a successful build installs
+_build_products = {
+    'sip': 'lib/python*/site-packages/sip*.so',
+    'pyqt5': 'lib/python*/site-packages/PyQt5/QtCore*.so',
+}
+
+_placeholder = b'@CT_VENV_DIR@'
+_manifest_name = 'manifest.json'
+_timeout = 60  # seconds
+
+def get_sip_cache_dir():
+    '''
+    Get directory of SIP tarballs and build artifacts
+    
+    Returns
+    -------
+    pathlib.Path
+    '''
+    return get_cache_dir() / 'sip'
+
+def install(name, versions, venv_dir, jobs=None):
+    '''
+    Install SIP dependency in venv, from a cached build if possible
+    
+    Parameters
+    ----------
+    name : str
+        Lower case name, a key of `chicken_turtle_project.common.sip_packages`.
+    versions : {str : str}
+        Version of each SIP dependency by lower case name. Contains at least
+        the version of `name`. The versions of the SIP dependencies `name` is
+        built against are part of the artifact key; install those first.
+    venv_dir : pathlib.Path
+        Absolute path of the venv.
+    jobs : int or None
+        Number of parallel make jobs. Default: number of CPUs.
+    '''
+    version = versions[name]
+    key = [name, version, get_interpreter_digest(venv_dir / 'bin/python')]
+    key.extend('{}=={}'.format(dependency, versions.get(dependency)) for dependency in _build_dependencies[name])
+    artifact_dir = get_sip_cache_dir() / 'artifacts' / digest(*key)
+    with lock(artifact_dir.with_name(artifact_dir.name + '.lock')):  # build only once, even when concurrent
+        if (artifact_dir / _manifest_name).exists():
+            logger.info('- installing {} from cache'.format(name))
+        else:
+            logger.info('- building {}'.format(name))
+            with TemporaryDirectory() as staging_dir:
+                staging_dir = Path(staging_dir)
+                _build(name, version, venv_dir, staging_dir, jobs)
+                files_dir = staging_dir / venv_dir.relative_to(venv_dir.anchor)
+                _warn_outside(staging_dir, files_dir)
+                # Note: the PyQt5 build's exit code is ignored, so check it
+                # installed the package rather than caching a broken build
+                if not list(files_dir.glob(_build_products[name])):
+                    raise UserException(
+                        'Failed to build {} {}: the build installed nothing matching {}. '
+                        'See the build output above. The build is retried on the next run.'
+                        .format(name, version, _build_products[name])
+                    )
+                save_artifact(files_dir, venv_dir, artifact_dir)
+        restore_artifact(artifact_dir, venv_dir)
+    
+def _build(name, version, venv_dir, staging_dir, jobs):
+    '''
+    Build SIP dependency against venv and install it into staging_dir
+    '''
+    url, unpack_name = (part.format(version=version) for part in _sources[name])
+    tarball = _download(url)
+    with TemporaryDirectory() as temp_dir:
+        _extract(tarball, Path(temp_dir))
+        with pb.local.cwd(str(Path(temp_dir) / unpack_name)):
+            # Note: http://stackoverflow.com/a/1962076/1031434
+            # Note: sip's makefiles install into DESTDIR, PyQt5's (qmake) into INSTALL_ROOT
+            staging_dir = quote(str(staging_dir))
+            script = '. {} && python configure.py && make -j{} && make install DESTDIR={} INSTALL_ROOT={}'.format(
+                quote(str(venv_dir / 'bin/activate')), jobs or os.cpu_count(), staging_dir, staging_dir
+            )
+            cmd = pb.local['sh']['-c', script]
+            if name == 'pyqt5':
+                # say yes to license and ignore exit code as this script always fails (but still install correctly)
+                (cmd << 'yes\n')(retcode=None)
+            else:
+                cmd & pb.FG
+                
+def _extract(tarball, directory):
+    '''
+    Extract tarball into directory, refusing members that would end up outside
+    it or that are not regular files, directories or links
+    
+    Raises
+    ------
+    ValueError
+        If the tarball has an unsafe member.
+    '''
+    with tarfile.open(str(tarball)) as tar:
+        if hasattr(tarfile, 'data_filter'):
+            try:
+                tar.extractall(str(directory), filter='data')
+            except tarfile.FilterError as ex:
+                raise ValueError('Unsafe member in {}: {}'.format(tarball, ex)) from ex
+        else:
+            root = os.path.realpath(str(directory))
+            def is_inside(path):
+                path = os.path.realpath(os.path.join(root, path))
+                return path == root or path.startswith(root + os.sep)
+            for member in tar.getmembers():
+                if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+                    raise ValueError('Unsafe member in {}: {} is not a regular file, directory or link'.format(tarball, member.name))
+                if os.path.isabs(member.name) or not is_inside(member.name):
+                    raise ValueError('Unsafe member in {}: {} is outside the destination'.format(tarball, member.name))
+                if member.issym() and not is_inside(os.path.join(os.path.dirname(member.name), member.linkname)):
+                    raise ValueError('Unsafe member in {}: {} links outside the destination'.format(tarball, member.name))
+                if member.islnk() and not is_inside(member.linkname):
+                    raise ValueError('Unsafe member in {}: {} links outside the destination'.format(tarball, member.name))
+            tar.extractall(str(directory))
+            
+def _warn_outside(staging_dir, files_dir):
+    '''
+    Warn about files a build installed outside the venv, they are not installed
+    '''
+    outside = []
+    for parent, _, names in os.walk(str(staging_dir)):
+        parent = Path(parent)
+        if parent != files_dir and files_dir not in parent.parents:
+            outside.extend(str(Path('/') / (parent / name).relative_to(staging_dir)) for name in names)
+    if outside:
+        logger.warning('Build installed files outside the venv, these are not installed: {}'.format(', '.join(sorted(outside))))
+    
+def _download(url):
+    '''
+    Download url to the tarball cache, unless already there
+    
+    Returns
+    -------
+    pathlib.Path
+    '''
+    downloads_dir = get_sip_cache_dir() / 'downloads'
+    path = downloads_dir / url.rsplit('/', 1)[-1]
+    if path.exists():
+        return path
+    downloads_dir.mkdir(parents=True, exist_ok=True)
+    fd, temp_path = mkstemp(dir=str(downloads_dir), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f, urlopen(url, timeout=_timeout) as response:
+            shutil.copyfileobj(response, f)
+        os.replace(temp_path, str(path))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path
+
+def save_artifact(files_dir, prefix, artifact_dir):
+    '''
+    Save installed files as artifact
+    
+    Parameters
+    ----------
+    files_dir : pathlib.Path
+        Directory with the files the build installed in the venv prefix, e.g.
+        ``staging_dir / 'home/user/project/venv'``.
+    prefix : pathlib.Path
+        The venv prefix the files were built for.
+    artifact_dir : pathlib.Path
+        Directory to save to. It is created atomically.
+    '''
+    files = []
+    for parent, dirs, names in os.walk(str(files_dir)):
+        links = [name for name in dirs if os.path.islink(os.path.join(parent, name))]  # symlinks to directories
+        dirs[:] = [name for name in dirs if name != '__pycache__' and name not in links]
+        files.extend(os.path.relpath(os.path.join(parent, name), str(files_dir)) for name in names + links)
+    files.sort()
+    prefix = str(prefix).encode()
+    artifact_dir.parent.mkdir(parents=True, exist_ok=True)
+    temp_dir = Path(mkdtemp(dir=str(artifact_dir.parent), prefix='.tmp'))
+    try:
+        templates = []
+        for path in files:
+            source = files_dir / path
+            target = temp_dir / 'files' / path
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if source.is_symlink():
+                os.symlink(os.readlink(str(source)), str(target))
+                continue
+            with source.open('rb') as f:
+                content = f.read()
+            if prefix in content:
+                if b'\0' in content:
+                    # Note: replacing a path by one of a different length would corrupt a binary
+                    logger.debug('{} references the venv path, but is binary. It is saved as is'.format(path))
+                else:
+                    content = content.replace(prefix, _placeholder)
+                    templates.append(path)
+            with target.open('wb') as f:
+                f.write(content)
+            shutil.copymode(str(source), str(target))
+        with (temp_dir / _manifest_name).open('w') as f:
+            json.dump({'files': files, 'templates': templates}, f)
+        try:
+            os.rename(str(temp_dir), str(artifact_dir))
+        except OSError:
+            if not (artifact_dir / _manifest_name).exists():
+                raise
+            # else: a concurrent ct-* process saved the same artifact first
+    finally:
+        remove_file(temp_dir)
+    
+def restore_artifact(artifact_dir, venv_dir):
+    '''
+    Install the files of an artifact in venv
+    
+    Parameters
+    ----------
+    artifact_dir : pathlib.Path
+    venv_dir : pathlib.Path
+    '''
+    with (artifact_dir / _manifest_name).open() as f:
+        manifest = json.load(f)
+    templates = set(manifest['templates'])
+    prefix = str(venv_dir).encode()
+    for path in manifest['files']:
+        source = artifact_dir / 'files' / path
+        target = venv_dir / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if target.is_symlink() or target.exists():
+            target.unlink()
+        if source.is_symlink():
+            os.symlink(os.readlink(str(source)), str(target))
+        elif path in templates:
+            with source.open('rb') as f:
+                content = f.read()
+            with target.open('wb') as f:
+                f.write(content.replace(_placeholder, prefix))
+            shutil.copymode(str(source), str(target))
+        else:
+            shutil.copy2(str(source), str(target))
@@ -22,7 +22,7 @@ Be warned, incorrect changes here will likely go undetected.
 '''
 
 from textwrap import dedent
-from pkg_resources import resource_string
+from pathlib import Path
 
 #: setup.py must begin with this header
 setup_py_header = '''\
@@ -207,17 +207,23 @@ recursive-include docs *
 recursive-exclude docs/build *
 '''.splitlines()
 
+def _read_data(name):
+    # Note: read directly instead of with pkg_resources.resource_string, which
+    # takes longer to import than all of the ct-* commands
+    with (Path(__file__).parent / 'data' / name).open(encoding='utf-8') as f:
+        return f.read()
+
 #: docs/_templates/autosummary/module.rst must match this format
-docs_templates_autosummary_module_rst = resource_string(__name__, 'data/_templates/autosummary/module.rst').decode('utf-8')
+docs_templates_autosummary_module_rst = _read_data('_templates/autosummary/module.rst')
 
 #: docs/conf.py must match this format
-docs_conf_py = resource_string(__name__, 'data/conf.py').decode('utf-8')
+docs_conf_py = _read_data('conf.py')
 
 #: docs/Makefile must match this format
-docs_makefile = resource_string(__name__, 'data/Makefile').decode('utf-8')
+docs_makefile = _read_data('Makefile')
 
 #: docs/index.rst must match this format
-docs_index_rst = resource_string(__name__, 'data/index.rst').decode('utf-8')
+docs_index_rst = _read_data('index.rst')
 
 #: project.py:project must have these keys
 project_py_required_attributes = {'name', 'package_name', 'human_friendly_name', 'python_version', 'readme_file', 'description', 'author', 'author_email', 'url', 'license', 'classifiers', 'keywords', 'index_production'}
@@ -0,0 +1,279 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Run stages, i.e. units of work with dependencies among them, concurrently and
+incrementally
+
+A stage which declares its inputs and outputs is only run when its inputs or
+outputs changed since it last ran, as recorded in `Stamps`.
+'''
+
+from chicken_turtle_project.common import write_file_if_changed
+from chicken_turtle_project.cache import file_digest
+from chicken_turtle_project import trace
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Lock
+import logging
+import json
+
+logger = logging.getLogger(__name__)
+
+class Stage(object):
+    
+    '''
+    Unit of work which may depend on the results of other stages
+    
+    Parameters
+    ----------
+    name : str
+        Unique name of the stage, must be a valid Python identifier.
+    function : callable
+        Does the work, is called with the result of each dependency as keyword
+        argument (named after the dependency). Its return value is the result
+        of the stage.
+    dependencies : iterable of str
+        Names of the stages which must finish before this stage can start and
+        whose result is passed to `function`.
+    after : iterable of str
+        Names of stages which must finish before this stage can start, but
+        whose result is not passed to `function`. E.g. the stage which
+        generates one of this stage's inputs.
+    inputs : callable or None
+        If None, the stage always runs. Else, `inputs()` returns the inputs of
+        the stage as ``{name :: str : digest :: str}``, and the stage is
+        skipped when its inputs and `outputs` are unchanged since it last ran.
+        A skipped stage has None as result.
+    outputs : iterable of pathlib.Path
+        Files the stage generates.
+    on_demand : bool
+        If True, the stage only runs when a stage which depends on it runs.
+        Use this for stages which only compute a result for other stages.
+    '''
+    
+    def __init__(self, name, function, dependencies=(), after=(), inputs=None, outputs=(), on_demand=False):
+        self.name = name
+        self.function = function
+        self.dependencies = tuple(dependencies)
+        self.after = tuple(after)
+        self.inputs = inputs
+        self.outputs = tuple(outputs)
+        self.on_demand = on_demand
+        
+    def __repr__(self):
+        return 'Stage({!r})'.format(self.name)
+    
+class Stamps(object):
+    
+    '''
+    Persistent record of the inputs and outputs of the last run of each stage
+    
+    Parameters
+    ----------
+    path : pathlib.Path
+        JSON file to load stamps from and `save` them to.
+    '''
+    
+    def __init__(self, path):
+        self._path = path
+        self._lock = Lock()
+        try:
+            with path.open('r') as f:
+                self._stamps = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self._stamps = {}
+            
+    def get_reasons(self, stage, inputs):
+        '''
+        Get reasons why stage needs to run
+        
+        Parameters
+        ----------
+        stage : Stage
+        inputs : {str : str}
+            Current return of ``stage.inputs()``
+        
+        Returns
+        -------
+        [str]
+            Reasons why stage needs to run, empty if it's up to date.
+        '''
+        with self._lock:
+            stamp = self._stamps.get(stage.name)
+        if stamp is None:
+            return ['not run before']
+        reasons = []
+        for name in sorted(stamp['inputs'].keys() | inputs.keys()):
+            if stamp['inputs'].get(name) != inputs.get(name):
+                reasons.append('input changed: {}'.format(name))
+        for path, digest in sorted(_get_output_digests(stage).items()):
+            if stamp['outputs'].get(path) != digest:
+                reasons.append('output changed: {}'.format(path))
+        return reasons
+    
+    def update(self, stage, inputs):
+        '''
+        Record stage ran with given inputs, and now has its current outputs
+        '''
+        stamp = dict(inputs=inputs, outputs=_get_output_digests(stage))
+        with self._lock:
+            self._stamps[stage.name] = stamp
+            
+    def save(self):
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            write_file_if_changed(self._path, json.dumps(self._stamps, sort_keys=True, indent=0))
+            
+def _get_output_digests(stage):
+    return {str(path): file_digest(path) for path in stage.outputs}
+
+_skipped = object()
+        
+def run_stages(stages, jobs=None, stamps=None, explain=False):
+    '''
+    Run stages in dependency order, independent stages concurrently
+    
+    Stages run on a thread pool, so concurrency only pays off for stages that
+    mostly wait on I/O or subprocesses. When a stage raises, no new stages are
+    started and the exception is reraised once the running stages finished.
+    
+    Parameters
+    ----------
+    stages : iterable of Stage
+    jobs : int or None
+        Maximum number of stages to run concurrently. 1 runs them sequentially
+        in the calling thread, None imposes no limit.
+    stamps : Stamps or None
+        Stamps to skip up to date stages with. If None, stages with inputs
+        always run. The stamps are updated, but not saved.
+    explain : bool
+        If True, log why each stage with inputs runs or is skipped at info
+        level instead of debug level.
+        
+    Returns
+    -------
+    {str : any}
+        Result of each stage that ran, by stage name.
+    '''
+    stages = {stage.name: stage for stage in stages}
+    for stage in stages.values():
+        for dependency in stage.dependencies + stage.after:
+            if dependency not in stages:
+                raise ValueError('{} depends on unknown stage: {}'.format(stage, dependency))
+    log_explanation = logger.info if explain else logger.debug
+    parent_span = trace.get_current_span_id()  # stages run in other threads
+    
+    # A regular stage can start when the regular stages it depends on,
+    # directly or through on demand stages, have finished
+    def get_gates(stage):
+        gates = set()
+        for name in stage.dependencies + stage.after:
+            dependency = stages[name]
+            if dependency.on_demand:
+                gates |= get_gates(dependency)
+            else:
+                gates.add(name)
+        return gates
+    gates = {name: get_gates(stage) for name, stage in stages.items() if not stage.on_demand}
+    
+    results = {}
+    pending = {name for name in gates}
+    on_demand_results = {}  # name -> future or result
+    on_demand_lock = Lock()
+    on_demand_executor = None
+    
+    def get_result(name):
+        stage = stages[name]
+        if not stage.on_demand:
+            result = results[name]
+            return None if result is _skipped else result
+        with on_demand_lock:
+            if name not in on_demand_results:
+                if on_demand_executor:
+                    on_demand_results[name] = on_demand_executor.submit(call, stage)
+                else:
+                    on_demand_results[name] = None  # guard against cycles
+                    on_demand_results[name] = call(stage)
+            result = on_demand_results[name]
+        return result.result() if on_demand_executor else result
+    
+    def call(stage):
+        kwargs = {dependency: get_result(dependency) for dependency in stage.dependencies}
+        logger.debug('Running stage {}'.format(stage.name))
+        with trace.span(stage.name, 'stage', parent=parent_span):
+            return stage.function(**kwargs)
+    
+    def run(stage):
+        if stage.inputs is None:
+            return call(stage)
+        inputs = stage.inputs()
+        reasons = stamps.get_reasons(stage, inputs) if stamps else ['no stamps']
+        if not reasons:
+            log_explanation('{}: up to date'.format(stage.name))
+            return _skipped
+        log_explanation('{}: running, {}'.format(stage.name, ', '.join(reasons)))
+        result = call(stage)
+        if stamps:
+            stamps.update(stage, inputs)
+        return result
+    
+    def pop_ready():
+        ready = [name for name in pending if gates[name] <= results.keys()]
+        for name in ready:
+            pending.remove(name)
+        return [stages[name] for name in sorted(ready)]
+    
+    if jobs == 1:
+        while pending:
+            ready = pop_ready()
+            if not ready:
+                raise ValueError('Cyclic stage dependencies: {}'.format(sorted(pending)))
+            for stage in ready:
+                results[stage.name] = run(stage)
+    else:
+        max_workers = jobs or max(len(stages), 1)
+        error = None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Note: an on demand stage waits for the on demand stages it depends
+            # on, so it needs its own, large enough pool to avoid deadlock
+            on_demand_executor = ThreadPoolExecutor(max_workers=max(len(stages), 1))
+            try:
+                running = {}  # future -> stage
+                while True:
+                    if error is None:
+                        for stage in pop_ready():
+                            running[executor.submit(run, stage)] = stage
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        stage = running.pop(future)
+                        try:
+                            results[stage.name] = future.result()
+                        except Exception as ex:
+                            if error is None:
+                                error = ex
+            finally:
+                on_demand_executor.shutdown()
+        if error is not None:
+            raise error
+        if pending:
+            raise ValueError('Cyclic stage dependencies: {}'.format(sorted(pending)))
+    
+    results = {name: result for name, result in results.items() if result is not _skipped}
+    results.update((name, result.result() if on_demand_executor else result) for name, result in on_demand_results.items())
+    return results
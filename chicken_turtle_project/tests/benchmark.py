@@ -0,0 +1,232 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks of the ct-* commands on synthetic projects
+
+Run with ``python -m chicken_turtle_project.tests.benchmark results.json``,
+see ``--help``. Results are written as JSON, so that runs of different CTP
+versions and project sizes can be compared.
+'''
+
+from chicken_turtle_project.tests.common import project1, update_project, git_
+from chicken_turtle_project.common import working_directory, get_repo
+from chicken_turtle_project import __version__
+from tempfile import TemporaryDirectory
+from textwrap import dedent
+from pathlib import Path
+from datetime import datetime
+import plumbum as pb
+import itertools
+import platform
+import click
+import shutil
+import json
+import time
+
+#: Small, pure Python distributions on PyPI without dependencies, used as
+#: synthetic requirements
+requirement_names = (
+    'six', 'idna', 'pytz', 'toml', 'wcwidth', 'pyparsing', 'certifi',
+    'chardet', 'decorator', 'docopt', 'ply', 'pycparser', 'tabulate',
+    'termcolor', 'xmltodict', 'zipp', 'iso8601', 'appdirs', 'mccabe',
+    'pyflakes',
+)
+
+#: Benchmarked commands, in the order they are run
+commands = ('mkproject', 'mkvenv', 'mkdoc', 'pre_commit_hook', 'release_validate')
+
+def generate_project(path, packages=1, data_files=0, requirements=0, editables=0, tags=0, commits=1):
+    '''
+    Generate a synthetic project, based on the project of the tests
+    
+    The project is committed, with a bare repository as origin.
+    
+    Parameters
+    ----------
+    path : pathlib.Path
+        Directory to generate project in, must not exist. A bare repository
+        ``path.with_suffix('.git')`` is created as origin.
+    packages : int
+        Number of packages in addition to the root package and its tests
+        package. Packages are nested 10 per level.
+    data_files : int
+        Number of files in the root package's data directory, 100 per
+        subdirectory.
+    requirements : int
+        Number of requirements from PyPI, at most ``len(requirement_names)``.
+    editables : int
+        Number of local editable requirements.
+    tags : int
+        Number of version tags, each on a separate commit.
+    commits : int
+        Number of commits, at least 1 and at least `tags`.
+    '''
+    if requirements > len(requirement_names):
+        raise ValueError('requirements must be at most {}'.format(len(requirement_names)))
+    project = project1.copy()
+    pkg_root = Path(project.format_kwargs['pkg_root'])
+    
+    # Packages
+    for i in range(packages):
+        parts = ['pkg{}'.format(i)]
+        while i >= 10:
+            i = i // 10 - 1
+            parts.insert(0, 'pkg{}'.format(i))
+        project.files[pkg_root.joinpath(*parts) / '__init__.py'] = ''
+        
+    # Data files
+    for i in range(data_files):
+        project.files[pkg_root / 'data' / 'dir{}'.format(i // 100) / 'file{}'.format(i)] = str(i)
+        
+    # Requirements
+    lines = list(requirement_names[:requirements])
+    for i in range(editables):
+        name = 'editable{}'.format(i)
+        project.files[Path('editables') / name / 'setup.py'] = dedent('''\
+            from setuptools import setup
+            setup(name='{}', py_modules=['{}'])
+            '''.format(name, name))
+        project.files[Path('editables') / name / (name + '.py')] = ''
+        lines.append('-e ./editables/{}'.format(name))
+    project.files[Path('requirements.in')] = '\n'.join(lines) + '\n'
+    
+    # Write and commit
+    path.mkdir(parents=True)
+    origin = path.with_suffix('.git')
+    git_('init', '--bare', str(origin))
+    with working_directory(path):
+        update_project(project)
+        git_('init')
+        git_('remote', 'add', 'origin', str(origin))
+        with pb.local.env(CT_NO_MKPROJECT='1'):  # don't run the pre-commit hook
+            for i in range(max(commits, tags, 1)):
+                with Path('history.txt').open('a') as f:
+                    f.write('commit {}\n'.format(i))
+                git_('add', '.')
+                git_('commit', '--no-verify', '-m', 'Commit {}'.format(i))
+                if i < tags:
+                    git_('tag', 'v0.0.{}'.format(i + 1))
+        git_('push', '--quiet', 'origin', 'HEAD', '--tags')
+        
+def _time(function):
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+def _run_command(command, project_root):
+    if command == 'mkproject':
+        pb.local['ct-mkproject']()
+    elif command == 'mkvenv':
+        pb.local['ct-mkvenv']()
+    elif command == 'mkdoc':
+        pb.local['ct-mkdoc']()
+    elif command == 'pre_commit_hook':
+        with Path('history.txt').open('a') as f:
+            f.write('benchmark\n')
+        git_('add', 'history.txt')
+        git_('commit', '-m', 'Benchmark pre-commit hook')
+    elif command == 'release_validate':
+        from chicken_turtle_project.release import validate, Version
+        validate(get_repo(project_root), project_root, Version('1000.0.0'))
+    else:
+        assert False
+
+def _prepare_cold_run(command, project_root, cache_dir):
+    '''
+    Clear all caches and output of command
+    '''
+    if command == 'pre_commit_hook' and not (project_root / '.git/hooks/pre-commit').exists():
+        pb.local['ct-mkproject']()  # install the hook
+    shutil.rmtree(str(cache_dir), ignore_errors=True)
+    shutil.rmtree(str(project_root / '.cache'), ignore_errors=True)
+    if command in ('mkvenv', 'mkdoc', 'pre_commit_hook'):
+        shutil.rmtree(str(project_root / 'venv'), ignore_errors=True)
+    if command == 'mkdoc':
+        shutil.rmtree(str(project_root / 'docs/build'), ignore_errors=True)
+        
+def benchmark(project_root, commands=commands):
+    '''
+    Time commands on project, cold and warm
+    
+    A cold run starts without CTP caches, and without venv for commands that
+    create one. A warm run follows a cold run without changes.
+    
+    Parameters
+    ----------
+    project_root : pathlib.Path
+        Generated project, see `generate_project`.
+    commands : iterable of str
+        Commands to benchmark, see `commands`.
+        
+    Returns
+    -------
+    {command :: str : {'cold' : float, 'warm' : float}}
+        Wall clock time in seconds of each run.
+    '''
+    results = {}
+    with TemporaryDirectory() as cache_dir:
+        cache_dir = Path(cache_dir)
+        with working_directory(project_root), pb.local.env(CT_CACHE_DIR=str(cache_dir)):
+            for command in commands:
+                _prepare_cold_run(command, project_root, cache_dir)
+                results[command] = {
+                    'cold': _time(lambda: _run_command(command, project_root)),
+                    'warm': _time(lambda: _run_command(command, project_root)),
+                }
+    return results
+
+@click.command(context_settings=dict(help_option_names=['-h', '--help']))
+@click.argument('output', type=click.Path(dir_okay=False, writable=True))
+@click.option('--packages', type=int, multiple=True, default=(1,), show_default=True, help='Number of packages, may be repeated.')
+@click.option('--data-files', type=int, multiple=True, default=(0,), show_default=True, help='Number of data files, may be repeated.')
+@click.option('--requirements', type=int, multiple=True, default=(0,), show_default=True, help='Number of requirements from PyPI, may be repeated.')
+@click.option('--editables', type=int, multiple=True, default=(0,), show_default=True, help='Number of local editable requirements, may be repeated.')
+@click.option('--tags', type=int, multiple=True, default=(0,), show_default=True, help='Number of version tags, may be repeated.')
+@click.option('--commits', type=int, multiple=True, default=(1,), show_default=True, help='Number of commits, may be repeated.')
+@click.option('--command', 'commands_', type=click.Choice(commands), multiple=True, help='Command to benchmark, may be repeated. Default: all.')
+def main(output, packages, data_files, requirements, editables, tags, commits, commands_):
+    '''
+    Benchmark ct-* commands on synthetic projects and write results to OUTPUT
+    
+    A project is generated for each combination of the given sizes.
+    '''
+    runs = []
+    for sizes in itertools.product(packages, data_files, requirements, editables, tags, commits):
+        parameters = dict(zip(('packages', 'data_files', 'requirements', 'editables', 'tags', 'commits'), sizes))
+        click.echo('Benchmarking {}'.format(parameters))
+        commands__ = commands_ or commands
+        if parameters['editables'] and 'release_validate' in commands__:
+            # validate rejects editable requirements before it gets to the remote
+            click.echo('Skipping release_validate, projects with editable requirements cannot be released')
+            commands__ = [command for command in commands__ if command != 'release_validate']
+        with TemporaryDirectory() as temp_dir:
+            project_root = Path(temp_dir) / 'project'
+            generate_project(project_root, **parameters)
+            results = benchmark(project_root, commands__)
+        runs.append(dict(parameters=parameters, results=results))
+    with open(output, 'w') as f:
+        json.dump(dict(
+            chicken_turtle_project=__version__,
+            python=platform.python_version(),
+            platform=platform.platform(),
+            time=datetime.now().isoformat(),
+            runs=runs,
+        ), f, indent=4, sort_keys=True)
+        
+if __name__ == '__main__':
+    main()
@@ -20,9 +20,19 @@ from signal import signal, SIGPIPE, SIG_DFL
 signal(SIGPIPE, SIG_DFL) # Ignore SIGPIPE
 
 from pathlib import Path
+import plumbum as pb
 import os
 import pytest
 
+@pytest.yield_fixture(autouse=True, scope='session')
+def cache_dir(tmpdir_factory):
+    '''
+    Use a CTP cache dir private to the test session
+    '''
+    path = tmpdir_factory.mktemp('cache')
+    with pb.local.env(CT_CACHE_DIR=str(path)):
+        yield path
+
 # TODO is CTU.test.temp_dir_cwd
 @pytest.yield_fixture()
 def tmpcwd(tmpdir):
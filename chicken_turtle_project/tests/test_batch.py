@@ -0,0 +1,110 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+ct-batch tests
+'''
+
+from chicken_turtle_project.tests.common import create_project, project1, read_file
+from pathlib import Path
+import plumbum as pb
+import os
+
+batch = pb.local['ct-batch']
+
+def create_projects(requirements):
+    '''
+    Create a project in a subdirectory for each name in requirements
+    
+    Parameters
+    ----------
+    requirements : {str : str}
+        requirements.in content by project name.
+    '''
+    for name, requirements_in in requirements.items():
+        project = project1.copy()
+        project.project_py['name'] = name
+        project.files[Path('requirements.in')] = requirements_in
+        os.mkdir(name)
+        with pb.local.cwd(name):
+            create_project(project)
+    
+def test_dependency_order(tmpcwd):
+    '''
+    Projects are processed after the projects they depend on through local
+    editable requirements
+    
+    pip-compile needs the setup.py of local editable requirements, so
+    mkproject fails when a project is processed before its dependencies.
+    '''
+    create_projects({
+        'c': '-e ../b\npytest',
+        'b': '-e ../a',
+        'a': 'pytest',
+        'd': 'pytest',
+    })
+    batch('--stage', 'project', '--jobs', '2')
+    for name in 'abcd':
+        assert Path(name, 'setup.py').exists()
+    assert '-e ../b' in read_file('c/requirements.txt')
+    
+def test_failures(tmpcwd):
+    '''
+    A failing project does not stop the others, dependents of it are skipped,
+    and failures are summarised
+    '''
+    create_projects({
+        'a': 'pytest',
+        'b': '-e ../a',
+        'c': 'pytest',
+    })
+    Path('a/project.py').open('a').write('\nsyntax error')
+    exit_code, _, stderr = batch.run(['--stage', 'project'], retcode=None)
+    assert exit_code == 1
+    assert '1 of 3 projects succeeded' in stderr
+    assert '2 of 3 projects failed' in stderr
+    assert 'Skipped, failed dependencies: {}'.format(Path('a').absolute()) in stderr
+    assert Path('c/setup.py').exists()
+    
+def test_exit(tmpcwd):
+    '''
+    A project which exits is reported as failed, the others are processed
+    '''
+    create_projects({
+        'a': 'pytest',
+        'b': 'pytest',
+        'c': 'pytest',
+    })
+    Path('a/project.py').open('a').write('\nimport sys\nsys.exit(3)\n')
+    exit_code, _, stderr = batch.run(['--stage', 'project', '--jobs', '1'], retcode=None)
+    assert exit_code == 1
+    assert 'Exited with 3' in stderr
+    assert '2 of 3 projects succeeded' in stderr
+    assert Path('b/setup.py').exists()
+    assert Path('c/setup.py').exists()
+    
+def test_cycle(tmpcwd):
+    '''
+    Cyclic local editable requirements are reported
+    '''
+    create_projects({
+        'a': '-e ../b',
+        'b': '-e ../a',
+    })
+    exit_code, _, stderr = batch.run(['--stage', 'project'], retcode=None)
+    assert exit_code == 1
+    assert 'form a cycle' in stderr
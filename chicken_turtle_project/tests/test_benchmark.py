@@ -0,0 +1,46 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests of the benchmark suite itself, on tiny projects
+'''
+
+from chicken_turtle_project.tests.benchmark import generate_project, benchmark
+from chicken_turtle_project.tests.common import git_
+from pathlib import Path
+import plumbum as pb
+
+def test_generate_project(tmpcwd):
+    project_root = Path('project').absolute()
+    generate_project(project_root, packages=12, data_files=150, requirements=2, editables=2, tags=2, commits=3)
+    pkg_root = project_root / 'operation/mittens'
+    assert (pkg_root / 'pkg0/pkg11/__init__.py').exists()
+    assert len(list((pkg_root / 'data').glob('*/*'))) == 150
+    assert (project_root / 'editables/editable1/setup.py').exists()
+    with pb.local.cwd(str(project_root)):
+        assert git_('tag').split() == ['v0.0.1', 'v0.0.2']
+        assert len(git_('log', '--format=%H').split()) == 3
+        assert git_('status', '--porcelain') == ''
+        
+def test_benchmark(tmpcwd):
+    project_root = Path('project').absolute()
+    generate_project(project_root)
+    results = benchmark(project_root, ['mkproject', 'release_validate'])
+    assert set(results) == {'mkproject', 'release_validate'}
+    for times in results.values():
+        assert set(times) == {'cold', 'warm'}
+        assert all(time > 0 for time in times.values())
@@ -0,0 +1,46 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+ct tests
+'''
+
+from chicken_turtle_project.tests.common import create_project, mkproject
+from checksumdir import dirhash
+import plumbum as pb
+
+ct = pb.local['ct']
+
+def test_project(tmpcwd):
+    '''
+    ct project is ct-mkproject
+    '''
+    create_project()
+    mkproject & pb.FG
+    expected = dirhash('.', 'md5', excluded_files=['mkproject.json'])
+    ct('project')
+    assert dirhash('.', 'md5', excluded_files=['mkproject.json']) == expected
+    
+def test_deduplicate(tmpcwd):
+    '''
+    Each stage runs at most once per invocation
+    '''
+    create_project()
+    _, stdout, stderr = ct.run(['--debug', 'project', 'project'])
+    output = stdout + stderr
+    assert output.count('Running stage project') == 1
+    assert 'Stage project already ran' in output
@@ -26,7 +26,11 @@ from chicken_turtle_project.tests.common import (
     update_project
 )
 from contextlib import ExitStack
-from chicken_turtle_project.common import eval_file, parse_requirements_file, get_dependency_name, remove_file
+from chicken_turtle_project.common import eval_file, remove_file
+from chicken_turtle_project.requirements import parse_requirements_file
+from chicken_turtle_project.mkproject import (
+    _parse_requirements_txt_annotations, _compile_requirements_incrementally, _RequirementsInputs
+)
 from chicken_turtle_project import specification as spec
 from pathlib import Path
 from configparser import ConfigParser
@@ -311,7 +315,19 @@ class TestProjectPy(object):
         write_file('project.py', '')
         with assert_process_fails(stderr_matches='must export a `project` variable'):
             mkproject()
-            
+
+    def test_cached_warnings(self, tmpcwd):
+        '''
+        Warnings about project.py are repeated when the validated project is
+        loaded from cache
+        '''
+        project = project1.copy()
+        project.project_py['name'] = 'under_score'
+        create_project(project)
+        for _ in range(2):
+            _, stdout, stderr = mkproject.run()
+            assert 'contains underscores' in stdout + stderr
+
     @pytest.mark.parametrize('required_attr', project1.project_py.keys())
     def test_missing_required_attr(self, tmpcwd, required_attr):
         '''
@@ -403,8 +419,8 @@ class TestSetupPyAndRequirementsTxt(object):
         assert set(setup_args['classifiers']) == {'Development Status :: 2 - Pre-Alpha', 'Programming Language :: Python :: Implementation :: Stackless'}
         assert set(setup_args['packages']) == {'operation', 'operation.mittens', 'operation.mittens.tests', 'operation.mittens.tests.pkg'}
         assert {k:set(v) for k,v in setup_args['package_data'].items()} == {
-            'operation.mittens.tests' : {'data/subdir/file1', 'data/subdir/file2'},
-            'operation.mittens.tests.pkg' : {'data/file'},
+            'operation.mittens.tests' : {'data/subdir/*'},
+            'operation.mittens.tests.pkg' : {'data/*'},
         }
         assert set(setup_args['install_requires']) == {'pytest', 'pytest-testmon<5.0.0', 'pytest-env==0.6', 'pkg4', 'pytest-cov'}
         assert set(setup_args['extras_require'].keys()) == {'my_extra', 'test', 'dev'}
@@ -422,11 +438,11 @@ class TestSetupPyAndRequirementsTxt(object):
         # Requirements.txt must be sorted like pip-compile
         #TODO hard to test, exact order used is: https://github.com/nvie/pip-tools/blob/master/piptools/writer.py#L27
         # maybe 2 local setup.py and 2 trivial pypi packages that have no dependencies and won't have any in the near/distant future 
-        deps_txt = [get_dependency_name(line[0], line[1]) for line in parse_requirements_file(Path('requirements.txt')) if line[1]]
+        deps_txt = [requirement.name for requirement in parse_requirements_file(Path('requirements.txt')).requirements]
         
         # and must contain the dependencies of all *requirements.in files
         for path in map(Path, ('requirements.in', 'my_extra_requirements.in', 'test_requirements.in')):
-            deps_in = [get_dependency_name(line[0], line[1]) for line in parse_requirements_file(path) if line[1]]
+            deps_in = [requirement.name for requirement in parse_requirements_file(path).requirements]
             assert set(deps_in).issubset(set(deps_txt))
             
         # Multiple runs yield the same setup.py each time
@@ -437,7 +453,125 @@ class TestSetupPyAndRequirementsTxt(object):
             with open('setup.py') as f:
                 actual = f.read()
             assert actual == expected
+
+    def test_package_data(self, tmpcwd):
+        '''
+        Directories of which all files are included are listed as a glob,
+        ignored files are excluded
+        '''
+        project = project1.copy()
+        data_dir = Path('operation/mittens/data')
+        for path in ('file', '.hidden', 'sub/file', 'sub/deeper/file', 'partial/file', 'partial/file.log', 'ignored/file'):
+            project.files[data_dir / path] = ''
+        project.files[data_dir / '.gitignore'] = '*.log\nignored/\n'
+        create_project(project)
+        mkproject & pb.FG
+        assert get_setup_args()['package_data'] == {
+            'operation.mittens': ['data/*', 'data/.gitignore', 'data/.hidden', 'data/partial/file', 'data/sub/*', 'data/sub/deeper/*']
+        }
+        
+        # Removing a file is picked up on the next run
+        (data_dir / 'partial/file.log').unlink()
+        mkproject()
+        assert 'data/partial/*' in get_setup_args()['package_data']['operation.mittens']
+        
+    def test_packages(self, tmpcwd):
+        '''
+        Packages in git-ignored directories are not included, packages which
+        are not yet tracked are
+        '''
+        project = project1.copy()
+        project.files[Path('venv/lib/pkg/__init__.py')] = ''
+        project.files[Path('build/lib/operation/__init__.py')] = ''
+        project.files[Path('operation/mittens/untracked/__init__.py')] = ''
+        project.files[Path('operation/mittens/untracked/nested/__init__.py')] = ''
+        project.files[Path('operation/mittens/orphan/sub/__init__.py')] = ''
+        create_project(project)
+        mkproject & pb.FG
+        assert get_setup_args()['packages'] == ['operation', 'operation.mittens', 'operation.mittens.tests', 'operation.mittens.untracked', 'operation.mittens.untracked.nested']
+
+        # A package in an ignored directory is included once it is tracked
+        Path('operation/mittens/ignored').mkdir()
+        write_file('operation/mittens/ignored/__init__.py', '')
+        with Path('.gitignore').open('a') as f:
+            f.write('\nignored/\n')
+        mkproject & pb.FG
+        assert 'operation.mittens.ignored' not in get_setup_args()['packages']
+        git_('add', '-f', 'operation/mittens/ignored/__init__.py')
+        mkproject & pb.FG
+        assert 'operation.mittens.ignored' in get_setup_args()['packages']
+
+    def test_requirements_txt_cache(self, tmpcwd):
+        '''
+        When *requirements.in files are unchanged, reuse the cached
+        requirements.txt without running pip-compile
+        '''
+        create_project()
+        mkproject & pb.FG
+        expected = read_file('requirements.txt')
+        write_file('requirements.txt', '# outdated')
+        
+        # Shadow pip-compile by one of the same version that fails to compile
+        version = pb.local['pip-compile']('--version').strip()
+        bin_dir = Path('fake_bin').absolute()
+        bin_dir.mkdir()
+        def fake_pip_compile(version):
+            write_file(bin_dir / 'pip-compile', '#!/bin/sh\n[ "$1" = --version ] && echo {!r} && exit 0\nexit 1\n'.format(version))
+            (bin_dir / 'pip-compile').chmod(0o755)
+        fake_pip_compile(version)
+        with pb.local.env(PATH='{}:{}'.format(bin_dir, pb.local.env['PATH'])):
+            mkproject()
+            assert read_file('requirements.txt') == expected
             
+            # When the pip-compile version changes, requirements are compiled again
+            write_file('requirements.txt', '# outdated')
+            fake_pip_compile(version + '.post1')
+            with pytest.raises(pb.ProcessExecutionError):
+                mkproject()
+        
+    def test_requirements_txt_incremental(self, tmpcwd):
+        '''
+        When requirements are added and removed, the incrementally updated
+        requirements.txt equals the fully resolved one
+        '''
+        create_project()
+        mkproject & pb.FG
+        write_file('requirements.in', 'checksumdir\nsix\n')
+        mkproject & pb.FG
+        incremental = read_file('requirements.txt')
+        assert 'six' in incremental
+        
+        # Note: use an empty cache, so pip-compile really resolves all
+        with pb.local.env(CT_CACHE_DIR=str(Path('empty_cache').absolute())):
+            mkproject('--full-resolve')
+        assert read_file('requirements.txt') == incremental
+        
+    def test_requirements_txt_annotations_fallback(self):
+        '''
+        When pip-compile's annotations cannot be parsed, the next update
+        resolves all requirements
+        '''
+        assert _parse_requirements_txt_annotations('six==1.10.0  # via pytest\npytest==2.9.0\n') == {'six': {'pytest'}}
+        for content in ('six==1.10.0\n    --hash=sha256:abc\n', 'six @ https://example.com/six.zip\n', '# unknown comment\n'):
+            assert _parse_requirements_txt_annotations(content) is None
+        
+        state = dict(inputs={'six': 'six'}, options=[], editables={}, parents=None)
+        inputs = _RequirementsInputs(Path.cwd(), ['six', 'pytest'])
+        assert _compile_requirements_incrementally(inputs, 'six==1.10.0\n', state, Path('requirements.txt')) == (None, None)
+        
+    def test_long_description_rst(self, tmpcwd):
+        '''
+        When the readme file is reStructuredText, use it as is as long_description
+        '''
+        project = project1.copy()
+        readme = 'Mittens\n=======\n\nMeow *meow*.\n'
+        project.project_py['readme_file'] = 'README.rst'
+        del project.files[Path('README.md')]
+        project.files[Path('README.rst')] = readme
+        create_project(project)
+        mkproject & pb.FG
+        assert get_setup_args()['long_description'] == readme
+        
     def test_sip_dependency(self, tmpcwd):
         '''
         When sip based dependency, do not put it in setup.py or requirements.txt
@@ -599,6 +733,82 @@ def test_idempotent(tmpcwd):
     with assert_directory_contents(Path('.'), changed=False):
         mkproject()
 
+def test_sequential(tmpcwd):
+    '''
+    Running stages sequentially yields the same project as running them concurrently
+    '''
+    create_project()
+    mkproject & pb.FG
+    with assert_directory_contents(Path('.'), changed=False):
+        mkproject('--jobs', '1')
+        
+def test_no_rewrites(tmpcwd):
+    '''
+    When nothing changed, ct-mkproject does not touch any file
+    '''
+    create_project()
+    mkproject & pb.FG
+    files = [path for path in Path('.').glob('**/*') if path.is_file() and '.git' not in path.parts]
+    with assert_file_access(*files, written=False, stat_changed=False):
+        mkproject()
+        
+def test_no_git_repo(tmpcwd):
+    '''
+    When the project is not in a git repository, error
+    '''
+    update_project(project1)
+    with assert_process_fails(stderr_matches=r'(?i)must be in a git repository'):
+        mkproject()
+        
+def test_stage_changes(tmpcwd):
+    '''
+    Files created or modified by ct-mkproject are staged
+    '''
+    create_project()
+    mkproject & pb.FG
+    assert git_('diff', '--name-only') == ''
+    assert 'setup.py' in git_('diff', '--cached', '--name-only').splitlines()
+
+def test_incremental(tmpcwd):
+    '''
+    Generated files are only regenerated when their inputs or the file itself
+    changed
+    '''
+    create_project()
+    mkproject & pb.FG
+
+    # Up to date
+    _, stdout, stderr = mkproject.run(['--explain'])
+    output = stdout + stderr
+    assert 'setup_py: up to date' in output
+    assert 'requirements_txt: up to date' in output
+
+    # Input changed
+    with Path(project1.project_py['readme_file']).open('a') as f:
+        f.write('\nMore readme\n')
+    _, stdout, stderr = mkproject.run(['--explain'])
+    output = stdout + stderr
+    assert 'setup_py: running, input changed: {}'.format(project1.project_py['readme_file']) in output
+    assert 'requirements_txt: up to date' in output
+
+    # Output changed
+    write_file('setup.py', '')
+    mkproject()
+    assert 'More readme' in read_file('setup.py')
+
+    # New package
+    Path('operation/mittens/new').mkdir()
+    write_file('operation/mittens/new/__init__.py', '')
+    _, stdout, stderr = mkproject.run(['--explain'])
+    output = stdout + stderr
+    assert 'setup_py: running, input changed: packages' in output
+    assert "'operation.mittens.new'" in read_file('setup.py')
+    
+    # A full resolve always resolves
+    _, stdout, stderr = mkproject.run(['--explain', '--full-resolve'])
+    output = stdout + stderr
+    assert 'requirements_txt: up to date' not in output
+
 @pytest.mark.parametrize('name', ('readme.md', 'README.MD', 'REEEADMEE.md'))
 def test_wrong_readme_file_name(tmpcwd, name):
     project = project1.copy()
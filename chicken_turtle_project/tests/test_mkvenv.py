@@ -20,14 +20,25 @@ ct-mkvenv tests
 '''
 
 from chicken_turtle_project.tests.common import (
-    create_project, reset_logging, project1
+    create_project, reset_logging, project1, write_file, update_project
 )
-from chicken_turtle_project.mkvenv import main as _mkvenv
+from chicken_turtle_project.mkvenv import main as _mkvenv, get_plan, probe, Probe, _sync
+from chicken_turtle_project.common import sip_packages
+from chicken_turtle_project.common import remove_file
+from chicken_turtle_project.sip_cache import save_artifact, restore_artifact, get_sip_cache_dir, _extract
+from chicken_turtle_project import sip_cache
+from chicken_turtle_util.exceptions import UserException
+from chicken_turtle_project.requirements import parse_requirement_line
+from chicken_turtle_project.wheelhouse import _list_wheels
+from chicken_turtle_project.venv_store import get_store_dir, prune
 from click.testing import CliRunner
 from textwrap import dedent
 from pathlib import Path
 import plumbum as pb
+import tarfile
 import pytest
+import sys
+import os
 
 # TODO this is copy paste from `release`
 def mkvenv(*args, **invoke_kwargs):
@@ -70,4 +81,252 @@ def test_sip_install(tmpcwd):
     # When call mycli, all good
     stdout = pb.local['venv/bin/mycli']()
     assert 'meow' in stdout
-    
\ No newline at end of file
+        
+def test_plan():
+    '''
+    Only distributions which differ from the desired ones are in the plan
+    '''
+    installed = {'pip': '8.1.2', 'six': '1.10.0', 'pytest': '2.9.0', 'numpy': '1.11.0', 'old': '1.0', 'kept': '1.0'}
+    desired = {'pip': None, 'six': '1.10.0', 'pytest': '2.9.2', 'numpy': '1.9.0', 'new': '1.0', 'editable': None}
+    plan = get_plan(installed, desired, keep={'kept'})
+    assert plan.install == ['editable', 'new']
+    assert plan.upgrade == ['pytest']
+    assert plan.downgrade == ['numpy']
+    assert plan.remove == ['old']
+    
+    # In sync
+    assert get_plan(installed, dict(installed)) == ([], [], [], [])
+    
+def test_probe():
+    '''
+    probe returns the Python version, installed distributions and which SIP
+    packages are importable
+    '''
+    result = probe(pb.local[sys.executable])
+    assert result.python_version == tuple(sys.version_info[:2])
+    assert 'chicken-turtle-project' in result.installed
+    assert 'plumbum' in result.installed
+    assert set(result.importable) == set(sip_packages.values())
+    assert result.site_packages.name == 'site-packages'
+    assert result.environment['python_version'] == '{}.{}'.format(*sys.version_info[:2])
+    
+def test_sync(tmpcwd, mocker):
+    '''
+    Requirements whose markers do not match the venv are not installed, a
+    local editable requirement is only satisfied by an editable install of
+    its directory
+    '''
+    install = mocker.patch('chicken_turtle_project.wheelhouse.install')
+    pip = mocker.Mock()
+    write_file(Path('setup.py'), "from setuptools import setup\nsetup(name='foo')\n")
+    site_packages = Path('site-packages').absolute()
+    site_packages.mkdir()
+    venv = Probe(
+        python_version=(3, 5),
+        installed={'pip': '8.1.2', 'setuptools': '28.0.0', 'wheel': '0.29.0', 'foo': '1.0'},
+        importable={},
+        site_packages=site_packages,
+        environment=probe(pb.local[sys.executable]).environment,
+    )
+    requirements = [
+        parse_requirement_line('-e .'),
+        parse_requirement_line('other==1.0; python_version < "3"'),
+    ]
+    
+    # foo 1.0 is installed, but not as editable install of the project
+    _sync(pip, Path.cwd(), requirements, [], venv, keep=())
+    assert not pip.called
+    assert install.call_count == 1
+    assert [requirement.name for requirement in install.call_args[0][1]] == ['foo']
+    
+    # In sync
+    install.reset_mock()
+    write_file(site_packages / 'foo.egg-link', '{}\n.'.format(Path.cwd()))
+    _sync(pip, Path.cwd(), requirements, [], venv, keep=())
+    assert not pip.called
+    assert not install.called
+    
+def test_stamp(tmpcwd):
+    '''
+    When nothing changed since the last run, do not touch the venv, unless --verify
+    '''
+    create_project()
+    result = mkvenv()
+    assert result.exit_code == 0, result.output
+    
+    # Break the venv's python, only the slow path uses it. Note: it's a
+    # symlink, remove it before writing
+    python = Path('venv/bin/python')
+    remove_file(python)
+    write_file(python, '#!/bin/sh\nexit 1\n')
+    python.chmod(0o755)
+    result = mkvenv()
+    assert result.exit_code == 0, result.output
+    result = mkvenv('--verify')
+    assert result.exit_code != 0
+    
+    # The failed run removed the stamp, so the next run takes the slow path too
+    result = mkvenv()
+    assert result.exit_code != 0
+    
+def test_wheelhouse(tmpcwd, cache_dir):
+    '''
+    Pinned dependencies are installed from wheels in the wheelhouse, which
+    are only built once
+    '''
+    create_project()
+    result = mkvenv()
+    assert result.exit_code == 0, result.output
+    wheels = [path.name for path in Path(str(cache_dir), 'wheelhouse').glob('*/*.whl')]
+    assert any(name.startswith('pytest-') for name in wheels)
+    
+    # Recreate venv
+    remove_file(Path('venv'))
+    result = mkvenv()
+    assert result.exit_code == 0, result.output
+    assert 'Building wheels' not in result.output
+    assert Path('venv/bin/py.test').exists()
+    
+def test_wheelhouse_pins(tmpcwd):
+    '''
+    Wheels match requirements by normalised name and equivalent version
+    '''
+    write_file('Foo_Bar-1.0-py3-none-any.whl', '')
+    wheels = _list_wheels(Path('.'))
+    assert parse_requirement_line('foo.bar==1.0.0').pin in wheels
+    assert parse_requirement_line('foo-bar==1.0.1').pin not in wheels
+    
+def test_venv_store(tmpcwd, cache_dir):
+    '''
+    A venv with the same requirements as a venv created before is cloned from
+    the venv store, with its scripts pointing to the clone
+    '''
+    create_project()
+    result = mkvenv()
+    assert result.exit_code == 0, result.output
+    
+    # Recreate venv
+    remove_file(Path('venv'))
+    result = mkvenv()
+    assert result.exit_code == 0, result.output
+    assert 'Creating venv from venv store' in result.output
+    venv_dir = Path('venv').absolute()
+    with (venv_dir / 'bin/py.test').open() as f:
+        assert f.readline() == '#!{}\n'.format(venv_dir / 'bin/python')
+    assert pb.local[str(venv_dir / 'bin/py.test')]('--version')
+    
+    # The project itself is not installed in the store
+    assert list(Path(str(cache_dir), 'venvs').glob('*/lib/python*/site-packages/*mittens*')) == []
+    
+    # Base files are read-only, metadata which pip may write is copied
+    record = next(venv_dir.glob('lib/python*/site-packages/pytest-*.dist-info/RECORD'))
+    assert record.stat().st_nlink == 1
+    assert record.stat().st_mode & 0o200
+    module = next(venv_dir.glob('lib/python*/site-packages/_pytest/__init__.py'))
+    assert module.stat().st_nlink > 1
+    assert not module.stat().st_mode & 0o222
+    
+def test_venv_store_prune(tmpcwd, cache_dir):
+    '''
+    Pruning keeps the most recently used bases
+    '''
+    store_dir = get_store_dir()
+    for i, name in enumerate(('old', 'new', 'newest')):
+        (store_dir / name).mkdir(parents=True)
+        write_file(store_dir / name / 'ct_venv_store.json', '{}')
+        os.utime(str(store_dir / name / 'ct_venv_store.json'), (i, i))
+    write_file(store_dir / 'old.lock', '')
+    prune(2)
+    assert sorted(path.name for path in store_dir.iterdir() if path.is_dir()) == ['new', 'newest']
+    
+def test_sip_artifact(tmpcwd):
+    '''
+    A SIP build artifact contains the files the build installed in the venv
+    prefix and can be installed in a venv at another path
+    '''
+    venv_dir = Path('venv1').absolute()
+    files_dir = Path('staging').absolute() / venv_dir.relative_to(venv_dir.anchor)
+    for path in ('bin', 'lib/__pycache__'):
+        (files_dir / path).mkdir(parents=True)
+    
+    # "Build"
+    write_file(files_dir / 'bin/sip', '#!{}/bin/python\n'.format(venv_dir))
+    write_file(files_dir / 'lib/sip.so', 'binary\0{}'.format(venv_dir))
+    write_file(files_dir / 'lib/__pycache__/sipconfig.pyc', 'compiled')
+    (files_dir / 'lib/sip-link.so').symlink_to('sip.so')
+    save_artifact(files_dir, venv_dir, Path('artifact'))
+    
+    # Install
+    venv_dir = Path('venv2').absolute()
+    (venv_dir / 'bin').mkdir(parents=True)
+    write_file(venv_dir / 'bin/python', 'unrelated')
+    write_file(venv_dir / 'bin/sip', 'old')
+    restore_artifact(Path('artifact'), venv_dir)
+    assert (venv_dir / 'bin/sip').read_text() == '#!{}/bin/python\n'.format(venv_dir)
+    assert (venv_dir / 'lib/sip.so').read_text() == 'binary\0{}'.format(Path('venv1').absolute())
+    assert os.readlink(str(venv_dir / 'lib/sip-link.so')) == 'sip.so'
+    assert (venv_dir / 'bin/python').read_text() == 'unrelated'
+    assert not (venv_dir / 'lib/__pycache__').exists()
+    
+def test_sip_failed_build(tmpcwd, cache_dir, mocker):
+    '''
+    A SIP build which did not install the package is not cached
+    '''
+    mocker.patch('chicken_turtle_project.sip_cache._build')  # installs nothing
+    venv_dir = Path('venv').absolute()
+    (venv_dir / 'bin').mkdir(parents=True)
+    write_file(venv_dir / 'bin/python', '')
+    with pytest.raises(UserException):
+        sip_cache.install('pyqt5', {'pyqt5': '5.6', 'sip': '4.18'}, venv_dir)
+    assert not list(get_sip_cache_dir().glob('artifacts/*/*'))
+    
+def test_sip_extract(tmpcwd):
+    '''
+    Source tarballs with members outside the destination are refused
+    '''
+    write_file(Path('evil'), 'evil')
+    with tarfile.open('evil.tar.gz', 'w:gz') as tar:
+        tar.add('evil', arcname='../evil')
+    Path('out').mkdir()
+    with pytest.raises(ValueError):
+        _extract(Path('evil.tar.gz'), Path('out'))
+    assert not list(Path('out').iterdir())
+    
+    with tarfile.open('good.tar.gz', 'w:gz') as tar:
+        tar.add('evil', arcname='sip-1/evil')
+    _extract(Path('good.tar.gz'), Path('out'))
+    assert (Path('out') / 'sip-1/evil').read_text() == 'evil'
+    
+def test_project_install(tmpcwd, cache_dir):
+    '''
+    The project is only reinstalled when its setup.py changed, and when only
+    its entry points changed, it is reinstalled without its dependencies
+    '''
+    create_project()
+    result = mkvenv()
+    assert result.exit_code == 0, result.output
+    assert 'Installing project package' in result.output
+    
+    # Unchanged
+    result = mkvenv('--verify')
+    assert result.exit_code == 0, result.output
+    assert 'Project package is up to date' in result.output
+    
+    # Add entry point
+    project = project1.copy()
+    project.project_py['entry_points'] = {'console_scripts': ['mycli = operation.mittens.main:main']}
+    project.files[Path('operation/mittens/main.py')] = "def main():\n    print('meow')\n"
+    update_project(project)
+    result = mkvenv()
+    assert result.exit_code == 0, result.output
+    assert 'Reinstalling project package, its entry points changed' in result.output
+    assert pb.local[str(Path('venv/bin/mycli').absolute())]() == 'meow\n'
+    
+    # Rename it
+    project.project_py['entry_points'] = {'console_scripts': ['mycli2 = operation.mittens.main:main']}
+    update_project(project)
+    result = mkvenv()
+    assert result.exit_code == 0, result.output
+    assert 'Reinstalling project package, its entry points changed' in result.output
+    assert not Path('venv/bin/mycli').exists()
+    assert pb.local[str(Path('venv/bin/mycli2').absolute())]() == 'meow\n'
@@ -0,0 +1,72 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Prefetch tests, against a local --find-links directory
+'''
+
+from chicken_turtle_project.prefetch import prefetch, get_downloads_dir
+from chicken_turtle_project.requirements import parse_requirement_line
+from chicken_turtle_project.common import parse_version
+from chicken_turtle_project.cache import file_digest
+from pathlib import Path
+from zipfile import ZipFile
+import plumbum as pb
+import sys
+import os
+
+def create_wheel(directory, name, version):
+    '''
+    Create minimal pure Python wheel
+    '''
+    dist_info = '{}-{}.dist-info'.format(name, version)
+    path = Path(directory) / '{}-{}-py3-none-any.whl'.format(name, version)
+    with ZipFile(str(path), 'w') as wheel:
+        wheel.writestr(dist_info + '/METADATA', 'Metadata-Version: 2.1\nName: {}\nVersion: {}\n'.format(name, version))
+        wheel.writestr(dist_info + '/WHEEL', 'Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n')
+        wheel.writestr(dist_info + '/RECORD', '')
+    return path
+
+def test_prefetch(tmpcwd, cache_dir):
+    '''
+    Pinned requirements are downloaded by pip and reused without pip later
+    '''
+    Path('links').mkdir()
+    create_wheel('links', 'foo', '1.0')
+    create_wheel('links', 'Bar_Baz', '2.0')
+    options = ['--no-index', '--find-links ' + str(Path('links').absolute())]
+    pip = pb.local[sys.executable]['-m', 'pip']
+    python_version = sys.version_info[:2]
+    requirements = [parse_requirement_line(line) for line in ('foo==1.0.0', 'bar.baz==2.0', 'missing==1.0', 'unpinned>=1.0')]
+    downloads = prefetch(pip, requirements, options, python_version)
+    assert set(downloads) == {('foo', parse_version('1.0')), ('bar-baz', parse_version('2.0'))}
+    for path in downloads.values():
+        assert path.parent.parent == get_downloads_dir(python_version)
+        assert path.parent.name == file_digest(path)  # content addressed
+    assert downloads['bar-baz', parse_version('2.0')].name == 'Bar_Baz-2.0-py3-none-any.whl'
+    
+    # Corrupt downloads are downloaded again
+    foo = downloads['foo', parse_version('1.0')]
+    with foo.open('ab') as f:
+        f.write(b'corrupt')
+    assert prefetch(pip, requirements, options, python_version) == downloads
+    assert foo.parent.name == file_digest(foo)
+    
+    # Downloads are reused
+    for name in os.listdir('links'):
+        os.remove(str(Path('links', name)))
+    assert prefetch(pip, requirements, options, python_version) == downloads
@@ -0,0 +1,147 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Requirements file parser tests
+'''
+
+from chicken_turtle_project.requirements import parse_requirements_file, parse_requirement_line, parse_distribution_file_name
+from chicken_turtle_project.common import parse_version
+from chicken_turtle_project.tests.common import write_file
+from chicken_turtle_util.exceptions import UserException
+from textwrap import dedent
+from pathlib import Path
+import pytest
+
+def test_requirement_line():
+    '''
+    Extras, version specifier, markers and per-requirement options are split
+    '''
+    requirement = parse_requirement_line('Foo_Bar[b, a] >=1.0,<2 ; python_version < "3.5" --hash=sha256:abc --hash sha256:def --global-option="--quiet"')
+    assert not requirement.editable
+    assert requirement.dependency == 'Foo_Bar'
+    assert requirement.name == 'foo-bar'
+    assert requirement.extras == '[b,a]'
+    assert requirement.version_spec == '>=1.0,<2'
+    assert requirement.markers == 'python_version < "3.5"'
+    assert requirement.hashes == ('sha256:abc', 'sha256:def')
+    assert requirement.options == ('--global-option="--quiet"',)
+    assert requirement.specifier == 'foo-bar[b,a]>=1.0,<2; python_version < "3.5"'
+    
+    requirement = parse_requirement_line('-e ../chicken_turtle_util[asyncio,inspect]')
+    assert requirement.editable
+    assert requirement.dependency == '../chicken_turtle_util'
+    assert requirement.extras == '[asyncio,inspect]'
+    assert requirement.version_spec is None
+    
+    requirement = parse_requirement_line('-e git+https://example.com/repo.git#egg=Pkg')
+    assert requirement.name == 'pkg'
+    
+    assert parse_requirement_line('--index-url https://example.com/simple') is None
+    
+def test_pin():
+    '''
+    Pins of requirements match those of distribution file names
+    '''
+    pin = ('foo-bar', parse_version('1.0'))
+    assert parse_requirement_line('Foo.Bar==1.0.0').pin == pin
+    assert parse_requirement_line('foo_bar==1.0; python_version >= "3"').pin == pin
+    assert parse_requirement_line('foo_bar>=1.0').pin is None
+    assert parse_requirement_line('foo_bar==1.*').pin is None
+    assert parse_distribution_file_name('Foo_Bar-1.0-py3-none-any.whl') == pin
+    assert parse_distribution_file_name('foo.bar-1.0.0.tar.gz') == pin
+    assert parse_distribution_file_name('foo_bar-1.0.zip') == pin
+    assert parse_distribution_file_name('requirements.txt') is None
+    
+def test_file(tmpcwd):
+    '''
+    Comments, continuations, options and -r/-c includes
+    '''
+    write_file('requirements.in', dedent('''\
+        # comment
+        --index-url https://example.com/simple
+        pytest  # comment
+        pytest-env==0.6 \\
+            --hash=sha256:abc
+        -r sub/more.in
+        -c constraints.txt
+        '''))
+    Path('sub').mkdir()
+    write_file('sub/more.in', 'six\n-e ./pkg\n')
+    write_file('constraints.txt', 'six==1.10.0\n')
+    file = parse_requirements_file(Path('requirements.in'))
+    assert [requirement.name for requirement in file.requirements if not requirement.editable] == ['pytest', 'pytest-env', 'six']
+    assert file.requirements[1].hashes == ('sha256:abc',)
+    assert file.requirements[1].line == 'pytest-env==0.6     --hash=sha256:abc'
+    assert file.requirements[3].dependency == './pkg'
+    assert [requirement.line for requirement in file.constraints] == ['six==1.10.0']
+    assert file.options == ('--index-url https://example.com/simple', '-c {}'.format(Path('constraints.txt')))
+    assert set(file.digests) == {'requirements.in', 'sub/more.in', 'constraints.txt'}
+    
+def test_invalid_requirement(tmpcwd):
+    '''
+    An invalid requirement is reported with its file and line number
+    '''
+    write_file('requirements.in', '-r more.in\n')
+    write_file('more.in', '# comment\nsix\n~invalid\n')
+    with pytest.raises(UserException) as ex:
+        parse_requirements_file(Path('requirements.in'))
+    assert ex.value.message == "more.in: line 3: Invalid requirement: '~invalid'"
+    
+def test_memoized(tmpcwd):
+    '''
+    A file is parsed again only when it or a file it includes changed
+    '''
+    write_file('requirements.in', '-r more.in\n')
+    write_file('more.in', 'six\n')
+    file = parse_requirements_file(Path('requirements.in'))
+    assert parse_requirements_file(Path('requirements.in')) is file
+    write_file('more.in', 'six\npytest\n')
+    file = parse_requirements_file(Path('requirements.in'))
+    assert [requirement.name for requirement in file.requirements] == ['six', 'pytest']
+    
+def test_editable_name(tmpcwd):
+    '''
+    Names of local editable requirements are read from static metadata, and
+    setup.py is only run as a last resort
+    '''
+    failing_setup_py = 'import sys\nsys.exit(1)\n'
+    files = {
+        'project_py': {'project.py': 'project = dict(name="From_Project_Py")', 'setup.py': failing_setup_py},
+        'setup_cfg': {'setup.cfg': '[metadata]\nname = from-setup-cfg\n', 'setup.py': failing_setup_py},
+        'pyproject': {'pyproject.toml': '[build-system]\nrequires = []\n\n[project]\nname = "from-pyproject"\n', 'setup.py': failing_setup_py},
+        'egg_info': {'pkg.egg-info/PKG-INFO': 'Metadata-Version: 1.1\nName: from-pkg-info\n', 'setup.py': failing_setup_py},
+        'setup_py': {'setup.py': 'from setuptools import setup\nsetup(name="from-setup-py")\n'},
+    }
+    for directory, files_ in files.items():
+        for path, content in files_.items():
+            path = Path(directory, path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            write_file(path, content)
+    names = [parse_requirement_line('-e ./' + directory).name for directory in sorted(files)]
+    assert names == ['from-pkg-info', 'from-project-py', 'from-pyproject', 'from-setup-cfg', 'from-setup-py']
+    
+    # Names are cached by content of the metadata files
+    write_file('requirements.in', '-e ./setup_py\n')
+    requirement = parse_requirements_file(Path('requirements.in')).requirements[0]
+    assert requirement.name == 'from-setup-py'
+    write_file('setup_py/setup.py', 'from setuptools import setup\nsetup(name="renamed")\n')
+    assert parse_requirement_line('-e ./setup_py').name == 'renamed'
+    
+    # Also on requirements memoized before the rename
+    assert parse_requirements_file(Path('requirements.in')).requirements[0] is requirement
+    assert requirement.name == 'renamed'
@@ -0,0 +1,93 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Startup time tests of the ct-* commands
+'''
+
+from chicken_turtle_project.tests.common import create_project, mkproject
+from textwrap import dedent
+import plumbum as pb
+import pytest
+import json
+import sys
+
+#: Modules that are slow to import, and only needed on some paths
+_slow_modules = {'git', 'pkg_resources', 'setuptools', 'versio', 'collections_extended', 'pypandoc'}
+
+#: Maximum import time of each entry point module, in milliseconds. Commands
+#: run on each commit or edit get the tightest budget.
+_budgets = {
+    'chicken_turtle_project.ct': 200,
+    'chicken_turtle_project.mkproject': 200,
+    'chicken_turtle_project.mkvenv': 200,
+    'chicken_turtle_project.pre_commit_hook': 200,
+    'chicken_turtle_project.mkdoc': 250,
+    'chicken_turtle_project.batch': 250,
+    'chicken_turtle_project.release': 300,
+}
+
+# Note: -X importtime requires Python 3.7, so time the import in the
+# interpreter itself
+_import_script = dedent('''\
+    import json, sys, time
+    start = time.perf_counter()
+    exec(sys.argv[1])
+    print(json.dumps({'time': (time.perf_counter() - start) * 1000, 'modules': sorted(sys.modules)}))
+    ''')
+
+def _run(code):
+    '''
+    Run code in a new interpreter
+    
+    Returns
+    -------
+    (float, {str})
+        Time it took in milliseconds and the names of the modules imported
+        by then.
+    '''
+    result = json.loads(pb.local[sys.executable]('-c', _import_script, code).splitlines()[-1])
+    return result['time'], set(result['modules'])
+
+def _get_slow_modules(modules):
+    return {module for module in modules if module.split('.')[0] in _slow_modules}
+
+@pytest.mark.parametrize('module', sorted(_budgets))
+def test_import_time(module):
+    '''
+    Entry points import no slow modules up front and start within budget
+    '''
+    time, modules = _run('import ' + module)
+    assert not _get_slow_modules(modules)
+    
+    # Best of 3 to reduce noise
+    time = min([time] + [_run('import ' + module)[0] for _ in range(2)])
+    assert time <= _budgets[module], '{} took {:.0f}ms to import, budget is {}ms'.format(module, time, _budgets[module])
+    
+def test_mkproject_no_op(tmpcwd):
+    '''
+    ct-mkproject on an up to date project imports no slow modules, e.g. it
+    doesn't open the git repo with GitPython
+    '''
+    create_project()
+    mkproject & pb.FG
+    _, modules = _run(dedent('''\
+        from chicken_turtle_project.mkproject import mkproject
+        from pathlib import Path
+        mkproject(Path.cwd())
+        '''))
+    assert not _get_slow_modules(modules)
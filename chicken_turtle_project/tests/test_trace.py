@@ -0,0 +1,70 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+CT_TRACE tests
+'''
+
+from chicken_turtle_project.tests.common import create_project, mkproject
+from chicken_turtle_project import trace
+from plumbum.commands.base import BaseCommand
+from pathlib import Path
+import plumbum as pb
+import json
+
+def read_trace(path):
+    with path.open() as f:
+        return json.loads(f.read().rstrip().rstrip(',') + ']')
+    
+def test_mkproject(tmpcwd):
+    '''
+    Trace includes the process, its stages and the commands they run, linked
+    by parent
+    '''
+    create_project()
+    path = Path('trace.json').absolute()
+    with pb.local.env(CT_TRACE=str(path), CT_CACHE_DIR=str(Path('cache').absolute())):  # empty cache, so pip-compile runs
+        mkproject()
+    spans = [event for event in read_trace(path) if event['ph'] == 'X']
+    spans = {(span['cat'], span['name']): span for span in spans}
+    process = spans['process', 'ct-mkproject']
+    assert process['args']['parent'] is None
+    for name in ('requirements_txt', 'setup_py'):
+        assert spans['stage', name]['args']['parent'] == process['args']['id']
+    pip_compile = spans['command', 'pip-compile']
+    assert pip_compile['args']['parent'] == spans['stage', 'requirements_txt']['args']['id']
+    assert pip_compile['args']['children_cpu_user'] > 0
+    assert pip_compile['args']['children_peak_rss_kb'] > 0
+    
+def test_stop(tmpcwd):
+    '''
+    Commands are only traced while tracing
+    '''
+    run = BaseCommand.run
+    path = Path('trace.json').absolute()
+    with pb.local.env(CT_TRACE=str(path)):
+        trace.start('test')
+    try:
+        assert BaseCommand.run is not run
+        pb.local['true']()
+    finally:
+        trace.stop()
+    assert BaseCommand.run is run
+    assert not trace.is_enabled()
+    pb.local['false'](retcode=1)
+    spans = [event['name'] for event in read_trace(path) if event['ph'] == 'X']
+    assert spans == ['true']
@@ -0,0 +1,213 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Trace spans of ct-* commands, their stages and the commands they run
+
+Tracing is enabled by setting ``CT_TRACE`` to a file path. Spans are appended
+to that file in the Chrome trace event format (JSON array format, which
+allows omitting the closing bracket), viewable with chrome://tracing or
+https://ui.perfetto.dev. Child processes inherit CT_TRACE and append to the
+same file, so one file covers e.g. a whole commit or release.
+
+Each span records wall time, the CPU time of the thread (or process) and of
+child processes that finished during the span, and the peak RSS of the
+process and of its children so far. The latter are process lifetime peaks
+(``ru_maxrss``) at the end of the span, not peaks during the span.
+'''
+
+from contextlib import contextmanager
+from itertools import count
+import plumbum as pb
+import threading
+import resource
+import json
+import time
+import os
+
+_path = None  # trace file path, None if not tracing
+_span_ids = count(1)
+_local = threading.local()  # .span_id: id of innermost span of thread
+_root_span_id = None  # id of the outermost span of the process
+_run = None  # plumbum's BaseCommand.run, while it is patched
+
+#: resource.getrusage who of the CPU time of a span
+_self = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+def start(name):
+    '''
+    Start tracing if CT_TRACE is set
+    
+    Also traces each plumbum command run.
+    
+    Parameters
+    ----------
+    name : str
+        Name of the process in the trace, e.g. 'ct-mkproject'.
+    '''
+    global _path
+    path = pb.local.env.get('CT_TRACE')
+    if not path or _path:
+        return
+    _path = os.path.abspath(path)
+    try:
+        fd = os.open(_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        pass
+    else:
+        os.write(fd, b'[\n')
+        os.close(fd)
+    _write(dict(name='process_name', ph='M', pid=os.getpid(), args=dict(name=name)))
+    _patch_plumbum()
+    
+def stop():
+    '''
+    Stop tracing, if tracing
+    
+    Restores plumbum's command run.
+    '''
+    global _path, _root_span_id
+    if not _path:
+        return
+    _unpatch_plumbum()
+    _path = None
+    _root_span_id = None
+    
+def is_enabled():
+    return _path is not None
+
+def get_current_span_id():
+    '''
+    Get id of the innermost span of the current thread
+    
+    Falls back to the outermost span of the process (for threads which have
+    not opened a span), or to the span of the parent process which started
+    this process.
+    
+    Returns
+    -------
+    str or None
+    '''
+    span_id = getattr(_local, 'span_id', None) or _root_span_id
+    if span_id is None:
+        return pb.local.env.get('CT_TRACE_PARENT')
+    return '{}:{}'.format(os.getpid(), span_id)
+
+def _write(event):
+    # Note: a single write to a file opened with O_APPEND does not interleave
+    # with those of other processes
+    fd = os.open(_path, os.O_WRONLY | os.O_APPEND)
+    try:
+        os.write(fd, (json.dumps(event, sort_keys=True) + ',\n').encode('utf-8'))
+    finally:
+        os.close(fd)
+        
+@contextmanager
+def span(name, category='stage', parent=None, **args):
+    '''
+    Record a span, if tracing
+    
+    Parameters
+    ----------
+    name : str
+    category : str
+        E.g. 'stage' or 'command'.
+    parent : str or None
+        Id of the parent span. Defaults to `get_current_span_id`, pass it
+        explicitly for spans in worker threads.
+    args
+        Extra info to include in the span, must be JSON serialisable.
+    '''
+    global _root_span_id
+    if not _path:
+        yield
+        return
+    span_id = next(_span_ids)
+    parent = parent or get_current_span_id()
+    if _root_span_id is None:
+        _root_span_id = span_id
+    previous_span_id = getattr(_local, 'span_id', None)
+    _local.span_id = span_id
+    self_start = resource.getrusage(_self)
+    children_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        self_end = resource.getrusage(_self)
+        children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _local.span_id = previous_span_id
+        args.update(
+            id='{}:{}'.format(os.getpid(), span_id),
+            parent=parent,
+            cpu_user=self_end.ru_utime - self_start.ru_utime,
+            cpu_system=self_end.ru_stime - self_start.ru_stime,
+            process_peak_rss_kb=self_end.ru_maxrss,
+            children_cpu_user=children_end.ru_utime - children_start.ru_utime,
+            children_cpu_system=children_end.ru_stime - children_start.ru_stime,
+            children_peak_rss_kb=children_end.ru_maxrss,
+        )
+        _write(dict(
+            name=name, cat=category, ph='X',
+            ts=int(start * 1e6), dur=int((end - start) * 1e6),
+            pid=os.getpid(), tid=threading.get_ident(),
+            args=args,
+        ))
+        
+def _patch_plumbum():
+    '''
+    Record a span for each plumbum command run, until `_unpatch_plumbum`
+    
+    Commands are run all over CTP (and by chicken_turtle_util), so they are
+    traced by patching plumbum rather than at each call site. The patch only
+    applies while tracing.
+    '''
+    global _run
+    from plumbum.commands.base import BaseCommand
+    if _run:
+        return
+    _run = run = BaseCommand.run
+    def traced_run(self, *args, **kwargs):
+        with span(_get_command_name(self), 'command', command=str(self)):
+            # Child processes refer to the command's span as their parent
+            return run(self.with_env(CT_TRACE_PARENT=get_current_span_id()), *args, **kwargs)
+    BaseCommand.run = traced_run
+    
+def _unpatch_plumbum():
+    global _run
+    from plumbum.commands.base import BaseCommand
+    if _run:
+        BaseCommand.run = _run
+        _run = None
+    
+def _get_command_name(command):
+    '''
+    Get short name of command, e.g. 'pip install' or 'git add'
+    '''
+    words = str(command).split()
+    if not words:
+        return str(command)
+    name = [os.path.basename(words[0])]
+    for word in words[1:]:
+        if word.startswith(('-', "'", '"')) or '/' in word:
+            if os.path.basename(word) in ('pip', 'pip-compile'):  # python path/to/pip ...
+                name.append(os.path.basename(word))
+            continue
+        name.append(word)
+        break
+    return ' '.join(name)
@@ -0,0 +1,275 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Store of populated base venvs, from which project venvs are cloned
+
+A base venv has the non-editable requirements of a requirements.txt
+installed and is keyed by the interpreter and those requirements. Projects
+(or clones, worktrees, ...) with the same requirements share a base. A
+project venv is created by hard linking the files of the base (copying
+those which could be modified in place) and replacing the base's path in
+its scripts.
+
+A hard linked file is the same file in the base and in every venv cloned
+from it. To prevent writing to one from corrupting all others, the files of
+a base are made read-only. Installing, upgrading or removing packages in a
+clone is safe, as pip replaces or removes files rather than writing to them.
+
+The store keeps the `CT_VENV_STORE_SIZE` (default 10) most recently used
+bases, older ones are removed when a base is added.
+'''
+
+from chicken_turtle_project.cache import get_cache_dir, digest, lock
+from chicken_turtle_project.common import remove_file
+from tempfile import mkdtemp
+from pathlib import Path
+import plumbum as pb
+import logging
+import shutil
+import stat
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+_manifest_name = 'ct_venv_store.json'
+_default_size = 10
+
+def get_store_dir():
+    '''
+    Get directory of the venv store
+    
+    Returns
+    -------
+    pathlib.Path
+    '''
+    return get_cache_dir() / 'venvs'
+
+def create_venv(python, requirements_txt, venv_dir, populate):
+    '''
+    Create venv with the non-editable requirements of requirements.txt installed
+    
+    The venv is cloned from the store. If the store has no matching base venv,
+    it is created first and least recently used bases are removed from the
+    store. Concurrent ct-* processes which need the same base venv wait for
+    the first one to create it.
+    
+    Parameters
+    ----------
+    python : plumbum command
+        Python interpreter to create the venv with.
+    requirements_txt : chicken_turtle_project.requirements.RequirementsFile
+    venv_dir : pathlib.Path
+        Absolute path of the venv to create. Must not exist.
+    populate : (pathlib.Path, [chicken_turtle_project.requirements.Requirement]) -> None
+        Install requirements in the venv at the given path. Called when
+        creating a base venv.
+    '''
+    requirements = [requirement for requirement in requirements_txt.requirements if not requirement.editable]
+    base_dir = get_store_dir() / _get_key(python, requirements, requirements_txt.options)
+    manifest_path = base_dir / _manifest_name
+    created = False
+    with _lock(base_dir):  # Note: also keeps prune from removing the base while cloning
+        if manifest_path.exists():
+            logger.info('Creating venv from venv store')
+        else:
+            logger.info('Creating venv and adding it to the venv store')
+            _create_base(python, base_dir, requirements, populate)
+            created = True
+        os.utime(str(manifest_path))  # mark as used, see prune
+            
+        # Note: clone next to venv_dir and move into place, so an interrupted
+        # clone does not leave a broken venv behind
+        with manifest_path.open() as f:
+            base_prefix = json.load(f)['prefix']
+        temp_dir = Path(mkdtemp(dir=str(venv_dir.parent), prefix='.' + venv_dir.name))
+        try:
+            clone_dir = temp_dir / 'venv'
+            os.mkdir(str(clone_dir))
+            _clone(base_dir, clone_dir, base_prefix.encode(), str(venv_dir).encode())
+            os.rename(str(clone_dir), str(venv_dir))
+        finally:
+            remove_file(temp_dir)
+    if created:
+        prune(int(pb.local.env.get('CT_VENV_STORE_SIZE', _default_size)))
+        
+def prune(size):
+    '''
+    Remove all but the most recently used bases from the store
+    
+    Bases in use by another process are kept.
+    
+    Parameters
+    ----------
+    size : int
+        Number of bases to keep.
+    '''
+    store_dir = get_store_dir()
+    bases = []
+    for path in store_dir.iterdir():
+        try:
+            bases.append(((path / _manifest_name).stat().st_mtime, path))
+        except (FileNotFoundError, NotADirectoryError):  # not a base, e.g. a lock file
+            pass
+    for _, base_dir in sorted(bases, reverse=True)[size:]:
+        try:
+            with _lock(base_dir, blocking=False):
+                logger.info('Removing least recently used venv from venv store: {}'.format(base_dir.name))
+                temp_dir = Path(mkdtemp(dir=str(store_dir), prefix='.tmp'))
+                try:
+                    os.rename(str(base_dir), str(temp_dir / 'venv'))  # remove atomically
+                finally:
+                    remove_file(temp_dir)
+        except BlockingIOError:
+            logger.debug('Not removing venv from venv store, it is in use: {}'.format(base_dir.name))
+            
+def _lock(base_dir, blocking=True):
+    return lock(base_dir.with_name(base_dir.name + '.lock'), blocking)
+    
+def get_interpreter_digest(executable):
+    '''
+    Get digest identifying a Python interpreter
+    
+    Parameters
+    ----------
+    executable : str or pathlib.Path
+        Path to the interpreter, e.g. the ``bin/python`` of a venv.
+    
+    Returns
+    -------
+    str
+        Digest of the real path and stat of the executable. It changes when
+        the interpreter is reinstalled, e.g. upgraded to another patch
+        version.
+    '''
+    executable = os.path.realpath(str(executable))
+    stat = os.stat(executable)
+    return digest(executable, str(stat.st_mtime_ns), str(stat.st_size))
+    
+def _get_key(python, requirements, options):
+    '''
+    Get store key of a base venv
+    '''
+    return digest(get_interpreter_digest(python.executable), *(list(options) + sorted(requirement.line for requirement in requirements)))
+
+def _create_base(python, base_dir, requirements, populate):
+    '''
+    Create base venv in the store
+    
+    The venv is created in a temporary directory in the store, made
+    read-only and then moved into place. Its original path is saved in its
+    manifest, to be replaced when cloning.
+    '''
+    base_dir.parent.mkdir(parents=True, exist_ok=True)
+    temp_dir = Path(mkdtemp(dir=str(base_dir.parent), prefix='.tmp'))
+    try:
+        venv_dir = temp_dir / 'venv'
+        python('-m', 'venv', str(venv_dir))
+        populate(venv_dir, requirements)
+        with (venv_dir / _manifest_name).open('w') as f:
+            json.dump({'prefix': str(venv_dir)}, f)
+        _make_read_only(venv_dir)
+        try:
+            os.rename(str(venv_dir), str(base_dir))
+        except OSError:
+            if not (base_dir / _manifest_name).exists():
+                raise
+            # else: a concurrent ct-* process created the same base first
+    finally:
+        remove_file(temp_dir)
+
+def _make_read_only(venv_dir):
+    '''
+    Remove write permissions of the files (not the directories) of a venv
+    '''
+    for parent, _, files in os.walk(str(venv_dir)):
+        for name in files:
+            path = os.path.join(parent, name)
+            if not os.path.islink(path):
+                os.chmod(path, stat.S_IMODE(os.stat(path).st_mode) & ~0o222)
+                
+def _clone(base_dir, venv_dir, base_prefix, prefix):
+    '''
+    Clone base venv to venv_dir
+    
+    Files are hard linked, except:
+    
+    - files which may be modified in place: scripts in ``bin``, ``*.pth`` and
+      ``pyvenv.cfg``. These are copied and the path of the base is replaced
+      by the path of the clone.
+    - files which pip or Python may write: the files in ``*.dist-info`` and
+      ``*.egg-info`` directories (e.g. RECORD) and ``*.pyc`` files. These are
+      copied as is.
+    - ``__pycache__`` directories, the compiled files reference the paths of
+      the base.
+    - the store manifest.
+    
+    Symlinks are copied as is. Files are copied instead of linked if linking
+    fails, e.g. when the store is on another file system. Copied files are
+    writable, linked files are read-only like the base.
+    
+    Parameters
+    ----------
+    base_dir : pathlib.Path
+    venv_dir : pathlib.Path
+        Existing empty directory.
+    base_prefix : bytes
+        Path of the base to replace in copied files.
+    prefix : bytes
+        Path to replace it with.
+    '''
+    base_dir = str(base_dir)
+    venv_dir = str(venv_dir)
+    for parent, directories, files in os.walk(base_dir):
+        directories[:] = [directory for directory in directories if directory != '__pycache__']
+        relative_parent = os.path.relpath(parent, base_dir)
+        target_parent = os.path.normpath(os.path.join(venv_dir, relative_parent))
+        is_bin = relative_parent == 'bin'
+        is_metadata = parent.endswith(('.dist-info', '.egg-info'))
+        for name in directories + files:
+            if relative_parent == '.' and name == _manifest_name:
+                continue
+            source = os.path.join(parent, name)
+            target = os.path.join(target_parent, name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                if name in directories:
+                    directories.remove(name)  # Note: do not descend into symlinked dirs, e.g. lib64
+            elif name in directories:
+                os.mkdir(target)
+            elif is_bin or name.endswith('.pth') or (relative_parent == '.' and name == 'pyvenv.cfg'):
+                with open(source, 'rb') as f:
+                    content = f.read()
+                with open(target, 'wb') as f:
+                    f.write(content.replace(base_prefix, prefix))
+                _copy_mode(source, target)
+            elif is_metadata or name.endswith('.pyc'):
+                shutil.copyfile(source, target)
+                _copy_mode(source, target)
+            else:
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy2(source, target)
+                    _copy_mode(source, target)
+                    
+def _copy_mode(source, target):
+    '''
+    Copy mode of a base file to its copy, keeping the copy writable
+    '''
+    os.chmod(target, stat.S_IMODE(os.stat(source).st_mode) | stat.S_IWUSR)
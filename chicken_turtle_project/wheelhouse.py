@@ -0,0 +1,213 @@
+# Copyright (C) 2016 Tim Diels <timdiels.m@gmail.com>
+# 
+# This file is part of Chicken Turtle Project.
+# 
+# Chicken Turtle is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Chicken Turtle is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with Chicken Turtle.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Shared wheelhouse of the dependencies of venvs
+
+Pinned dependencies are installed from wheels in the CTP cache dir, built
+(or downloaded) once per name, version, Python version and platform. A venv
+that is recreated (e.g. in a fresh clone) then only needs to unpack wheels,
+instead of downloading them and building those only available as sdist.
+
+Distributions of missing wheels are downloaded concurrently first, see
+`chicken_turtle_project.prefetch`. Their wheels, as downloaded or as built
+from the downloaded sdist, are added to the wheelhouse, so the wheelhouse
+rather than the downloads directory is what requirements are installed from.
+'''
+
+from chicken_turtle_project.requirements import parse_distribution_file_name
+from chicken_turtle_project import prefetch
+from chicken_turtle_project.cache import get_cache_dir
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from pathlib import Path
+import sysconfig
+import logging
+import shutil
+import os
+
+logger = logging.getLogger(__name__)
+
+def get_wheelhouse_dir(python_version):
+    '''
+    Get wheelhouse directory for a Python version on the current platform
+    
+    Parameters
+    ----------
+    python_version : (int, int)
+        Major and minor version of the Python the wheels are for.
+    
+    Returns
+    -------
+    pathlib.Path
+    '''
+    return get_cache_dir() / 'wheelhouse' / 'py{}{}-{}'.format(python_version[0], python_version[1], sysconfig.get_platform())
+
+def install(pip, requirements, options, python_version, jobs=None):
+    '''
+    Install requirements, from the wheelhouse where possible
+    
+    Wheels of pinned requirements (``name==version``) missing from the
+    wheelhouse are downloaded or built first, concurrently. Requirements with
+    a wheel are installed without consulting the index.
+    
+    Parameters
+    ----------
+    pip : plumbum command
+        pip of the venv to install in.
+    requirements : [chicken_turtle_project.requirements.Requirement]
+        Requirements whose environment markers, if any, match the venv.
+    options : [str]
+        Option lines of the requirements file, e.g. ``--index-url url``.
+    python_version : (int, int) or None
+        Major and minor version of the venv's Python. If None, install without
+        wheelhouse.
+    jobs : int or None
+        Maximum number of wheels to build concurrently. Default: number of CPUs.
+    '''
+    if python_version is None or any(requirement.hashes for requirement in requirements):
+        # Note: locally built wheels would not match the hashes
+        _pip_install(pip, options, [requirement.line for requirement in requirements])
+        return
+    
+    wheelhouse_dir = get_wheelhouse_dir(python_version)
+    wheels = build_wheels(pip, requirements, options, python_version, jobs)
+    options = list(options) + ['--find-links ' + str(wheelhouse_dir)]
+    
+    # Install those in the wheelhouse without consulting the index. Note:
+    # requirements.txt pins all dependencies, except unsafe ones such as
+    # setuptools, which are installed next
+    local = [requirement.line for requirement in requirements if requirement.pin in wheels]
+    if local:
+        _pip_install(pip, options + ['--no-index'], local, '--no-deps')
+        
+    # Install the others (e.g. editable requirements) normally. Those whose
+    # wheel failed to build are installed from their download
+    remote = [requirement for requirement in requirements if requirement.pin not in wheels]
+    if remote:
+        downloads = prefetch.get_downloads(remote, python_version)
+        options.extend('--find-links ' + str(path.parent) for path in sorted(downloads.values()))
+        _pip_install(pip, options, [requirement.line for requirement in remote])
+    
+def build_wheels(pip, requirements, options, python_version, jobs=None):
+    '''
+    Add wheels of pinned requirements to the wheelhouse, if missing
+    
+    Distributions are prefetched concurrently. Downloaded wheels are added
+    as is, the others are built by a separate ``pip wheel --no-deps`` process
+    each. Wheels which fail to build are skipped, with a warning.
+    
+    Parameters
+    ----------
+    pip : plumbum command
+    requirements : [chicken_turtle_project.requirements.Requirement]
+    options : [str]
+    python_version : (int, int)
+    jobs : int or None
+    
+    Returns
+    -------
+    {(str, packaging.version.Version or str) : pathlib.Path}
+        Wheel by pin, see `chicken_turtle_project.requirements.Requirement.pin`,
+        for all wheels in the wheelhouse.
+    '''
+    wheelhouse_dir = get_wheelhouse_dir(python_version)
+    wheelhouse_dir.mkdir(parents=True, exist_ok=True)
+    wheels = _list_wheels(wheelhouse_dir)
+    missing = [requirement for requirement in requirements if requirement.pin and requirement.pin not in wheels]
+    if not missing:
+        return wheels
+    
+    downloads = prefetch.prefetch(pip, missing, options, python_version)
+    to_build = []
+    for requirement in missing:
+        path = downloads.get(requirement.pin)
+        if path and path.name.endswith('.whl'):
+            _add_wheel(path, wheelhouse_dir)
+        else:
+            to_build.append((requirement, str(path) if path else requirement.line))
+    if to_build:
+        logger.info('Building wheels of {}'.format(', '.join(requirement.name for requirement, _ in to_build)))
+        with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+            errors = executor.map(lambda item: _build_wheel(pip, item[1], options, wheelhouse_dir), to_build)
+            for (requirement, _), error in zip(to_build, errors):
+                if error:
+                    logger.warning('Failed to build wheel of {}, it will be installed without wheelhouse:\n{}'.format(requirement.line, error))
+    return _list_wheels(wheelhouse_dir)
+    
+def _add_wheel(path, wheelhouse_dir):
+    '''
+    Add downloaded wheel to the wheelhouse, as a hard link if possible
+    '''
+    with TemporaryDirectory(dir=str(wheelhouse_dir), prefix='.tmp') as temp_dir:
+        temp_path = Path(temp_dir) / path.name
+        try:
+            os.link(str(path), str(temp_path))
+        except OSError:
+            shutil.copyfile(str(path), str(temp_path))
+        os.replace(str(temp_path), str(wheelhouse_dir / path.name))
+    
+def _build_wheel(pip, source, options, wheelhouse_dir):
+    '''
+    Build wheel into the wheelhouse
+    
+    Parameters
+    ----------
+    source : str
+        Requirement line or path to an sdist.
+    
+    Returns
+    -------
+    str or None
+        Error message, None if succeeded.
+    '''
+    # Note: build in a temporary dir and move into place, so concurrent ct-*
+    # processes never see a partial wheel
+    with TemporaryDirectory(dir=str(wheelhouse_dir), prefix='.tmp') as temp_dir:
+        temp_dir = Path(temp_dir)
+        requirements_path = temp_dir / 'requirements.txt'
+        _write_requirements(requirements_path, options, [source])
+        build_dir = temp_dir / 'wheels'
+        exit_code, _, stderr = pip.run(['wheel', '--no-deps', '-w', str(build_dir), '-r', str(requirements_path)], retcode=None)
+        if exit_code:
+            return stderr
+        for path in build_dir.glob('*.whl'):
+            os.replace(str(path), str(wheelhouse_dir / path.name))
+    return None
+    
+def _list_wheels(wheelhouse_dir):
+    '''
+    Get wheels in the wheelhouse by pin
+    '''
+    wheels = {}
+    for name in os.listdir(str(wheelhouse_dir)):
+        if name.endswith('.whl'):
+            pin = parse_distribution_file_name(name)
+            if pin:
+                wheels[pin] = wheelhouse_dir / name
+    return wheels
+
+def _pip_install(pip, options, lines, *args):
+    with TemporaryDirectory() as temp_dir:
+        path = Path(temp_dir) / 'requirements.txt'
+        _write_requirements(path, options, lines)
+        pip('install', '-r', str(path), *args)
+        
+def _write_requirements(path, options, lines):
+    with path.open('w') as f:
+        for line in list(options) + list(lines):
+            f.write(line + '\n')
@@ -57,6 +57,8 @@ project = dict(
     # Auto generate entry points
     entry_points={
         'console_scripts': [
+            'ct = chicken_turtle_project.ct:main',
+            'ct-batch = chicken_turtle_project.batch:main',
             'ct-mkproject = chicken_turtle_project.mkproject:main',
             'ct-mkvenv = chicken_turtle_project.mkvenv:main',
             'ct-release = chicken_turtle_project.release:main',
@@ -36,7 +36,9 @@ setup(
                        'Programming Language :: Python :: Implementation :: Stackless',
                        'Topic :: Software Development'],
     'description': 'Python 3 project development tools',
-    'entry_points': {   'console_scripts': [   'ct-mkdoc = chicken_turtle_project.mkdoc:main',
+    'entry_points': {   'console_scripts': [   'ct = chicken_turtle_project.ct:main',
+                                               'ct-batch = chicken_turtle_project.batch:main',
+                                               'ct-mkdoc = chicken_turtle_project.mkdoc:main',
                                                'ct-mkproject = chicken_turtle_project.mkproject:main',
                                                'ct-mkvenv = chicken_turtle_project.mkvenv:main',
                                                'ct-pre-commit-hook = chicken_turtle_project.pre_commit_hook:main',
@@ -53,8 +55,11 @@ setup(
                             'click',
                             'collections-extended',
                             'gitpython',
+                            'm2r>=0.1.11',
+                            'mistune<2',
                             'more-itertools',
                             'numpy',
+                            'packaging',
                             'pip-tools>=1.7',
                             'plumbum',
                             'pypandoc',